@@ -3,13 +3,24 @@ import io
 import os
 import tarfile
 import re
+import time
+import shutil
+import tempfile
+import queue
+import threading
+import multiprocessing
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
 import traceback
 
+from pymongo import UpdateOne
+
 from database import DbClient
-from jpo_bulk_data import Browser
 import common_util
+import jpp_cache
 from local_config import Config
 
 conf = Config()
@@ -26,6 +37,12 @@ logging.basicConfig(
 
 logger = logging.getLogger('daily_inquire')
 
+# まとめて検索・更新する件数
+CHUNK_SIZE = 500
+
+# 法域とファイル名の記号
+LAWS = (('Patent', 'p'), ('Utility', 'u'), ('Design', 'd'), ('Trademark', 't'))
+
 def read_tsv(target):
     """
     タブ区切りテキストを読み込む
@@ -70,173 +87,519 @@ def read_tsv(target):
         line = wrapper.readline()
 
 
-def extract_and_import(filepath, db):
+@contextmanager
+def measure(timings, stage):
     """
-    1ファイルをインポートする
+    処理段階ごとの所要時間を計測する
     """
-    # 展開
-    with tarfile.open(filepath, mode='r:gz') as tf:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + (time.perf_counter() - started)
 
-        # メンバーリストの取得
-        members = { Path(m.name).name: m for m in tf.getmembers() }
+def index_tsv(ef):
+    """
+    タブ区切りテキストを読み込み、(law_cd, reg_num) ごとの行のリストにまとめる
+    """
+    index = {}
+    for info in read_tsv(ef):
+        key = (info['law_cd'], info['reg_num'])
+        if not key in index:
+            index[key] = []
+        index[key].append(info)
+    return index
+
+def law_file_names(law, c):
+    """
+    1つの法域のインポートに使うファイル名（管理情報ファイル、権利者ファイル、指定区分ファイル）
+    """
+    names = ['upd_mgt_info_%s.tsv' % c, 'upd_right_person_art_%s.tsv' % c]
 
-        # 法域ごとにチェックする
-        for law, c in (('Patent', 'p'), ('Utility', 'u'), ('Design', 'd'), ('Trademark', 't')):
+    # 指定区分ファイルは (law_cd, reg_num) で結合するため、商標の行にしか該当しない
+    if law == 'Trademark':
+        names.append('upd_goods_class_art.tsv')
+
+    return names
+
+def make_holders(rows):
+    """
+    権利者ファイルの行から権利者のリストを生成する
+    """
+    holders = []
+    for info2 in rows:
+        doc = {}
+        if 'right_person_appl_id' in info2:
+            doc['Id'] = info2['right_person_appl_id']
+        else:
+            # 識別番号を取得できない場合は権利者を更新しない
+            return []
+        if 'right_person_name' in info2:
+            doc['Name'] = common_util.zen_to_han(info2['right_person_name'])
+        if len(doc) > 0:
+            holders.append(doc)
+    return holders
+
+def make_classes(rows):
+    """
+    指定区分ファイルの行から区分のリストを生成する
+    """
+    return [x['desig_goods_or_desig_wrk_class'] for x in rows if 'desig_goods_or_desig_wrk_class' in x]
+
+def load_registered_keys(db, law=None):
+    """
+    登録されている日本の権利の (法域, 登録番号) の集合を取得する
+    """
+    query = {
+        'Country': 'JP',
+        'RegistrationNumber': {'$exists': True},
+        'Ignored': {'$exists': False},
+    }
+    if not law is None:
+        query['Law'] = law
+    keys = set()
+    for prop in db.Properties.find(query, {'Law': 1, 'RegistrationNumber': 1}):
+        keys.add((prop['Law'], prop['RegistrationNumber']))
+    return keys
+
+def make_query(prop, update, now):
+    """
+    権利（エントリー）ごとの更新クエリーを生成する
+    """
+    query = { '$set': {}, '$unset': {} }
+
+    for key in update:
+        if key in ('PaidYears', 'NextProcedureLimit',):
+            query['$set'][key] = update[key]
+
+    # 納付済年分
+    if 'PaidYears' in update:
+        if not 'PaidYears' in prop or prop['PaidYears'] < update['PaidYears']:
+            query['$set']['PaidYears'] = update['PaidYears']
+
+    # 次回手続期限
+    if 'NextProcedureLimit' in update:
+        if not 'NextProcedureLimit' in prop or prop['NextProcedureLimit'] < update['NextProcedureLimit']:
+            query['$set']['NextProcedureLimit'] = update['NextProcedureLimit']
+
+    # 照会日時等
+    query['$set']['JpoInquiredTime'] = now
+    query['$set']['InquiredTime'] = query['$set']['JpoInquiredTime']
+    query['$set']['ModifiedTime'] = query['$set']['JpoInquiredTime']
+
+    if len(query['$unset']) == 0:
+        del query['$unset']
+    return query
+
+def flush_updates(db, law, pending, stats, timings):
+    """
+    保留している行の登録番号をまとめて検索し、該当する権利をまとめて更新する
+    """
+    if len(pending) < 1:
+        return
+
+    # 既存の登録をまとめて調べる
+    with measure(timings, 'lookup'):
+        found = {}
+        for prop in db.Properties.find({
+            'Country': 'JP',
+            'Law': law,
+            'RegistrationNumber': {'$in': list(set([x[0] for x in pending]))},
+            'Ignored': {'$exists': False}
+        }, {'RegistrationNumber': 1, 'PaidYears': 1, 'NextProcedureLimit': 1}):
+            if not prop['RegistrationNumber'] in found:
+                found[prop['RegistrationNumber']] = []
+            found[prop['RegistrationNumber']].append(prop)
+
+    # 権利（エントリー）ごとの更新クエリーを生成する
+    # ※同じ権利に複数の行がある場合は、行の順に適用した結果にまとめる
+    now = datetime.now()
+    queries = {}
+    for reg_num, update in pending:
+        if not reg_num in found:
+            continue
+        props = found[reg_num]
+        logger.debug('[%s] (props) are found for updating.', ','.join([str(x['_id']) for x in props]))
+        stats['Matched'] += len(props)
+        for prop in props:
+            query = make_query(prop, update, now)
+            if prop['_id'] in queries:
+                queries[prop['_id']]['$set'].update(query['$set'])
+            else:
+                queries[prop['_id']] = query
+
+    # まとめて更新する
+    if len(queries) > 0:
+        with measure(timings, 'write'):
+            res = db.Properties.bulk_write([UpdateOne({'_id': k}, v) for k, v in queries.items()], ordered=False)
+            stats['Updated'] += res.modified_count
+
+        # 更新した権利の J-PlatPat の照会結果のキャッシュを破棄する
+        with measure(timings, 'invalidate'):
+            stats['Invalidated'] += jpp_cache.invalidate(law, set([x[0] for x in pending if x[0] in found]))
+
+def new_stats():
+    """
+    処理件数の集計を初期化する
+    """
+    return {'Scanned': 0, 'Candidates': 0, 'Matched': 0, 'Updated': 0, 'Invalidated': 0}
+
+def log_stats(name, stats, timings):
+    """
+    処理件数と処理段階ごとの所要時間を出力する
+    """
+    logger.info('%s: scanned %d, candidates %d, matched %d, updated %d, invalidated %d', name, stats['Scanned'], stats['Candidates'], stats['Matched'], stats['Updated'], stats['Invalidated'])
+    logger.info('%s: %s', name, ', '.join(['%s %.2fs' % (k, v) for k, v in timings.items()]))
+
+def import_law(open_file, names, law, c, db, keys, stats, timings, indexes):
+    """
+    1ファイルのうち、1つの法域の管理情報をインポートする
+    open_file にはファイル名を渡すと展開したファイルを返す関数、names には含まれているファイル名を渡す
+    indexes には読み込んだ権利者・指定区分ファイルの索引を保持する（ファイル名→索引）
+    :return 管理情報ファイルが含まれていたか否か
+    """
+    # 管理情報ファイル（の更新データ）が含まれるかチェックする
+    name, *names2 = law_file_names(law, c)
+
+    if not name in names:
+        return False
+
+    # 権利者ファイル・指定区分ファイル（商標のみ）を読み込む
+    for name2 in names2:
+        if name2 in names and not name2 in indexes:
+            with measure(timings, 'index:%s' % name2), open_file(name2) as ef:
+                indexes[name2] = index_tsv(ef)
+
+    holders_index = indexes.get('upd_right_person_art_%s.tsv' % c)
+    classes_index = indexes.get('upd_goods_class_art.tsv') if 'upd_goods_class_art.tsv' in names2 else None
+
+    # 管理情報ファイルを展開する
+    with measure(timings, 'import:%s' % name), open_file(name) as ef:
+
+        pending = []
+
+        for info in read_tsv(ef):
 
-            # 管理情報ファイル（の更新データ）が含まれるかチェックする
-            name = 'upd_mgt_info_%s.tsv' % c
+            # 登録番号を取得する
+            reg_num = common_util.pad0(info['reg_num'], length=7)
 
-            if not name in members:
+            stats['Scanned'] += 1
+
+            # 登録されていない権利はスキップする
+            if not (law, reg_num) in keys:
                 continue
 
-            # 管理情報ファイルを展開する
-            with tf.extractfile(members[name]) as ef:
+            stats['Candidates'] += 1
 
-                for info in read_tsv(ef):
+            # 更新情報を生成する
+            update = {}
 
-                    # 登録番号を取得する
-                    reg_num = common_util.pad0(info['reg_num'], length=7)
+            # 存続期間満了日
+            if 'conti_prd_expire_ymd' in info and info['conti_prd_expire_ymd'] != '00000000':
+                update['ExpirationDate'] = datetime.strptime(info['conti_prd_expire_ymd'], '%Y%m%d')
 
-                    # 既存の登録を調べる
-                    props = list(db.Properties.find({
-                        'Country': 'JP',
-                        'Law': law,
-                        'RegistrationNumber': reg_num,
-                        'Ignored': {'$exists': False}
-                    }))
+            # 次回手続期限
+            if 'next_pen_pymnt_tm_lmt_ymd' in info and info['next_pen_pymnt_tm_lmt_ymd'] != '00000000':
+                update['NextProcedureLimit'] = datetime.strptime(info['next_pen_pymnt_tm_lmt_ymd'], '%Y%m%d')
 
-                    # 該当がなければスキップする
-                    if len(props) < 1:
-                        continue
+            # 最終納付年分
+            if 'last_pymnt_yearly' in info and info['last_pymnt_yearly'] != '00':
+                update['PaidYears'] = int(info['last_pymnt_yearly'])
 
-                    logger.debug('[%s] (props) are found for updating.', ','.join([str(x['_id']) for x in props]))
+            # 消滅日
+            if 'right_disppr_year_month_day' in info and info['right_disppr_year_month_day'] != '00000000':
+                update['DisappearanceDate'] = datetime.strptime(info['right_disppr_year_month_day'], '%Y%m%d')
 
-                    # 更新情報を生成する
-                    update = {}
+            # 出願日
+            if 'app_year_month_day' in info and info['app_year_month_day'] != '00000000':
+                update['ApplicationDate'] = datetime.strptime(info['app_year_month_day'], '%Y%m%d')
 
-                    # 存続期間満了日
-                    if 'conti_prd_expire_ymd' in info and info['conti_prd_expire_ymd'] != '00000000':
-                        update['ExpirationDate'] = datetime.strptime(info['conti_prd_expire_ymd'], '%Y%m%d')
+            # 登録日
+            if 'set_reg_year_month_day' in info and info['set_reg_year_month_day'] != '00000000':
+                update['RegistrationDate'] = datetime.strptime(info['set_reg_year_month_day'], '%Y%m%d')
 
-                    # 次回手続期限
-                    if 'next_pen_pymnt_tm_lmt_ymd' in info and info['next_pen_pymnt_tm_lmt_ymd'] != '00000000':
-                        update['NextProcedureLimit'] = datetime.strptime(info['next_pen_pymnt_tm_lmt_ymd'], '%Y%m%d')
+            # 請求項の数
+            if 'invent_cnt_claim_cnt_cls_cnt' in info and info['invent_cnt_claim_cnt_cls_cnt'] != '000':
+                update['NumberOfClaims'] = int(info['invent_cnt_claim_cnt_cls_cnt'])
 
-                    # 最終納付年分
-                    if 'last_pymnt_yearly' in info and info['last_pymnt_yearly'] != '00':
-                        update['PaidYears'] = int(info['last_pymnt_yearly'])
+            # 発明等の名称
+            if 'invent_title_etc' in info:
+                update['Subject'] = common_util.zen_to_han(info['invent_title_etc'])
 
-                    # 消滅日
-                    if 'right_disppr_year_month_day' in info and info['right_disppr_year_month_day'] != '00000000':
-                        update['DisappearanceDate'] = datetime.strptime(info['right_disppr_year_month_day'], '%Y%m%d')
+            # 権利者
+            key = (info['law_cd'], info['reg_num'])
 
-                    # 出願日
-                    if 'app_year_month_day' in info and info['app_year_month_day'] != '00000000':
-                        update['ApplicationDate'] = datetime.strptime(info['app_year_month_day'], '%Y%m%d')
+            if not holders_index is None:
+                holders = make_holders(holders_index[key]) if key in holders_index else []
+                if len(holders) > 0:
+                    update['Holders'] = holders
 
-                    # 登録日
-                    if 'set_reg_year_month_day' in info and info['set_reg_year_month_day'] != '00000000':
-                        update['RegistrationDate'] = datetime.strptime(info['set_reg_year_month_day'], '%Y%m%d')
+            # 指定区分
+            if not classes_index is None:
+                classes = make_classes(classes_index[key]) if key in classes_index else []
+                if len(classes) > 0:
+                    update['Classes'] = classes
+                    update['NumberOfClasses'] = len(classes)
 
-                    # 請求項の数
-                    if 'invent_cnt_claim_cnt_cls_cnt' in info and info['invent_cnt_claim_cnt_cls_cnt'] != '000':
-                        update['NumberOfClaims'] = int(info['invent_cnt_claim_cnt_cls_cnt'])
+            # まとめて更新する
+            pending.append((reg_num, update))
+            if len(pending) >= CHUNK_SIZE:
+                flush_updates(db, law, pending, stats, timings)
+                pending = []
 
-                    # 発明等の名称
-                    if 'invent_title_etc' in info:
-                        update['Subject'] = common_util.zen_to_han(info['invent_title_etc'])
+        flush_updates(db, law, pending, stats, timings)
 
-                    # 権利者ファイルを探す
-                    name2 = 'upd_right_person_art_%s.tsv' % c
+    return True
 
-                    if name2 in members:
+def extract_and_import(filepath, db, keys=None):
+    """
+    1ファイルをインポートする
+    keys には登録されている権利の (法域, 登録番号) の集合を渡す（省略時は読み込む）
+    """
+    timings = {}
+    stats = new_stats()
 
-                        holders = []
+    # 登録されている権利
+    if keys is None:
+        with measure(timings, 'keys'):
+            keys = load_registered_keys(db)
 
-                        with tf.extractfile(members[name2]) as ef2:
+    # 展開
+    with tarfile.open(filepath, mode='r:gz') as tf:
 
-                            for info2 in read_tsv(ef2):
+        # メンバーリストの取得
+        with measure(timings, 'members'):
+            members = { Path(m.name).name: m for m in tf.getmembers() }
 
-                                if info2['law_cd'] == info['law_cd'] \
-                                    and info2['reg_num'] == info['reg_num']:
-                                    doc = {}
-                                    if 'right_person_appl_id' in info2:
-                                        doc['Id'] = info2['right_person_appl_id']
-                                    else:
-                                        # 識別番号を取得できない場合は権利者を更新しない
-                                        holders = []
-                                        break
-                                    if 'right_person_name' in info2:
-                                        doc['Name'] = common_util.zen_to_han(info2['right_person_name'])
-                                    if len(doc) > 0:
-                                        holders.append(doc)
+        # 法域ごとにチェックする
+        indexes = {}
+        for law, c in LAWS:
+            import_law(lambda name: tf.extractfile(members[name]), members, law, c, db, keys, stats, timings, indexes)
 
-                        if len(holders) > 0:
-                            update['Holders'] = holders
+    # 処理件数と処理段階ごとの所要時間
+    log_stats(Path(filepath).name, stats, timings)
 
-                    # 指定区分ファイルを探す
-                    name2 = 'upd_goods_class_art.tsv'
+    return stats
 
-                    if name2 in members:
+def import_law_file(files, law, c):
+    """
+    1ファイルのうち、1つの法域をインポートする（プロセスプールで実行する）
+    files には親プロセスで展開した、この法域のファイルのパスを渡す（ファイル名→パス）
+    :return 1:処理件数, 2:処理段階ごとの所要時間
+    """
+    timings = {}
+    stats = new_stats()
 
-                        classes = []
+    with DbClient() as db:
 
-                        with tf.extractfile(members[name2]) as ef2:
+        # 登録されている権利（該当の法域のみ）
+        with measure(timings, 'keys'):
+            keys = load_registered_keys(db, law)
 
-                            for info2 in read_tsv(ef2):
+        import_law(lambda name: open(files[name], 'rb'), files, law, c, db, keys, stats, timings, {})
 
-                                if info2['law_cd'] == info['law_cd'] \
-                                    and info2['reg_num'] == info['reg_num']:
-                                    if 'desig_goods_or_desig_wrk_class' in info2:
-                                        classes.append(info2['desig_goods_or_desig_wrk_class'])
+    return stats, timings
 
-                            if len(classes) > 0:
-                                update['Classes'] = classes
-                                update['NumberOfClasses'] = len(classes)
+def extract_law_files(filepath, laws, directory):
+    """
+    アーカイブを1度だけ展開し、法域ごとに使うファイルをフォルダーに書き出す
+    :return 法域ごとのファイルのパス（法域→ファイル名→パス）
+    """
+    # 必要なファイルと、それを使う法域
+    wanted = {}
+    for law, c in laws:
+        for name in law_file_names(law, c):
+            wanted.setdefault(name, []).append(law)
 
-                    # 権利（エントリー）ごとに更新する
-                    for prop in props:
+    files = { law: {} for law, c in laws }
+    if len(wanted) < 1:
+        return files
 
-                        query = { '$set': {}, '$unset': {} }
+    # 先頭から順に読み、必要なファイルだけを書き出す
+    with tarfile.open(filepath, mode='r:gz') as tf:
+        for m in tf:
+            name = Path(m.name).name
+            if not m.isfile() or not name in wanted:
+                continue
+            dest = Path(directory) / name
+            with tf.extractfile(m) as ef, open(str(dest), 'wb') as f:
+                shutil.copyfileobj(ef, f)
+            for law in wanted[name]:
+                files[law][name] = str(dest)
 
-                        for key in update:
-                            if key in ('PaidYears', 'NextProcedureLimit',):
-                                query['$set'][key] = update[key]
+    return files
 
-                        # 納付済年分
-                        if 'PaidYears' in update:
-                            if not 'PaidYears' in prop or prop['PaidYears'] < update['PaidYears']:
-                                query['$set']['PaidYears'] = update['PaidYears']
+def is_completed(db, archive, law=None):
+    """
+    アーカイブ（law を指定した場合はその法域）のインポートが完了しているか否か
+    """
+    return db.ImportCheckpoints.count_documents({
+        'Archive': archive,
+        'Law': law,
+        'CompletedTime': {'$exists': True},
+    }) > 0
 
-                        # 次回手続期限
-                        if 'NextProcedureLimit' in update:
-                            if not 'NextProcedureLimit' in prop or prop['NextProcedureLimit'] < update['NextProcedureLimit']:
-                                query['$set']['NextProcedureLimit'] = update['NextProcedureLimit']
+def start_checkpoint(db, archive, law=None):
+    """
+    インポートの開始を記録する
+    """
+    db.ImportCheckpoints.update_one({'Archive': archive, 'Law': law}, {
+        '$set': {'StartedTime': datetime.now()},
+        '$unset': {'CompletedTime': '', 'Stats': ''},
+        '$inc': {'Attempts': 1},
+    }, upsert=True)
 
-                        # 照会日時等
-                        query['$set']['JpoInquiredTime'] = datetime.now()
-                        query['$set']['InquiredTime'] = query['$set']['JpoInquiredTime']
-                        query['$set']['ModifiedTime'] = query['$set']['JpoInquiredTime']
+def complete_checkpoint(db, archive, law, stats):
+    """
+    インポートの完了を記録する
+    """
+    db.ImportCheckpoints.update_one({'Archive': archive, 'Law': law}, {
+        '$set': {'CompletedTime': datetime.now(), 'Stats': stats},
+    })
 
-                        # 更新
-                        if len(query['$unset']) == 0:
-                            del query['$unset']
-                        db.Properties.update_one({'_id': prop['_id']}, query)
+def import_archive(filepath, db, pool):
+    """
+    1ファイルの法域ごとのインポートをプロセスプールで並行して行う
+    （完了済の法域はスキップする）
+    """
+    archive = Path(filepath).name
+
+    if is_completed(db, archive):
+        logger.info('%s is already imported.', archive)
+        return None
+
+    start_checkpoint(db, archive)
+
+    # 未完了の法域
+    laws = []
+    for law, c in LAWS:
+        if is_completed(db, archive, law):
+            logger.info('%s (%s) is already imported.', archive, law)
+            continue
+        laws.append((law, c))
+
+    # 展開は親プロセスで1度だけ行う
+    timings = {}
+    directory = tempfile.mkdtemp(prefix='%s.' % archive, dir=str(Path(filepath).parent))
+    try:
+        with measure(timings, 'extract'):
+            files = extract_law_files(filepath, laws, directory)
+
+        # 法域ごとに投入する
+        # ※法域が異なれば対象の権利は重ならないため、並行して更新してよい
+        futures = {}
+        for law, c in laws:
+            start_checkpoint(db, archive, law)
+            futures[pool.submit(import_law_file, files[law], law, c)] = law
+
+        # 法域ごとの完了を記録する
+        # ※失敗した法域があっても、完了した法域は記録してから例外を送出する
+        total = new_stats()
+        errors = []
+        for future in as_completed(futures):
+            law = futures[future]
+            try:
+                stats, law_timings = future.result()
+            except Exception as e:
+                logger.error('%s (%s) is failed.', archive, law)
+                logger.error(traceback.format_exc())
+                errors.append(e)
+                continue
+            complete_checkpoint(db, archive, law, stats)
+            for key in total:
+                total[key] += stats[key]
+            for key in law_timings:
+                timings['%s:%s' % (law, key)] = law_timings[key]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    complete_checkpoint(db, archive, None, total)
+    log_stats(archive, total, timings)
+    return total
+
+class LocalArchiveSource:
+    """
+    ローカルのアーカイブを一時フォルダーにコピーして渡す（試験用のダウンローダー）
+    """
 
-def bulk_import():
+    def __init__(self, directory, pattern='JPDRT_*.tar.gz', temp_dir='temp', delay=0.0):
+        """
+        コンストラクター
+        delay にはダウンロードの所要時間の代わりに待機する秒数を指定する
+        """
+        self.directory = directory
+        self.pattern = pattern
+        self.temp_dir = temp_dir
+        self.delay = delay
+
+    def __enter__(self):
+        os.makedirs(self.temp_dir, exist_ok=True)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+
+    def download(self):
+        """
+        アーカイブを日付順に取得する
+        """
+        for path in sorted(Path(self.directory).glob(self.pattern)):
+            if self.delay > 0:
+                time.sleep(self.delay)
+            dest = Path(self.temp_dir) / path.name
+            shutil.copyfile(str(path), str(dest))
+            yield path.name, None, str(dest)
+
+def bulk_import(source=None, workers=4):
     """
     一括でダウンロード・インポートを行う
+    ダウンロードは別スレッドで先行して行い、インポートと重ねる
+    （アーカイブは日付順にインポートし、法域ごとにプロセスプールで並行して処理する）
     """
-    with DbClient() as db:
-        with Browser('temp') as browser:
-            for _, _, filepath in browser.download():
+    if source is None:
+        from jpo_bulk_data import Browser
+        source = Browser('temp')
+
+    # ダウンロード済のファイル（先読みは2件まで）
+    downloaded = queue.Queue(maxsize=2)
+    errors = []
+
+    def download():
+        try:
+            with source as browser:
+                for _, _, filepath in browser.download():
+                    downloaded.put(filepath)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            errors.append(e)
+        finally:
+            downloaded.put(None)
+
+    # プロセスプールは spawn で起動し、ダウンロードのスレッドとデータベースの接続より前に作る
+    # ※fork すると、スレッドが持つロックや pymongo のソケット・監視スレッドが子プロセスに複製される
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+
+        thread = threading.Thread(target=download, daemon=True)
+        thread.start()
+
+        with DbClient() as db:
+            while True:
+                filepath = downloaded.get()
+                if filepath is None:
+                    break
                 try:
                     # インポート
-                    extract_and_import(filepath, db)
+                    import_archive(filepath, db, pool)
                 finally:
                     # ファイルの削除
                     os.remove(filepath)
 
+    if len(errors) > 0:
+        raise errors[0]
+
 def single_import(filepath):
     """
     特定のファイルをインポートする
@@ -245,4 +608,18 @@ def single_import(filepath):
         extract_and_import(filepath, db)
 
 if __name__ == '__main__':
-    single_import('sample_data/JPDRT_20200619.tar.gz')
+
+    parser = argparse.ArgumentParser(description='特許庁の更新データのインポート')
+    parser.add_argument('files', nargs='*', help='インポートするファイル')
+    parser.add_argument('--bulk', action='store_true', help='ダウンロードしてインポートする')
+    parser.add_argument('--local', metavar='DIR', help='ダウンロードの代わりにフォルダー内のアーカイブをインポートする')
+    parser.add_argument('--workers', type=int, default=4, help='並行して処理するプロセスの数')
+    args = parser.parse_args()
+
+    if args.bulk:
+        bulk_import(workers=args.workers)
+    elif not args.local is None:
+        bulk_import(LocalArchiveSource(args.local), workers=args.workers)
+    else:
+        for filepath in (args.files if len(args.files) > 0 else ['sample_data/JPDRT_20200619.tar.gz']):
+            single_import(filepath)
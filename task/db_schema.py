@@ -0,0 +1 @@
+../web/db_schema.py
\ No newline at end of file
@@ -10,9 +10,11 @@ import re
 import time
 import json
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
 
 import browser
 import common_util
+import jpp_scheduler
 
 # ロガーの取得
 if __name__ == '__main__':
@@ -21,12 +23,11 @@ _logger = logging.getLogger(__name__)
 
 # J-PlatPat の URL
 _jpp_url = 'https://www.j-platpat.inpit.go.jp'
+# メンテナンス中にリダイレクトされるページ（ホームのURLによらずパスで判定する）
+_mainte_path = '/cache/support/mainte_sorry.html'
 # Selenium のタイムアウト値（秒）
 _timeout = 3
 
-# 実行制限
-_timestamp = datetime(1900, 1, 1)
-
 # 権利情報が見つからない場合に発生する例外
 class NotFoundException(Exception):
     def __init__(self, law, number_kind, number):
@@ -65,25 +66,25 @@ logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
 class JppBrowser(browser.Browser):
 
     # 初期化
-    def __init__(self, headless=True):
+    def __init__(self, headless=True, home_url=None):
         super().__init__(headless)
-        self.open_url(_jpp_url)
+        self.open_url(home_url if home_url else _jpp_url)
         self.set_implicitly_wait(_timeout)
 
-    def get_status(self, law, number, number_type='registration'):
+    def is_under_maintenance(self):
+        """
+        メンテナンスページにリダイレクトされているか否か
+        """
+        return urlparse(self.current_url).path == _mainte_path
+
+    def get_status(self, law, number, number_type='registration', priority=jpp_scheduler.PRIORITY_BATCH):
         """
         経過情報の検索を実行し、その結果を取得する
         """
         _logger.info('start inquiring ... law=%s, number=%s, number_type=%s', law, number, number_type)
 
-        # 実行制限の確認(65秒以上の間隔)
-        global _timestamp
-        now = datetime.now()
-        if now <= _timestamp:
-            d_time = (_timestamp - now)
-            _logger.debug('wait for specified interval (%s).', d_time)
-            time.sleep(d_time.total_seconds() + 1)
-        _timestamp = now + timedelta(seconds=65)
+        # 実行制限の確認（プロセスをまたいで間隔を空ける）
+        jpp_scheduler.acquire(priority)
 
         if not number:
             raise ValueError('number is missing.')
@@ -92,7 +93,7 @@ class JppBrowser(browser.Browser):
         self.back_to_home()
 
         # メンテナンスページにリダイレクトされていたら例外を起こす
-        if self.current_url == 'https://www.j-platpat.inpit.go.jp/cache/support/mainte_sorry.html':
+        if self.is_under_maintenance():
             raise browser.OutOfServiceException('Now, J-PlatPat is under maintenance.')
 
         # 番号表記の正規化
@@ -0,0 +1,188 @@
+"""
+J-PlatPat の照会結果のキャッシュ
+（同じ権利の照会が1日に何度も行われるため、取得した経過情報と整形結果を一定時間保持する）
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from database import DbClient
+from local_config import Config
+
+# ロガーの取得
+_logger = logging.getLogger(__name__)
+
+# 既定の保持期間（秒）
+DEFAULT_TTL = 86400
+
+# 集計のキー（Misc コレクション）
+_stats_key = 'JppCache'
+
+class JppCache:
+    """
+    J-PlatPat の照会結果のキャッシュ
+    （JppCache コレクションに、法域・番号・番号の種類ごとに1件保持する）
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, enabled=True):
+        """
+        コンストラクター
+        ttl: 保持期間（秒、期限切れのエントリーは TTL インデックスで削除される）
+        """
+        self.ttl = ttl
+        self.enabled = enabled
+        self.__lock = threading.Lock()
+        self.__stats = {'Hit': 0, 'Miss': 0, 'Stored': 0, 'Invalidated': 0}
+
+    def __count(self, name, n=1):
+        """
+        ヒット・ミスなどを数える（プロセス内とデータベースの両方）
+        """
+        with self.__lock:
+            self.__stats[name] += n
+        try:
+            with DbClient() as db:
+                db.Misc.update_one({'Key': _stats_key}, {'$inc': {name: n}}, upsert=True)
+        except Exception:
+            _logger.exception('cannot count jpp cache %s.', name)
+
+    def get(self, law, number, number_type, max_age=None):
+        """
+        キャッシュされた照会結果を取得する
+        max_age: 許容する経過秒数（省略時は保持期間内のものすべて）
+        :return キャッシュのエントリー（無い場合は None）
+        """
+        if not self.enabled:
+            return None
+
+        now = datetime.utcnow()
+        query = {
+            'Law': law,
+            'Number': number,
+            'NumberType': number_type,
+            'ExpireAt': {'$gt': now},
+        }
+        if not max_age is None:
+            query['FetchedTime'] = {'$gte': now - timedelta(seconds=max_age)}
+
+        with DbClient() as db:
+            entry = db.JppCache.find_one(query)
+
+        self.__count('Miss' if entry is None else 'Hit')
+        return entry
+
+    def put(self, law, number, number_type, status, result=None, lang_name=None):
+        """
+        照会結果を保存する
+        status: J-PlatPat から取得した経過情報
+        result: 整形した照会結果（lang_name の言語のもの）
+        """
+        if not self.enabled:
+            return
+
+        now = datetime.utcnow()
+        update = {
+            '$set': {
+                'Status': status,
+                'FetchedTime': now,
+                'ExpireAt': now + timedelta(seconds=self.ttl),
+            },
+            # 再取得した場合は、以前の整形結果を破棄する
+            '$unset': {'Results': ''},
+        }
+        if not result is None and not lang_name is None:
+            update['$unset'] = {}
+            update['$set']['Results'] = {lang_name: result}
+        if len(update['$unset']) == 0:
+            del update['$unset']
+
+        try:
+            with DbClient() as db:
+                db.JppCache.update_one({'Law': law, 'Number': number, 'NumberType': number_type}, update, upsert=True)
+            self.__count('Stored')
+        except Exception:
+            # キャッシュできなくても照会自体は成功とする
+            _logger.exception('cannot store jpp cache (%s, %s, %s).', law, number, number_type)
+
+    def add_result(self, entry, result, lang_name):
+        """
+        キャッシュのエントリーに別の言語の整形結果を追加する
+        """
+        if not self.enabled:
+            return
+        try:
+            with DbClient() as db:
+                db.JppCache.update_one({'_id': entry['_id']}, {'$set': {'Results.%s' % lang_name: result}})
+        except Exception:
+            _logger.exception('cannot store jpp cache result (%s).', entry['_id'])
+
+    def invalidate(self, law, numbers, number_type='registration'):
+        """
+        指定した権利のエントリーを破棄する
+        :return 破棄した件数
+        """
+        numbers = list(numbers)
+        if len(numbers) < 1:
+            return 0
+        with DbClient() as db:
+            res = db.JppCache.delete_many({'Law': law, 'Number': {'$in': numbers}, 'NumberType': number_type})
+        if res.deleted_count > 0:
+            self.__count('Invalidated', res.deleted_count)
+        return res.deleted_count
+
+    def stats(self):
+        """
+        ヒット・ミスの件数とエントリー数を取得する
+        """
+        with self.__lock:
+            res = {'Process': dict(self.__stats)}
+
+        with DbClient() as db:
+            total = db.Misc.find_one({'Key': _stats_key}, {'_id': 0, 'Key': 0})
+            res['Total'] = total if not total is None else {}
+            res['Entries'] = db.JppCache.count_documents({'ExpireAt': {'$gt': datetime.utcnow()}})
+
+        # ヒット率
+        for x in (res['Process'], res['Total'],):
+            n = x.get('Hit', 0) + x.get('Miss', 0)
+            if n > 0:
+                x['HitRatio'] = x.get('Hit', 0) / n
+
+        return res
+
+# プロセス内で共有するキャッシュ
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    プロセス内で共有するキャッシュを取得する（設定は [jpp] から読み込む）
+    """
+    global _cache
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = Config()
+                conf = config['jpp'] if config.has_section('jpp') else {}
+                options = {}
+                if conf.get('cache_ttl', ''):
+                    options['ttl'] = int(conf['cache_ttl'])
+                    # 0 以下ならキャッシュしない
+                    if options['ttl'] <= 0:
+                        options['enabled'] = False
+                _cache = JppCache(**options)
+
+    return _cache
+
+def invalidate(law, numbers, number_type='registration'):
+    """
+    共有のキャッシュから指定した権利のエントリーを破棄する
+    """
+    return get_cache().invalidate(law, numbers, number_type)
+
+if __name__ == '__main__':
+    # キャッシュの状態を表示する
+    import json
+    print(json.dumps(get_cache().stats(), indent=2, ensure_ascii=False, default=str))
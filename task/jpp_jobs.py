@@ -0,0 +1 @@
+../web/jpp_jobs.py
\ No newline at end of file
@@ -0,0 +1,277 @@
+"""
+J-PlatPat のブラウザーのプール
+（起動済のブラウザーを使い回し、照会ごとの起動・終了を省く）
+"""
+
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from selenium.common.exceptions import WebDriverException
+
+import jpp_browser
+from local_config import Config
+
+# ロガーの取得
+_logger = logging.getLogger(__name__)
+
+class PooledSession:
+    """
+    プールで管理するブラウザー
+    """
+
+    def __init__(self, browser):
+        """
+        コンストラクター
+        """
+        self.browser = browser
+        self.created_time = time.time()
+        self.last_used_time = self.created_time
+        self.queries = 0
+
+class JppBrowserPool:
+    """
+    J-PlatPat のブラウザーのプール
+    """
+
+    def __init__(self, size=1, max_queries=50, idle_timeout=600, home_url=None, headless=True, factory=None):
+        """
+        コンストラクター
+        size: 同時に使うブラウザーの数
+        max_queries: ブラウザーを作り直すまでの照会回数
+        idle_timeout: 使われていないブラウザーを作り直すまでの秒数
+        home_url: ホームのURL（ローカルの代替ページで試験する場合に指定する）
+        factory: ブラウザーを生成する関数（省略時は JppBrowser）
+        """
+        self.size = size
+        self.max_queries = max_queries
+        self.idle_timeout = idle_timeout
+        self.home_url = home_url
+        self.headless = headless
+        self.__factory = factory
+        self.__idle = []
+        self.__in_use = 0
+        self.__closed = False
+        self.__cond = threading.Condition()
+        self.__stats = {'Created': 0, 'Recycled': 0, 'Reused': 0, 'Unhealthy': 0}
+
+    def __create(self):
+        """
+        ブラウザーを起動する
+        """
+        if not self.__factory is None:
+            b = self.__factory()
+        else:
+            b = jpp_browser.JppBrowser(headless=self.headless, home_url=self.home_url)
+        with self.__cond:
+            self.__stats['Created'] += 1
+        _logger.info('jpp browser is started.')
+        return PooledSession(b)
+
+    def __discard(self, session):
+        """
+        ブラウザーを終了する
+        """
+        try:
+            session.browser.close()
+        except Exception:
+            _logger.exception('cannot close jpp browser.')
+
+    def is_healthy(self, session):
+        """
+        ブラウザーが使える状態か否かを確認する
+        （残っている子ウィンドウは閉じる）
+        """
+        # 長く使われていない
+        if self.idle_timeout > 0 and time.time() - session.last_used_time > self.idle_timeout:
+            return False
+        try:
+            # ウィンドウが失われていないか
+            if session.browser.num_of_windows < 1:
+                return False
+            if session.browser.num_of_windows > 1:
+                session.browser.close_sub_windows()
+            # メンテナンスページにリダイレクトされていないか
+            if session.browser.is_under_maintenance():
+                return False
+        except WebDriverException:
+            return False
+        return True
+
+    def acquire(self, timeout=None):
+        """
+        ブラウザーを借りる（すべて使用中の場合は返却を待つ）
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            session = None
+            with self.__cond:
+                if self.__closed:
+                    raise RuntimeError('the pool is closed.')
+                if len(self.__idle) > 0:
+                    session = self.__idle.pop()
+                    self.__in_use += 1
+                elif self.__in_use < self.size:
+                    self.__in_use += 1
+                else:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if not remaining is None and remaining <= 0:
+                        raise TimeoutError('no jpp browser is available.')
+                    self.__cond.wait(remaining)
+                    continue
+
+            # 使用中の枠を確保したので、ロックの外で起動・確認する
+            try:
+                if session is None:
+                    return self.__create()
+                if self.is_healthy(session):
+                    with self.__cond:
+                        self.__stats['Reused'] += 1
+                    return session
+                with self.__cond:
+                    self.__stats['Unhealthy'] += 1
+                _logger.info('jpp browser is not healthy. recycle it.')
+                self.__discard(session)
+                return self.__create()
+            except:
+                self.__release_slot()
+                raise
+
+    def __release_slot(self):
+        """
+        使用中の枠を返す
+        """
+        with self.__cond:
+            self.__in_use -= 1
+            self.__cond.notify()
+
+    def release(self, session, broken=False):
+        """
+        ブラウザーを返す（照会回数の上限に達したか、エラーが起きた場合は終了する）
+        """
+        session.queries += 1
+        session.last_used_time = time.time()
+
+        if broken or self.__closed or (self.max_queries > 0 and session.queries >= self.max_queries):
+            with self.__cond:
+                self.__stats['Recycled'] += 1
+            self.__discard(session)
+            self.__release_slot()
+            return
+
+        with self.__cond:
+            self.__idle.append(session)
+            self.__in_use -= 1
+            self.__cond.notify()
+
+    @contextmanager
+    def session(self, timeout=None):
+        """
+        with ブロックの間ブラウザーを借りる
+        （ブロック内で例外が起きた場合、そのブラウザーは作り直す）
+        """
+        session = self.acquire(timeout)
+        try:
+            yield session.browser
+        except:
+            self.release(session, broken=True)
+            raise
+        self.release(session)
+
+    def stats(self):
+        """
+        プールの状態を取得する
+        """
+        with self.__cond:
+            res = dict(self.__stats)
+            res['Idle'] = len(self.__idle)
+            res['InUse'] = self.__in_use
+        return res
+
+    def close(self):
+        """
+        すべてのブラウザーを終了する（使用中のものは返却時に終了する）
+        """
+        with self.__cond:
+            self.__closed = True
+            idle = self.__idle
+            self.__idle = []
+            self.__cond.notify_all()
+        for session in idle:
+            self.__discard(session)
+
+# プロセス内で共有するプール
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    プロセス内で共有するプールを取得する（設定は [jpp] から読み込む）
+    """
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                config = Config()
+                conf = config['jpp'] if config.has_section('jpp') else {}
+                options = {}
+                if conf.get('pool_size', ''):
+                    options['size'] = int(conf['pool_size'])
+                if conf.get('max_queries', ''):
+                    options['max_queries'] = int(conf['max_queries'])
+                if conf.get('idle_timeout', ''):
+                    options['idle_timeout'] = int(conf['idle_timeout'])
+                if conf.get('home_url', ''):
+                    options['home_url'] = conf['home_url']
+                _pool = JppBrowserPool(**options)
+                atexit.register(_pool.close)
+
+    return _pool
+
+if __name__ == '__main__':
+    # ローカルの代替ページでプールの動作を確認する（Chrome が必要）
+    import sys
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    logging.basicConfig(level=logging.DEBUG)
+    logging.getLogger('selenium.webdriver.remote.remote_connection').setLevel(logging.WARNING)
+    logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
+
+    # メンテナンス中を再現する場合は引数に mainte を指定する
+    mainte = len(sys.argv) > 1 and sys.argv[1] == 'mainte'
+
+    class StandIn(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if mainte and self.path != '/cache/support/mainte_sorry.html':
+                self.send_response(302)
+                self.send_header('Location', '/cache/support/mainte_sorry.html')
+                self.end_headers()
+                return
+            body = '<html><body><div id="cfc001_globalNav_item_0">特許・実用新案</div></body></html>'.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/' % server.server_port
+
+    pool = JppBrowserPool(size=1, max_queries=3, home_url=url)
+    try:
+        for i in range(5):
+            started = time.time()
+            with pool.session() as b:
+                b.back_to_home()
+                print(i, b.current_url, 'maintenance' if b.is_under_maintenance() else 'ok', '%.2fs' % (time.time() - started))
+        print(pool.stats())
+    finally:
+        pool.close()
+        server.shutdown()
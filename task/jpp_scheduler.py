@@ -0,0 +1,218 @@
+"""
+J-PlatPat の照会の間隔を、プロセスをまたいで制御する
+（MongoDB 上のトークンバケットと優先度付きの待ち行列）
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+from database import DbClient
+from local_config import Config
+
+# ロガーの取得
+_logger = logging.getLogger(__name__)
+
+# 優先度（小さいほど先に処理する）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# 優先度の名称
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'Interactive',
+    PRIORITY_BATCH: 'Batch',
+}
+
+# バケットと待ち時間の集計のキー（Misc コレクション）
+_bucket_key = 'JppBucket'
+_wait_key = 'JppWait'
+
+class JppScheduler:
+    """
+    J-PlatPat の照会の実行枠を割り当てる
+    interval 秒ごとに1回分の枠が補充され、最大 burst 回分まで貯まる
+    （既定値は従来の「65秒以上の間隔」と同じ）
+    """
+
+    def __init__(self, interval=65, burst=1, poll=1.0, ticket_ttl=30):
+        """
+        コンストラクター
+        poll: 待機中の確認間隔（秒）
+        ticket_ttl: 待機中のプロセスが応答しなくなった場合に、順番を破棄するまでの秒数
+        """
+        self.interval = interval
+        self.burst = burst
+        self.poll = poll
+        self.ticket_ttl = ticket_ttl
+
+    def __ensure_bucket(self, db, now):
+        """
+        バケットが無ければ作成する
+        """
+        try:
+            db.Misc.update_one({'Key': _bucket_key}, {'$setOnInsert': {
+                'Tokens': float(self.burst),
+                'UpdatedTime': now,
+                'Version': 0,
+            }}, upsert=True)
+        except DuplicateKeyError:
+            pass
+
+    def __take_token(self, db, now):
+        """
+        バケットから1回分の枠を取り出す
+        :return 取り出せた場合は 0、取り出せない場合は補充されるまでの秒数
+        """
+        bucket = db.Misc.find_one({'Key': _bucket_key})
+        if bucket is None:
+            self.__ensure_bucket(db, now)
+            return self.poll
+
+        # 経過時間に応じて補充する
+        elapsed = max(0.0, (now - bucket['UpdatedTime']).total_seconds())
+        tokens = min(float(self.burst), bucket['Tokens'] + elapsed / self.interval)
+        if tokens < 1.0:
+            return (1.0 - tokens) * self.interval
+
+        # 他のプロセスと競合した場合は取り出せない（次の確認で再試行する）
+        res = db.Misc.update_one({'Key': _bucket_key, 'Version': bucket['Version']}, {
+            '$set': {'Tokens': tokens - 1.0, 'UpdatedTime': now},
+            '$inc': {'Version': 1},
+        })
+        return 0 if res.modified_count > 0 else self.poll
+
+    def acquire(self, priority=PRIORITY_BATCH, timeout=None):
+        """
+        照会の実行枠を得るまで待機する
+        優先度の高い（値の小さい）待機者がいる間は、枠が空いても順番を譲る
+        :return 待機した秒数
+        """
+        started = datetime.utcnow()
+        deadline = None if timeout is None else started + timedelta(seconds=timeout)
+
+        with DbClient() as db:
+
+            # 待ち行列に並ぶ
+            ticket = db.JppTickets.insert_one({
+                'Priority': priority,
+                'RequestedTime': started,
+                'ExpireAt': started + timedelta(seconds=self.ticket_ttl),
+                'Host': socket.gethostname(),
+                'Pid': os.getpid(),
+            }).inserted_id
+
+            try:
+                while True:
+                    now = datetime.utcnow()
+                    if not deadline is None and now > deadline:
+                        raise TimeoutError('J-PlatPat query slot is not available.')
+
+                    # 待機中であることを示す
+                    db.JppTickets.update_one({'_id': ticket}, {'$set': {'ExpireAt': now + timedelta(seconds=self.ticket_ttl)}})
+
+                    # 先頭でなければ待つ
+                    head = list(db.JppTickets.find(
+                        {'ExpireAt': {'$gt': now}}, {'_id': 1}
+                    ).sort([('Priority', 1), ('RequestedTime', 1), ('_id', 1)]).limit(1))
+                    if len(head) > 0 and head[0]['_id'] != ticket:
+                        time.sleep(self.poll)
+                        continue
+
+                    # 枠を取り出す
+                    wait = self.__take_token(db, now)
+                    if wait <= 0:
+                        break
+                    time.sleep(min(wait, self.poll))
+
+            finally:
+                db.JppTickets.delete_one({'_id': ticket})
+
+            # 待ち時間を記録する
+            waited = (datetime.utcnow() - started).total_seconds()
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            db.Misc.update_one({'Key': _wait_key}, {
+                '$inc': {'%s.Count' % name: 1, '%s.TotalSeconds' % name: waited},
+                '$max': {'%s.MaxSeconds' % name: waited},
+                '$set': {'%s.LastSeconds' % name: waited, '%s.LastTime' % name: datetime.utcnow()},
+            }, upsert=True)
+
+        if waited >= 1:
+            _logger.debug('waited %.1f seconds for J-PlatPat (%s).', waited, name)
+        return waited
+
+    def stats(self):
+        """
+        待ち行列の長さ、最も長く待っている秒数、残りの枠、待ち時間の集計を取得する
+        """
+        now = datetime.utcnow()
+        res = {'Depth': {}, 'OldestWaitSeconds': {}, 'Waits': {}, 'Tokens': None}
+
+        with DbClient() as db:
+
+            # 優先度ごとの待機数
+            for rec in db.JppTickets.aggregate([
+                {'$match': {'ExpireAt': {'$gt': now}}},
+                {'$group': {'_id': '$Priority', 'Count': {'$sum': 1}, 'Oldest': {'$min': '$RequestedTime'}}},
+            ]):
+                name = PRIORITY_NAMES.get(rec['_id'], str(rec['_id']))
+                res['Depth'][name] = rec['Count']
+                res['OldestWaitSeconds'][name] = (now - rec['Oldest']).total_seconds()
+
+            # 残りの枠
+            bucket = db.Misc.find_one({'Key': _bucket_key})
+            if not bucket is None:
+                elapsed = max(0.0, (now - bucket['UpdatedTime']).total_seconds())
+                res['Tokens'] = min(float(self.burst), bucket['Tokens'] + elapsed / self.interval)
+
+            # 待ち時間の集計
+            waits = db.Misc.find_one({'Key': _wait_key})
+            if not waits is None:
+                for name in waits:
+                    if name in ('_id', 'Key',):
+                        continue
+                    x = dict(waits[name])
+                    if x.get('Count', 0) > 0:
+                        x['AverageSeconds'] = x['TotalSeconds'] / x['Count']
+                    res['Waits'][name] = x
+
+        return res
+
+# プロセス内で共有するスケジューラー
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """
+    プロセス内で共有するスケジューラーを取得する（設定は [jpp] から読み込む）
+    """
+    global _scheduler
+
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                config = Config()
+                conf = config['jpp'] if config.has_section('jpp') else {}
+                options = {}
+                if conf.get('interval', ''):
+                    options['interval'] = float(conf['interval'])
+                if conf.get('burst', ''):
+                    options['burst'] = int(conf['burst'])
+                _scheduler = JppScheduler(**options)
+
+    return _scheduler
+
+def acquire(priority=PRIORITY_BATCH, timeout=None):
+    """
+    共有のスケジューラーで照会の実行枠を得る
+    """
+    return get_scheduler().acquire(priority, timeout)
+
+if __name__ == '__main__':
+    # 待ち行列の状態を表示する
+    import json
+    print(json.dumps(get_scheduler().stats(), indent=2, ensure_ascii=False, default=str))
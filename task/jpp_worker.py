@@ -0,0 +1,90 @@
+"""
+J-PlatPat の照会ジョブを実行するワーカー
+（画面から登録された照会ジョブを、プールのブラウザーで順に実行する）
+"""
+
+import logging
+import argparse
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+from database import DbClient
+import jpp_jobs
+import jpp_pool
+import language
+from local_config import Config
+
+conf = Config()
+log_file = None
+
+if conf['log']['directory']:
+    log_file = Path(conf['log']['directory']) / 'jpp_worker.log'
+
+logging.basicConfig(
+    filename=str(log_file) if log_file else None,
+    level=logging.INFO if log_file else logging.DEBUG,
+    format='%(asctime)s:%(process)d:%(thread)d:%(name)s:%(levelname)s:%(message)s'
+)
+logger = logging.getLogger('jpp_worker')
+
+def work(name, poll, once, stop):
+    """
+    ジョブを取り出して実行する
+    once: 待機中のジョブが無くなったら終了する
+    """
+    while not stop.is_set():
+
+        with DbClient() as db:
+
+            # ジョブを取り出す
+            job = jpp_jobs.claim_job(db, name)
+
+            if job is None:
+                if once:
+                    break
+                stop.wait(poll)
+                continue
+
+            # 照会して結果を保存する
+            started = time.time()
+            logger.info('%s: job %s (%s/%s/%s) is started.', name, job['_id'], job['Key']['Law'], job['Key']['NumberType'], job['Key']['Number'])
+            res = jpp_jobs.run_job(db, job, language.get_dictionary(job.get('Lang', 'ja')))
+            logger.info('%s: job %s is finished in %.1f s. (%s)', name, job['_id'], time.time() - started, 'succeeded' if res.get('Result', False) else 'failed')
+
+def main(threads, poll, once):
+    """
+    ワーカーを起動する
+    """
+    stop = threading.Event()
+    prefix = '%s:%d' % (socket.gethostname(), os.getpid())
+
+    workers = []
+    for i in range(threads):
+        t = threading.Thread(target=work, args=('%s:%d' % (prefix, i), poll, once, stop), daemon=True)
+        t.start()
+        workers.append(t)
+
+    try:
+        for t in workers:
+            while t.is_alive():
+                t.join(1)
+    except KeyboardInterrupt:
+        logger.info('stopping workers.')
+        stop.set()
+        for t in workers:
+            t.join()
+    finally:
+        jpp_pool.get_pool().close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='J-PlatPat の照会ジョブを実行する')
+    parser.add_argument('--threads', type=int, default=None, help='同時に実行するジョブの数（省略時はブラウザーのプールの大きさ）')
+    parser.add_argument('--poll', type=float, default=1.0, help='ジョブが無い場合の確認間隔（秒）')
+    parser.add_argument('--once', action='store_true', help='待機中のジョブが無くなったら終了する')
+    args = parser.parse_args()
+
+    main(args.threads if not args.threads is None else jpp_pool.get_pool().size, args.poll, args.once)
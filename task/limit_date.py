@@ -0,0 +1 @@
+../web/limit_date.py
\ No newline at end of file
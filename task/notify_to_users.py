@@ -60,23 +60,37 @@ def preamble(user, lang):
 
         return buff.getvalue().strip()
 
-def about_next_procedure(db, user, lang):
+def get_limit_dates(today):
     """
-    次回依頼期限についての通知を行う
+    通知条件日（get_checkpoints）が当日となる次回期限の一覧を取得する
+    （月末の丸めにより、同じ通知条件日になる期限が複数ある）
+    """
+    dates = []
+    d = today - timedelta(days=1)
+    last = after_month(today, 6) + timedelta(days=7)
+    while d <= last:
+        if today in get_checkpoints(d):
+            dates.append(d)
+        d += timedelta(days=1)
+    return dates
+
+def find_candidates(db, today, user_id=None):
+    """
+    通知条件日が当日の権利を抽出し、ユーザーごとにまとめる
+    （user_id を指定した場合はそのユーザーの権利のみ）
+    :return ユーザーのID→権利のリスト
     """
-    # 通知基準日
-    today = common_util.get_today()
-
     # 次回期限が6ヶ月以内のものを抽出する
     month_six = after_month(today, 6)
     month_three = after_month(today, 3)
 
-    # 対象権利の抽出
-    props = db.Properties.find({ '$and':[
-            {'User': user['_id']},
+    # 対象権利の抽出（通知条件日が当日となる期限のみ）
+    match = { '$and':[
+            {'User': {'$exists': True} if user_id is None else user_id},
             {'Country': {'$in': ['JP',]}},
             {'Ignored': {'$exists': False}},
             {'Abandoned': {'$exists': False}},
+            {'NextProcedureLimit': {'$in': get_limit_dates(today)}},
             {'$or':[
                 {
                     'Law': 'Trademark',
@@ -96,33 +110,39 @@ def about_next_procedure(db, user, lang):
                 {'MailPendingDate': {'$exists': False}},
                 {'MailPendingDate': {'$lte': today}},
             ]},
-    ]})
+    ]}
+
+    # ユーザーごとにまとめる
+    candidates = {}
+    for rec in db.Properties.aggregate([
+        {'$match': match},
+        {'$group': {'_id': '$User', 'Properties': {'$push': '$$ROOT'}}},
+    ]):
+        candidates[rec['_id']] = rec['Properties']
+
+    return candidates
+
+def about_next_procedure(db, user, lang, props=None):
+    """
+    次回依頼期限についての通知メールを生成する
+    props には通知条件日が当日の権利（find_candidates の結果）を渡す（省略時は抽出する）
+    :return (権利, メール, 通知日の記録) のリスト（送信は send_notifications でまとめて行う）
+    """
+    # 通知基準日
+    today = common_util.get_today()
+
+    # 対象権利の抽出
+    if props is None:
+        props = find_candidates(db, today, user['_id']).get(user['_id'], [])
 
-    # 通知条件日当日のみ対象とする
-    props = list(props)
-    props = [x for x in props if today in get_checkpoints(x['NextProcedureLimit'])]
+    # 依頼の状況を取得
+    states = db.get_request_states([x['_id'] for x in props], dict([(x['_id'], x) for x in props]))
 
     def check_active_request(prop_id):
         """
         依頼済み判定
         """
-        req_cnt = db.Requests.count_documents({'$and':[
-            {'Properties': {'$elemMatch': {
-                'Property': prop_id,
-                '$or': [
-                    {'CompletedTime': {'$exists': False},},
-                    {'CompletedTime': {'$gt': today - timedelta(days=183)},},
-                ],
-                'CanceledTime': {'$exists': False},
-            }}},
-            {'Ignored': {'$exists': False}},
-            {'$or': [
-                {'CompletedTime': {'$exists': False},},
-                {'CompletedTime': {'$gt': today - timedelta(days=183)},},
-            ]},
-            {'CanceledTime': {'$exists': False}},
-        ]})
-        if req_cnt > 0:
+        if states[prop_id]['Recent']:
             logger.info('Property[%s] has active request.', prop_id)
             return True
         else:
@@ -133,11 +153,11 @@ def about_next_procedure(db, user, lang):
     
     # 通知対象がなければ終了
     if len(props) == 0:
-        return
+        return []
 
     # 通知対象がなければ終了
     if len(props) == 0:
-        return
+        return []
 
     def refer_to_db(prop):
         """
@@ -183,10 +203,10 @@ def about_next_procedure(db, user, lang):
 
     # 通知対象がなければ終了
     if len(props) == 0:
-        return
+        return []
 
     # 対象の再取得（料金計算等を含む）
-    props = [db.get_prop_info(x['_id'], lang, date_to_str=False) for x in props]
+    props = db.get_prop_infos([x['_id'] for x in props], lang, date_to_str=False)
 
     # ユーザー名の付与
     def set_user_name(prop):
@@ -226,6 +246,12 @@ def about_next_procedure(db, user, lang):
     # 通貨情報の取得
     currencies = common_util.get_currencies(db)
 
+    # ユーザーのメールアドレス
+    to_addr, cc_addr, bcc_addr = db.get_mail_addresses(user['_id'])
+
+    # 送信するメール
+    outgoing = []
+
     # 次回通知日（通知抑制日）の計算
     for prop in props:
 
@@ -421,16 +447,14 @@ def about_next_procedure(db, user, lang):
             # メールのフッター
             body.write(lang.mail_footer())
 
-            # ユーザー向けメールの送信
-            to_addr, cc_addr, bcc_addr = db.get_mail_addresses(user['_id'])
-
-            mail.send_mail(
-                subject,
-                body.getvalue(),
-                to=to_addr, cc=cc_addr, bcc=bcc_addr,
-            )
+            # ユーザー向けメールの生成（送信はまとめて行う）
+            message = {
+                'subject': subject,
+                'body': body.getvalue(),
+                'to': to_addr, 'cc': cc_addr, 'bcc': bcc_addr,
+            }
 
-            # 通知日の記録
+            # 通知日の記録（送信できた場合に記録する）
             q = {'$set': {
                 'NotifiedDate': today,
                 'NotifiedDateTime': datetime.now(),
@@ -444,7 +468,25 @@ def about_next_procedure(db, user, lang):
                 q['$set']['MailPendingDate'] = prop['MailPendingDate']
             else:
                 q['$unset'] = {'MailPendingDate': ''}
-            db.Properties.update_one({'_id': ObjectId(prop['_id'])}, q)
+            outgoing.append((prop, message, q))
+
+    return outgoing
+
+def send_notifications(db, outgoing):
+    """
+    通知メールをまとめて送信し、送信できた権利の通知日を記録する
+    outgoing: about_next_procedure の結果（全ユーザー分）
+    :return 送信できた件数
+    """
+    sent = 0
+    results = mail.send_many([x[1] for x in outgoing])
+    for (prop, message, q), res in zip(outgoing, results):
+        if not res['Result']:
+            logger.error('Property[%s] cannot be notified. (%s)', prop['_id'], res.get('Message', ''))
+            continue
+        db.Properties.update_one({'_id': ObjectId(prop['_id'])}, q)
+        sent += 1
+    return sent
 
 def diff_months_or_days(d1, d2):
     """
@@ -469,9 +511,17 @@ def diff_months_or_days(d1, d2):
 
 def notify_all(db):
     """
-    全ユーザーに対して必要な通知を行う
+    通知対象の権利があるユーザーに対して必要な通知を行う
     """
-    for user in db.Users.find({'Ignored': {'$exists': False}}):
+    # 通知条件日が当日の権利をユーザーごとに抽出する
+    candidates = find_candidates(db, common_util.get_today())
+    logger.info('%d properties of %d users are candidates.', sum([len(x) for x in candidates.values()]), len(candidates))
+
+    # 送信するメール（全ユーザー分）
+    outgoing = []
+
+    # 対象の権利があるユーザーのみ
+    for user in db.Users.find({'_id': {'$in': list(candidates.keys())}, 'Ignored': {'$exists': False}}):
 
         # 言語設定
         lang_code = 'ja'
@@ -480,7 +530,11 @@ def notify_all(db):
         lang = language.get_dictionary(lang_code)
 
         # 次回手続期限の警告
-        about_next_procedure(db, user, lang)
+        outgoing.extend(about_next_procedure(db, user, lang, candidates[user['_id']]))
+
+    # まとめて送信する
+    sent = send_notifications(db, outgoing)
+    logger.info('%d of %d notifications are sent.', sent, len(outgoing))
 
 def after_month(basis, months):
     """
@@ -0,0 +1 @@
+../web/outbox.py
\ No newline at end of file
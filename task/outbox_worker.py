@@ -0,0 +1,90 @@
+"""
+送信待ちのメールを送信するワーカー
+（画面の処理で Outbox に登録されたメールを、まとめて送信する）
+"""
+
+import logging
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+
+from database import DbClient
+import db_schema
+import mail
+import outbox
+from local_config import Config
+
+conf = Config()
+log_file = None
+
+if conf['log']['directory']:
+    log_file = Path(conf['log']['directory']) / 'outbox_worker.log'
+
+logging.basicConfig(
+    filename=str(log_file) if log_file else None,
+    level=logging.INFO if log_file else logging.DEBUG,
+    format='%(asctime)s:%(process)d:%(thread)d:%(name)s:%(levelname)s:%(message)s'
+)
+logger = logging.getLogger('outbox_worker')
+
+def main(batch_size, max_attempts, poll, once):
+    """
+    送信待ちのメールを送信し続ける
+    once: 送信する時刻になったメールが無くなったら終了する
+    """
+    name = '%s:%d' % (socket.gethostname(), os.getpid())
+
+    # 取り出し・保持期間の削除に使うインデックスが無い場合は起動しない
+    with DbClient() as db:
+        missing = db_schema.missing_indexes(db, 'Outbox')
+    if len(missing) > 0:
+        logger.error('Outbox indexes are missing: %s. run "python db_schema.py ensure" first.', ', '.join(missing))
+        return False
+
+    try:
+        while True:
+
+            with DbClient() as db:
+
+                # まとめて送信する
+                started = time.time()
+                n, sent = outbox.drain(db, name, batch_size, max_attempts)
+
+            if n > 0:
+                logger.info('%d of %d mails are sent in %.1f s.', sent, n, time.time() - started)
+
+            # 送信するメールが無ければ待つ
+            if n < batch_size:
+                if once:
+                    break
+                time.sleep(poll)
+
+    except KeyboardInterrupt:
+        logger.info('stopping worker.')
+    finally:
+        mail.get_pool().close()
+
+    return True
+
+if __name__ == '__main__':
+
+    # 既定値は [outbox] から読み込む
+    options = conf['outbox'] if conf.has_section('outbox') else {}
+
+    parser = argparse.ArgumentParser(description='送信待ちのメールを送信する')
+    parser.add_argument('--batch', type=int, default=int(options.get('batch_size', '') or 20), help='1度に取り出すメールの数')
+    parser.add_argument('--max-attempts', type=int, default=int(options.get('max_attempts', '') or outbox.MAX_ATTEMPTS), help='送信を諦めるまでの試行回数')
+    parser.add_argument('--poll', type=float, default=float(options.get('poll', '') or 1.0), help='送信するメールが無い場合の確認間隔（秒）')
+    parser.add_argument('--once', action='store_true', help='送信する時刻になったメールが無くなったら終了する')
+    parser.add_argument('--stats', action='store_true', help='送信待ちの状態を表示して終了する')
+    args = parser.parse_args()
+
+    if args.stats:
+        with DbClient() as db:
+            print(json.dumps(outbox.stats(db), indent=2, ensure_ascii=False, default=str))
+    elif not main(args.batch, args.max_attempts, args.poll, args.once):
+        sys.exit(1)
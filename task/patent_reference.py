@@ -1,4 +1,7 @@
 import jpp_browser
+import jpp_cache
+import jpp_pool
+import jpp_scheduler
 from browser import OutOfServiceException
 from datetime import datetime
 import mojimoji
@@ -10,15 +13,17 @@ import common_util
 # ログ
 __logger = logging.getLogger(__name__)
 
-def refer(country, law, number, number_type, lang, exception_on_maintenance=False):
+def refer(country, law, number, number_type, lang, exception_on_maintenance=False, priority=jpp_scheduler.PRIORITY_BATCH, max_age=None, force_refresh=False):
     """
     特許に関する情報を収集する
+    priority には照会の優先度を指定する（画面からの照会は PRIORITY_INTERACTIVE）
+    max_age, force_refresh にはキャッシュの利用条件を指定する（refer_jpp を参照）
     :return 取得したデータ, 失敗時の理由
     :rtype dict, str
     """
     # 日本
     if country == 'JP':
-        return refer_jpp(law, number, number_type, lang, exception_on_maintenance)
+        return refer_jpp(law, number, number_type, lang, exception_on_maintenance, priority, max_age, force_refresh)
     
     # ここまでに検索できていない場合は NOT SUPPORTED
     return None, 'Not supported'
@@ -53,28 +58,45 @@ def find_date_from_text(text):
     else:
         return None
 
-def refer_jpp(law, number, number_type, lang, exception_on_maintenance=False):
+def refer_jpp(law, number, number_type, lang, exception_on_maintenance=False, priority=jpp_scheduler.PRIORITY_BATCH, max_age=None, force_refresh=False):
     """
     J-PlatPatを照会して登録情報（経過情報）を取得する
+    max_age: キャッシュを利用する場合に許容する経過秒数（省略時は保持期間内のものすべて）
+    force_refresh: キャッシュを使わずに照会する
     """
-
-    # J-PlatPatを照会
-    with jpp_browser.JppBrowser() as b:
-        try:
-            status = b.get_status(law, number, number_type=number_type)
-        except OutOfServiceException:
-            if exception_on_maintenance:
-                raise
-            else:
-                return None, lang['Pages']['Property']['JPlatPat']['UnderMaintenance']
-        except jpp_browser.UnderMaintenanceException:
-            if exception_on_maintenance:
-                raise
-            else:
-                return None, lang['Pages']['Property']['JPlatPat']['UnderMaintenance']
-        except:
-            __logger.exception('J-PlatPat Reference -> Unexpected Exception')
-            return None, lang['Pages']['Property']['JPlatPat']['CannotGetInformation']
+    cache = jpp_cache.get_cache()
+    lang_name = getattr(lang, 'name', None)
+
+    # キャッシュの確認
+    if not force_refresh:
+        entry = cache.get(law, number, number_type, max_age=max_age)
+        if not entry is None:
+            results = entry.get('Results', {})
+            if not lang_name is None and lang_name in results:
+                return results[lang_name], ''
+            # 別の言語で整形されている場合は、経過情報から整形し直す
+            res = parse_jpp_status(law, entry['Status'], lang)
+            if not lang_name is None:
+                cache.add_result(entry, res, lang_name)
+            return res, ''
+
+    # J-PlatPatを照会（プールのブラウザーを使う）
+    try:
+        with jpp_pool.get_pool().session() as b:
+            status = b.get_status(law, number, number_type=number_type, priority=priority)
+    except OutOfServiceException:
+        if exception_on_maintenance:
+            raise
+        else:
+            return None, lang['Pages']['Property']['JPlatPat']['UnderMaintenance']
+    except jpp_browser.UnderMaintenanceException:
+        if exception_on_maintenance:
+            raise
+        else:
+            return None, lang['Pages']['Property']['JPlatPat']['UnderMaintenance']
+    except:
+        __logger.exception('J-PlatPat Reference -> Unexpected Exception')
+        return None, lang['Pages']['Property']['JPlatPat']['CannotGetInformation']
 
     # 失敗判定
     if status is None:
@@ -82,6 +104,16 @@ def refer_jpp(law, number, number_type, lang, exception_on_maintenance=False):
     if not '登録情報' in status:
         return None, lang['Pages']['Request']['TEXT000089']
 
+    # 整形してキャッシュする
+    res = parse_jpp_status(law, status, lang)
+    cache.put(law, number, number_type, status, res, lang_name)
+
+    return res, ''
+
+def parse_jpp_status(law, status, lang):
+    """
+    J-PlatPatから取得した経過情報を整形する
+    """
     # 情報の整形
     res = {'Country': 'JP', 'Law': law}
 
@@ -289,8 +321,8 @@ def refer_jpp(law, number, number_type, lang, exception_on_maintenance=False):
     if 'URL' in status:
         res['SourceURL'] = status['URL']
 
-    # 取得・整形した情報を返す。
-    return res, ''
+    # 整形した情報を返す。
+    return res
 
 def kanji_to_alpha_in_number(s):
     """
@@ -0,0 +1,25 @@
+import logging
+from pathlib import Path
+
+from database import DbClient
+from local_config import Config
+
+conf = Config()
+log_file = None
+
+if conf['log']['directory']:
+    log_file = Path(conf['log']['directory']) / 'repair_request_state.log'
+
+logging.basicConfig(
+    filename=str(log_file) if log_file else None,
+    level=logging.INFO if log_file else logging.DEBUG,
+    format='%(asctime)s:%(process)d:%(name)s:%(levelname)s:%(message)s'
+)
+logger = logging.getLogger('repair_request_state')
+
+if __name__ == '__main__':
+
+    # すべての権利について依頼の状況を依頼情報から再構築する
+    with DbClient() as db:
+        cnt = db.refresh_request_state()
+        logger.info('request state is rebuilt. (%d properties)', cnt)
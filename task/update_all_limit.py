@@ -1,24 +1,33 @@
 import database
 import logging
+import argparse
+import time
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-with database.DbClient() as db:
+# 対象の権利
+query = {
+    'Ignored': {'$exists': False},
+    'NextProcedureLimit': {'$exists': True},
+}
+
+def update_one_by_one(db):
+    """
+    1件ずつ次回期限を更新する（従来の方法）
+    """
+    count = 0
+    started = time.perf_counter()
 
     # 全ての権利が対象
-    for prop in db.Properties.find({
-        'Ignored': {'$exists': False},
-    }):
-        
-        if not 'NextProcedureLimit' in prop:
-            continue
+    for prop in db.Properties.find(query):
 
         logger.info('%s / %s / %s', prop['_id'], prop['Law'], prop['RegistrationNumber'])
         x = prop['NextProcedureLimit']
 
         # 次回期限の更新
         db.renew_limit_date(prop['_id'])
+        count += 1
 
         updated = db.Properties.find_one({'_id': prop['_id']}, {'NextProcedureLimit':1})
 
@@ -26,3 +35,40 @@ with database.DbClient() as db:
             logger.warning('NextProcedureLimit is deleted.')
         elif x != updated['NextProcedureLimit']:
             logger.warning('NextProcedureLimit is changed %s -> %s', x, updated['NextProcedureLimit'])
+
+    elapsed = time.perf_counter() - started
+    logger.info('%d properties in %.1f s (%.0f / s)', count, elapsed, count / elapsed if elapsed > 0 else 0)
+
+def update_bulk(db, chunk_size, dry_run, changed_only):
+    """
+    まとめて次回期限を更新する
+    """
+    def report(prop, q, changed):
+        # 変わる期限を出力する
+        for key in changed:
+            before = prop[key] if key in prop else None
+            after = q['$set'][key] if '$set' in q and key in q['$set'] else None
+            logger.warning('%s / %s / %s: %s is changed %s -> %s', prop['_id'], prop['Law'], prop['RegistrationNumber'] if 'RegistrationNumber' in prop else '', key, before, after)
+
+    stats = db.renew_limit_dates(query, chunk_size=chunk_size, dry_run=dry_run, changed_only=changed_only, on_change=report)
+
+    # 処理件数と所要時間
+    elapsed = stats['Elapsed']
+    logger.info('scanned: %d, changed: %d, written: %d%s', stats['Scanned'], stats['Changed'], stats['Written'], ' (dry run)' if dry_run else '')
+    logger.info('elapsed: %.1f s (%.0f properties / s), read: %.1f s, compute: %.1f s, write: %.1f s',
+        elapsed, stats['Scanned'] / elapsed if elapsed > 0 else 0, stats['ReadTime'], stats['ComputeTime'], stats['WriteTime'])
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='全ての権利の次回期限を再計算する')
+    parser.add_argument('--dry-run', action='store_true', help='更新せずに変わる期限のみ出力する')
+    parser.add_argument('--changed-only', action='store_true', help='期限が変わる権利のみ更新する')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='まとめて更新する件数')
+    parser.add_argument('--one-by-one', action='store_true', help='1件ずつ更新する（従来の方法）')
+    args = parser.parse_args()
+
+    with database.DbClient() as db:
+        if args.one_by_one:
+            update_one_by_one(db)
+        else:
+            update_bulk(db, args.chunk_size, args.dry_run, args.changed_only)
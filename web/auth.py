@@ -32,6 +32,48 @@ def get_account_id():
     # 条件を満たさなければid値を返さない
     return None
 
+# リクエスト内で共有するアカウント情報（WSGI environ に保持する）
+_ACCOUNT_KEY = '%s.account_info' % __name__
+
+# アカウント情報として取得する項目（各ヘルパーで使う項目をまとめたもの）
+_ACCOUNT_FIELDS = {
+    'Name': 1,
+    'Organization': 1,
+    'IsClient': 1,
+    'IsStaff': 1,
+    'IsAdmin': 1,
+    'Language': 1,
+    'Currency': 1,
+    'Ignored': 1,
+}
+
+def get_account():
+    """
+    現在のアカウントの情報を取得する
+    （1回のリクエストの中ではデータベースを1回だけ参照する）
+    """
+    _id = get_account_id()
+    if not _id:
+        return None
+
+    # 同じリクエストで取得済みであればそれを返す
+    cached = request.environ.get(_ACCOUNT_KEY)
+    if not cached is None and cached[0] == _id:
+        return cached[1]
+
+    # データベースから情報を取得する
+    with DbClient() as db:
+        user = db.Users.find_one({'_id': _id}, _ACCOUNT_FIELDS)
+
+    request.environ[_ACCOUNT_KEY] = (_id, user)
+    return user
+
+def invalidate_account():
+    """
+    リクエスト内で保持しているアカウント情報を破棄する（更新時に使用する）
+    """
+    request.environ.pop(_ACCOUNT_KEY, None)
+
 def is_authenticated():
     """
     現在のセッションが認証済か否かを取得する
@@ -64,6 +106,7 @@ def enter(mail_address):
         logger.info('%s logged in (%s, %s)', ent['_id'], request.headers['User-Agent'], request.remote_addr)
 
     # セッションを開始
+    invalidate_account()
     sess = get_session()
     sess.invalidate()
     sess['%s.account' % __name__] = ent['_id']
@@ -107,10 +150,9 @@ def require():
 
             # 名前が未登録の場合は登録ページにリダイレクト
             if request.urlparts[2] != '/newuser' and request.urlparts[2] != '/bye':
-                with DbClient() as db:
-                    ent = db.Users.find_one({'_id': get_account_id()})
-                    if not ent is None and not 'Name' in ent:
-                        redirect('/newuser')
+                ent = get_account()
+                if not ent is None and not 'Name' in ent:
+                    redirect('/newuser')
 
             # 元の関数をそのまま実行する
             return f(*args, **kwargs)
@@ -182,17 +224,13 @@ def _get_account_info():
     """
     現在のアカウントについての権限を取得する
     """
-    # 現在のアカウントの _id を取得する
-    _id = get_account_id()
-    if not _id:
-        return None
+    # 現在のアカウントの情報を取得する
+    info = get_account()
 
-    # データベースから情報を取得する
-    with DbClient() as db:
-        return db.Users.find_one({
-            '_id': _id
-            , 'Ignored':{'$exists':False}
-        }, {'IsClient':1, 'IsStaff': 1, 'IsAdmin': 1})
+    # 削除済みのアカウントは権限なし
+    if info is None or 'Ignored' in info:
+        return None
+    return info
 
 def get_user_currency():
     """
@@ -67,6 +67,37 @@ def add_months(basis, delta):
     """
     return jp_calendar.add_months(basis, delta)
 
+def add_months_expr(date_expr, delta):
+    """
+    集計パイプライン用に、日付に対して月を加算する式を生成する
+    （add_months と同様に、対応する日がない場合は末日とする）
+    """
+    total = {'$add': [{'$multiply': [{'$year': date_expr}, 12]}, {'$subtract': [{'$month': date_expr}, 1]}, delta]}
+
+    def first_day(total_months):
+        return {'$dateFromParts': {
+            'year': {'$floor': {'$divide': [total_months, 12]}},
+            'month': {'$add': [{'$mod': [total_months, 12]}, 1]},
+            'day': 1,
+        }}
+
+    return {'$let': {
+        'vars': {'t': total},
+        'in': {'$add': [
+            first_day('$$t'),
+            {'$multiply': [
+                {'$subtract': [
+                    {'$min': [
+                        {'$dayOfMonth': date_expr},
+                        {'$dayOfMonth': {'$subtract': [first_day({'$add': ['$$t', 1]}), 24 * 60 * 60 * 1000]}},
+                    ]},
+                    1,
+                ]},
+                24 * 60 * 60 * 1000,
+            ]},
+        ]},
+    }}
+
 def diff_years(reg_date, dead_date):
     """
     年の差を求める
@@ -160,35 +191,27 @@ def is_requestable(db, id, consider_cart=True, consider_request=True):
     # 権利情報の取得
     prop = db.Properties.find_one({'_id': id})
 
+    # 依頼の状況
+    state = db.get_request_states([id,], {id: prop} if not prop is None else {})[id]
+
+    # 判定
+    return is_requestable_state(prop, state['Active'], state['Recent'], consider_cart=consider_cart, consider_request=consider_request)
+
+def is_requestable_state(prop, active, recent, consider_cart=True, consider_request=True):
+    """
+    知的財産権が手続依頼の可能な状態か確認する（取得済みの依頼状況を使用）
+    active: 処理中の依頼がある, recent: 6ヶ月以内に完了した（または処理中の）依頼がある
+    """
     # 通常の判定
     result, reason, max_year, additional = is_requestable_core(prop, consider_cart=consider_cart)
 
     # 依頼中（未完了）
-    if consider_request:
-        if under_process(db, id, include_cart=False):
-            return False, 'AlreadyRequested', 0, False
+    if consider_request and active:
+        return False, 'AlreadyRequested', 0, False
 
     # 6ヶ月以内に完了した依頼があれば依頼済扱いと考える
-    if result:
-        today = get_today()
-        req_cnt = db.Requests.count_documents({'$and':[
-            {'Properties': {'$elemMatch': {
-                'Property': id,
-                '$or': [
-                    {'CompletedTime': {'$exists': False},},
-                    {'CompletedTime': {'$gt': today - timedelta(days=183)},},
-                ],
-                'CanceledTime': {'$exists': False},
-            }}},
-            {'Ignored': {'$exists': False}},
-            {'$or': [
-                {'CompletedTime': {'$exists': False},},
-                {'CompletedTime': {'$gt': today - timedelta(days=183)},},
-            ]},
-            {'CanceledTime': {'$exists': False}},
-        ]})
-        if req_cnt > 0:
-            return False, 'AlreadyRequestedAndDone', 0, False
+    if result and recent:
+        return False, 'AlreadyRequestedAndDone', 0, False
 
     # 通常の結果を返す
     return result, reason, max_year, additional
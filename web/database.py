@@ -1,5 +1,9 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring, UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import logging
+import os
+import threading
+import time
 from datetime import datetime
 #from filelock import Lock
 from bson.objectid import ObjectId
@@ -7,13 +11,168 @@ import re
 from datetime import datetime, timedelta
 
 import common_util
-import jp_calendar
+import limit_date
 import fee_calculator
 from local_config import Config
 
 # ログの初期設定
 logger = logging.getLogger(__name__)
 
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    コネクションプールの状態を集計するリスナー
+    """
+
+    def __init__(self):
+        """
+        コンストラクター
+        """
+        self.__lock = threading.Lock()
+        self.__counts = {
+            'CheckedOut': 0,
+            'Waiting': 0,
+            'Created': 0,
+            'Closed': 0,
+            'CheckOutFailed': 0,
+        }
+
+    def __add(self, **kwargs):
+        with self.__lock:
+            for key in kwargs:
+                self.__counts[key] += kwargs[key]
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.__add(Created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.__add(Closed=1)
+
+    def connection_check_out_started(self, event):
+        self.__add(Waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self.__add(Waiting=-1, CheckOutFailed=1)
+
+    def connection_checked_out(self, event):
+        self.__add(Waiting=-1, CheckedOut=1)
+
+    def connection_checked_in(self, event):
+        self.__add(CheckedOut=-1)
+
+    def stats(self):
+        """
+        集計値を辞書で取得する
+        """
+        with self.__lock:
+            return dict(self.__counts)
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    発行したコマンド（往復）の数を集計するリスナー
+    """
+
+    def __init__(self):
+        """
+        コンストラクター
+        """
+        self.__lock = threading.Lock()
+        self.__count = 0
+
+    def started(self, event):
+        with self.__lock:
+            self.__count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def count(self):
+        """
+        集計値を取得する
+        """
+        with self.__lock:
+            return self.__count
+
+# プロセス内で共有するクライアント
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_pool_monitor = None
+_command_counter = None
+
+def get_client():
+    """
+    プロセス内で共有するMongoClientを取得する
+    （fork後の子プロセスでは新たに生成する）
+    """
+    global _client, _client_pid, _pool_monitor, _command_counter
+
+    pid = os.getpid()
+    if not _client is None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+
+            # 設定ファイルから設定を取得
+            config = Config()
+            conf = config['mongo']
+
+            # プールの設定
+            options = {'retryWrites': False,}
+            if conf.get('pool_size', ''):
+                options['maxPoolSize'] = int(conf['pool_size'])
+            if conf.get('min_pool_size', ''):
+                options['minPoolSize'] = int(conf['min_pool_size'])
+            if conf.get('wait_queue_timeout', ''):
+                options['waitQueueTimeoutMS'] = int(conf['wait_queue_timeout'])
+
+            # 親プロセスのクライアントは子プロセスでは使わない（閉じずに破棄する）
+            _pool_monitor = PoolMonitor()
+            _command_counter = CommandCounter()
+            _client = MongoClient(conf['host'], int(conf['port']),
+                username=conf['user'], password=conf['pwd'], authSource=conf['db'],
+                event_listeners=[_pool_monitor, _command_counter,], **options)
+            _client_pid = pid
+
+    return _client
+
+def get_pool_stats():
+    """
+    コネクションプールの状態を取得する
+    """
+    if _pool_monitor is None or _client_pid != os.getpid():
+        return None
+    stats = _pool_monitor.stats()
+    stats['Commands'] = _command_counter.count()
+    return stats
+
+def shutdown():
+    """
+    共有しているクライアントを閉じる（プロセスの終了時に使用する）
+    """
+    global _client, _client_pid
+
+    with _client_lock:
+        if not _client is None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
 class DbClient:
     """
     MongoDB用のラッパー
@@ -25,15 +184,14 @@ class DbClient:
         """
 
         # コレクションのリスト
-        collections = ['Users','Properties','Requests','Counters','Misc','Password','Carts','Currencies']
+        collections = ['Users','Properties','Requests','Counters','Misc','Password','Carts','Currencies','ImportCheckpoints','JppTickets','JppCache','JppJobs','Outbox']
 
         # 設定ファイルから設定を取得
         config = Config()
 
-        # データベースに接続
-        self.__mongo = MongoClient(config['mongo']['host'], int(config['mongo']['port']), retryWrites=False)
+        # 共有のクライアントからデータベースを取得
+        self.__mongo = get_client()
         self.__db = self.__mongo[config['mongo']['db']]
-        self.__db.authenticate(config['mongo']['user'], config['mongo']['pwd'])
 
         # インスタンスの属性としてコレクションへの参照をセットする
         for name in collections:
@@ -49,17 +207,46 @@ class DbClient:
         """
         カウンター管理の番号について、次の番号を取得する
         """
-        cnt = self.Counters.find_one({'Name':name})
-        while True:
-            if cnt is None:
-                x = 0
-                self.Counters.insert_one({'Name':name, 'Current':0})
-            else:
-                x = cnt['Current']
-            res = self.Counters.update_one({'Name':name, 'Current':x }
-                , {'$inc':{'Current':1}, '$set':{'LastTime':datetime.now()}})
-            if res.modified_count == 1:
-                return x + 1
+        # 1回の往復で加算と取得を行う（初回は 1 で作成される）
+        def inc():
+            return self.Counters.find_one_and_update(
+                {'Name': name},
+                {'$inc': {'Current': 1}, '$set': {'LastTime': datetime.now()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        try:
+            cnt = inc()
+        except DuplicateKeyError:
+            # 初回の作成が他の処理と競合した場合は、作成済みのものを加算する
+            cnt = inc()
+        return cnt['Current']
+
+    def seed_number(self, name, value):
+        """
+        カウンター管理の番号について、現在の番号を value 以上にする（既に大きい場合は変更しない）
+        """
+        try:
+            self.Counters.update_one({'Name': name}, {'$max': {'Current': value}}, upsert=True)
+        except DuplicateKeyError:
+            # 初回の作成が他の処理と競合した場合は、作成済みのものを更新する
+            self.Counters.update_one({'Name': name}, {'$max': {'Current': value}})
+
+    def next_daily_number(self, name, day=None, used=None):
+        """
+        日ごとのカウンターについて、次の番号を取得する
+        used: その日に使用済みの最大の番号を返す関数（カウンターが無い場合に、その番号から始める）
+        """
+        if day is None:
+            day = datetime.now()
+        name = '%s-%s' % (name, day.strftime('%Y%m%d'))
+
+        # その日の初回は、カウンターを使わずに採番した番号の続きから始める
+        # ※$max で更新するため、同時に初回の処理が行われても番号は戻らない
+        if not used is None and self.Counters.count_documents({'Name': name}, limit=1) < 1:
+            self.seed_number(name, used())
+
+        return self.next_number(name)
 
     def get_mail_addresses(self, user_id):
         """
@@ -366,25 +553,17 @@ class DbClient:
         """
         依頼を処理中か否かを判定する
         """
+        # 権利情報を取得
+        prop = self.Properties.find_one({'_id': id}, {'Cart':1, 'ActiveRequest':1, 'RequestStateTime':1})
+
         # カートをチェックする
         if include_cart:
-            # 権利情報を取得
-            prop = self.Properties.find_one({'_id': id}, {'Cart':1})
             if 'Cart' in prop and prop['Cart']['Years'] > 0:
                 return True
 
         # 依頼をチェックする
-        req_cnt = self.Requests.count_documents({'$and':[
-            {'Properties': {'$elemMatch': {
-                'Property': id, 
-                'CanceledTime': {'$exists': False},
-                'CompletedTime': {'$exists': False},
-            }}},
-            {'Ignored': {'$exists': False}},
-            {'CompletedTime': {'$exists': False}},
-            {'CanceledTime': {'$exists': False}},
-        ]})
-        return (req_cnt > 0)
+        props = {id: prop} if not prop is None else {}
+        return self.get_request_states([id,], props)[id]['Active']
 
     def renew_limit_date(self, prop_id):
         """
@@ -393,12 +572,6 @@ class DbClient:
         # 権利情報を取得する
         prop = self.Properties.find_one({'_id': prop_id})
 
-        # 納付済年分を取得する
-        if 'PaidYears' in prop:
-            y = prop['PaidYears']
-        else:
-            y = 0
-
         # 完了済の依頼を取得する
         reqs = self.Requests.find({
             'Ignored': {'$exists': False},
@@ -418,147 +591,321 @@ class DbClient:
             'Properties.YearTo': 1,
             'Properties.CompletedTime': 1,
         })
-        reqs = sorted(reqs, key=lambda x: x['RequestedTime'])
-        
-        if len(reqs) > 0:
-
-            # 最後の依頼のみ取得する
-            req = reqs[-1]
-            req_p = [x for x in req['Properties'] if x['Property'] == prop_id][0]
-
-            # 納付済年分の調整
-            if prop['Law'] == 'Trademark':
-
-                # 商標は存続期間満了日を基準に直近の納付手続か否かを判定する
-                if 'ExpirationDate' in prop:
-                    if req_p['PaidYears'] == 5:
-                        # 分納後期 -> 満了日の11年前より後なら直近の納付とみなす
-                        if req_p['CompletedTime'] > common_util.add_months(prop['ExpirationDate'], -11 * 12):
-                            # 完納済
-                            logger.info('changing PaidYears %d -> %d by completed request %s', y, 10, req['_id'])
-                            y = 10
-                    else:
-                        # 満了日の12月前より後なら直近の更新とみなす
-                        if req_p['CompletedTime'] > common_util.add_months(prop['ExpirationDate'], -12):
-                            logger.info('changing PaidYears %d -> %d by completed request %s', y, req_p['Years'], req['_id'])
-                            next_exp = common_util.add_months(prop['ExpirationDate'], 10 * 12)
-                            logger.info('changing ExpirationDate %s -> %s by completed request %s', prop['ExpirationDate'], next_exp, req['_id'])
-                            # 納付年数
-                            y = req_p['Years']
-                            # 次の存続期間満了日
-                            prop['ExpirationDate'] = next_exp
 
-            else:
-
-                # 商標以外は単純に納付済年分を置き換える
-                if 'YearTo' in req_p:
-                    y2 = req_p['YearTo']
-                else:
-                    assert req_p['Years'] == 1
-                    y2 = req_p['YearFrom']
-                
-                if y2 > y:
-                    logger.info('changing PaidYears %d -> %d by completed request %s', y, y2, req['_id'])
-                    y = y2
-
-        # 更新クエリーの生成
-        query = {'$set': {}, '$unset': {}}
+        # 最後の依頼のみを考慮して期限を計算する
+        req, req_p = limit_date.select_last_request(reqs, prop_id)
+        query = limit_date.compute_limit_dates(prop, req, req_p)
+        if len(query) == 0:
+            return
 
-        if prop['Country'] == 'JP' and prop['Law'] == 'Trademark':
+        # クエリーの実行
+        self.Properties.update_one({'_id': prop_id}, query)
 
-            # 日本の商標
+    def get_last_completed_requests(self, ids=None):
+        """
+        完了済の依頼のうち最後のものを権利ごとに取得する（renew_limit_date と同じ条件）
+        （ids が None の場合はすべての権利を対象とする）
+        :return 権利のIDから (依頼, 依頼中の権利の情報) への辞書
+        """
+        # 完了済（または受領書送付済）の依頼の権利を集計する
+        # ※依頼日時が同じ場合はIDの順で後のものを採用する
+        completed = {'$or': [
+            {'Properties.CompletedTime': {'$exists': True}},
+            {'Properties.SendingReceiptTime': {'$exists': True}},
+        ]}
+        match_1 = {'Ignored': {'$exists': False}, 'Properties': {'$elemMatch': {'$or': [
+            {'CompletedTime': {'$exists': True}},
+            {'SendingReceiptTime': {'$exists': True}},
+        ]}}}
+        match_2 = {'$and': [completed,]}
+        if not ids is None:
+            match_1['Properties.Property'] = {'$in': ids}
+            match_2['$and'].append({'Properties.Property': {'$in': ids}})
+        pipeline = [
+            {'$match': match_1},
+            {'$project': {
+                'RequestedTime': 1,
+                'Properties.Property': 1,
+                'Properties.PaidYears': 1,
+                'Properties.Years': 1,
+                'Properties.YearFrom': 1,
+                'Properties.YearTo': 1,
+                'Properties.CompletedTime': 1,
+                'Properties.SendingReceiptTime': 1,
+            }},
+            {'$unwind': '$Properties'},
+            {'$match': match_2},
+            {'$sort': {'RequestedTime': 1, '_id': 1}},
+            {'$group': {
+                '_id': '$Properties.Property',
+                'Request': {'$last': '$_id'},
+                'RequestedTime': {'$last': '$RequestedTime'},
+                'Entry': {'$last': '$Properties'},
+            }},
+        ]
+
+        reqs = {}
+        for rec in self.Requests.aggregate(pipeline, allowDiskUse=True):
+            reqs[rec['_id']] = ({'_id': rec['Request'], 'RequestedTime': rec['RequestedTime']}, rec['Entry'])
+        return reqs
+
+    def renew_limit_dates(self, query=None, chunk_size=1000, dry_run=False, changed_only=False, on_change=None):
+        """
+        複数の知的財産権の次回庁期限をまとめて再計算する
+        （依頼は1回の集計でまとめて取得し、更新は bulk_write で chunk_size 件ずつ行う）
+        dry_run: 更新しない, changed_only: 期限が変わる権利のみ更新する
+        on_change: 期限が変わる権利について (権利, 更新クエリー, 変わる項目) を渡す関数
+        :return 件数と所要時間（秒）
+        """
+        stats = {
+            'Scanned': 0,
+            'Changed': 0,
+            'Written': 0,
+            'ReadTime': 0.0,
+            'ComputeTime': 0.0,
+            'WriteTime': 0.0,
+        }
+        started = time.perf_counter()
+
+        # 最後の依頼を権利ごとに取得する
+        last_requests = self.get_last_completed_requests()
+        stats['ReadTime'] += time.perf_counter() - started
+
+        fields = {
+            'Country': 1,
+            'Law': 1,
+            'RegistrationNumber': 1,
+            'RegistrationDate': 1,
+            'ExpirationDate': 1,
+            'PaidYears': 1,
+            'Disappered': 1,
+        }
+        for key in limit_date.LIMIT_FIELDS:
+            fields[key] = 1
+        cursor = self.Properties.find(query if not query is None else {}, fields, batch_size=chunk_size)
+
+        def flush(props):
+            # 期限を計算する
+            t = time.perf_counter()
+            queries = limit_date.compute_limit_dates_batch(props, last_requests)
+            ops = []
+            for prop, q in zip(props, queries):
+                changed = limit_date.changed_fields(prop, q)
+                if len(changed) > 0:
+                    stats['Changed'] += 1
+                    if not on_change is None:
+                        on_change(prop, q, changed)
+                elif changed_only or len(q) == 0:
+                    continue
+                ops.append(UpdateOne({'_id': prop['_id']}, q))
+            stats['ComputeTime'] += time.perf_counter() - t
+
+            # まとめて更新する
+            if not dry_run and len(ops) > 0:
+                t = time.perf_counter()
+                stats['Written'] += self.Properties.bulk_write(ops, ordered=False).matched_count
+                stats['WriteTime'] += time.perf_counter() - t
+
+        # 権利を順に読み込み、chunk_size 件ごとに処理する
+        props = []
+        t = time.perf_counter()
+        for prop in cursor:
+            props.append(prop)
+            if len(props) >= chunk_size:
+                stats['ReadTime'] += time.perf_counter() - t
+                stats['Scanned'] += len(props)
+                flush(props)
+                props = []
+                t = time.perf_counter()
+        stats['ReadTime'] += time.perf_counter() - t
+        if len(props) > 0:
+            stats['Scanned'] += len(props)
+            flush(props)
+
+        stats['Elapsed'] = time.perf_counter() - started
+        return stats
+
+    def get_request_states(self, ids, props=None):
+        """
+        複数の知的財産権について、依頼の状況をまとめて取得する
+        （Active: 処理中の依頼あり, Recent: 処理中または6ヶ月以内に完了した依頼あり）
+        props に取得済みの権利情報（ID→情報）を渡した場合は再取得しない
+        """
+        # 権利に記録された依頼の状況を取得
+        if props is None:
+            props = {}
+            for prop in self.Properties.find({'_id': {'$in': ids}}, {'ActiveRequest':1, 'LastCompletedRequestTime':1, 'RequestStateTime':1}):
+                props[prop['_id']] = prop
+
+        # 判定の基準日
+        threshold = common_util.get_today() - timedelta(days=183)
+
+        states = {}
+        not_recorded = []
+
+        for id in ids:
+            prop = props[id] if id in props else None
+            if prop is None or not 'RequestStateTime' in prop:
+                # 未記録の場合は依頼から集計する
+                not_recorded.append(id)
+                continue
+            active = 'ActiveRequest' in prop
+            recent = active or ('LastCompletedRequestTime' in prop and prop['LastCompletedRequestTime'] > threshold)
+            states[id] = {'Active': active, 'Recent': recent}
+
+        if len(not_recorded) > 0:
+            for id, summary in self.__summarize_requests(not_recorded).items():
+                active = 'ActiveRequest' in summary
+                recent = active or ('LastCompletedRequestTime' in summary and summary['LastCompletedRequestTime'] > threshold)
+                states[id] = {'Active': active, 'Recent': recent}
 
-            # 存続期間満了日が設定されていない場合は計算しない
-            if 'ExpirationDate' in prop:
+        # 結果を返す
+        return states
 
-                exp = prop['ExpirationDate']
+    def __summarize_requests(self, ids=None):
+        """
+        依頼を権利ごとに集計する
+        ActiveRequest: 処理中の依頼のID, LastCompletedRequestTime: 最後に完了した日時
+        （ids が None の場合はすべての権利を対象とする）
+        """
+        summaries = {}
+        if not ids is None:
+            for id in ids:
+                summaries[id] = {}
+            if len(summaries) < 1:
+                return summaries
+
+        # キャンセルされていない依頼を権利ごとに集計する
+        # ※依頼と権利の両方に完了日時がある場合は早い方を完了日時とみなす
+        match_1 = {'Ignored': {'$exists': False}, 'CanceledTime': {'$exists': False}}
+        match_2 = {'Properties.CanceledTime': {'$exists': False}}
+        if not ids is None:
+            match_1['Properties.Property'] = {'$in': ids}
+            match_2['Properties.Property'] = {'$in': ids}
+        pipeline = [
+            {'$match': match_1},
+            {'$unwind': '$Properties'},
+            {'$match': match_2},
+            {'$project': {
+                'Property': '$Properties.Property',
+                'Completed': {'$min': ['$CompletedTime', '$Properties.CompletedTime']},
+            }},
+            {'$group': {
+                '_id': '$Property',
+                'ActiveRequest': {'$max': {'$cond': [{'$eq': [{'$ifNull': ['$Completed', None]}, None]}, '$_id', None]}},
+                'LastCompletedRequestTime': {'$max': '$Completed'},
+            }},
+        ]
+        for rec in self.Requests.aggregate(pipeline, allowDiskUse=True):
+            summary = {}
+            for key in ('ActiveRequest', 'LastCompletedRequestTime',):
+                if not rec[key] is None:
+                    summary[key] = rec[key]
+            summaries[rec['_id']] = summary
 
-                ## 仮の存続期限（更新予定）があれば、それで上書き
-                #if 'TempExpirationDate' in prop and prop['TempExpirationDate'] > exp:
-                #    exp = prop['TempExpirationDate']
+        # 結果を返す
+        return summaries
 
-                # 存続期間満了日から分納分を差し引いた日を次の期限とする
-                if y <= 10:
-                    query['$set']['NextProcedureLimit'] = common_util.add_months(exp, -1 * 12 * (10 - y))
-                else:
-                    query['$set']['NextProcedureLimit'] = jp_calendar.add_months(exp, 0, consider_holiday=False)
+    def refresh_request_state(self, ids=None, chunk_size=1000):
+        """
+        権利に依頼の状況（ActiveRequest, LastCompletedRequestTime）を記録する
+        （ids が None の場合はすべての権利を再構築する）
+        """
+        if not ids is None:
+            ids = list(set(ids))
 
-                if 'NextProcedureLimit' in query['$set']:
-                    query['$set']['NextProcedureOpenDate'] = jp_calendar.add_months(query['$set']['NextProcedureLimit'], -6, consider_holiday=False)
-                    query['$set']['NextProcedureLastLimit'] = jp_calendar.add_months(query['$set']['NextProcedureLimit'], 6, consider_holiday=True)
-                    # 閉庁日調整
-                    query['$set']['NextProcedureLimit'] = jp_calendar.add_months(query['$set']['NextProcedureLimit'], 0, consider_holiday=True)
+        # 依頼の集計
+        summaries = self.__summarize_requests(ids)
+        now = datetime.now()
 
+        # 対象の権利
+        if ids is None:
+            targets = (x['_id'] for x in self.Properties.find({}, {'_id': 1}))
         else:
-
-            # 通常の計算
-
-            # 登録日が設定されていない場合は計算しない
-            if 'RegistrationDate' in prop:
-        
-                # 次回庁期限の計算
-                if prop['Country'] == 'JP':
-                    query['$set']['NextProcedureLimit'] = jp_calendar.add_months(prop['RegistrationDate'], 12 * y, consider_holiday=True)
+            targets = ids
+
+        def make_update(id):
+            summary = summaries[id] if id in summaries else {}
+            q = {'$set': {'RequestStateTime': now}, '$unset': {}}
+            for key in ('ActiveRequest', 'LastCompletedRequestTime',):
+                if key in summary:
+                    q['$set'][key] = summary[key]
                 else:
-                    query['$set']['NextProcedureLimit'] = common_util.add_months(prop['RegistrationDate'], 12 * y)
-
-                # 追納期間の計算
-                if prop['Country'] == 'JP':
-                    query['$set']['NextProcedureLastLimit'] = jp_calendar.add_months(prop['RegistrationDate'], (12 * y) + 6, consider_holiday=True)
- 
-        # 計算した次回期限が存続期間を超える場合は期限日を消す
-        if 'NextProcedureLimit' in query['$set'] and 'ExpirationDate' in prop:
-            if 'ExpirationDate' in prop and query['$set']['NextProcedureLimit'] > prop['ExpirationDate'] and prop['Law'] != 'Trademark':
-                del query['$set']['NextProcedureLimit']
-                query['$unset']['NextProcedureLimit'] = ''
-
-        # 消滅しているのに次回期限があったら消す
-        if 'NextProcedureLimit' in query['$set'] and common_util.in_and_true(prop, 'Disappered'):
-            del query['$set']['NextProcedureLimit']
-            query['$unset']['NextProcedureLimit'] = ''
-
-        if 'NextProcedureLastLimit' in query['$set'] and not 'NextProcedureLimit' in query['$set']:
-            del query['$set']['NextProcedureLastLimit']
-            query['$unset']['NextProcedureLastLimit'] = ''
-        if not 'NextProcedureLastLimit' in query['$set'] and 'NextProcedureLimit' in query['$set']:
-            query['$set']['NextProcedureLastLimit'] = query['$set']['NextProcedureLimit']
-        else:
-            query['$unset']['NextProcedureLastLimit'] = ''
-
-        # $set に次回期限が無ければ、$unset に入れる
-        if not 'NextProcedureLimit' in query['$set']:
-            query['$unset']['NextProcedureLimit'] = ''
-            query['$unset']['NextProcedureOpenDate'] = ''
-            query['$unset']['NextProcedureLastLimit'] = ''
-
-        # $set にあるキーを $unset から消す
-        for key in query['$set'].keys():
-            if key in query['$unset']:
-                del query['$unset'][key]
-
-        if len(query['$set']) == 0:
-            del query['$set']
-        if len(query['$unset']) == 0:
-            del query['$unset']
-        if len(query) == 0:
-            return
-
-        # クエリーの実行
-        self.Properties.update_one({'_id': prop_id}, query)
+                    q['$unset'][key] = ''
+            if len(q['$unset']) == 0:
+                del q['$unset']
+            return UpdateOne({'_id': id}, q)
+
+        # まとめて更新する
+        count = 0
+        ops = []
+        for id in targets:
+            ops.append(make_update(id))
+            if len(ops) >= chunk_size:
+                count += self.Properties.bulk_write(ops, ordered=False).matched_count
+                ops = []
+        if len(ops) > 0:
+            count += self.Properties.bulk_write(ops, ordered=False).matched_count
+
+        # 更新件数を返す
+        return count
 
     def get_prop_info(self, id, lang, date_to_str=True):
         """
         知的財産権の情報を取得する
         """
-        # 詳細情報の取得
-        if not isinstance(id, ObjectId):
-            id = ObjectId(id)
+        infos = self.get_prop_infos([id,], lang, date_to_str=date_to_str)
+        if len(infos) < 1:
+            return None
+        return infos[0]
+
+    def get_prop_infos(self, ids, lang, date_to_str=True):
+        """
+        複数の知的財産権の情報をまとめて取得する
+        （get_prop_info と同じ形式の情報を ids の順に返す。存在しないものは含まない）
+        """
+        ids = [x if isinstance(x, ObjectId) else ObjectId(x) for x in ids]
+        if len(ids) < 1:
+            return []
 
         # 通貨設定の取得
         currencies = common_util.get_currencies(self)
 
         # 情報の取得
-        info = self.Properties.find_one({'_id': id})
+        infos = {}
+        for info in self.Properties.find({'_id': {'$in': ids}}):
+            infos[info['_id']] = info
+
+        # 依頼の状況を取得
+        states = self.get_request_states(list(infos.keys()), infos)
+
+        # ユーザーの通貨設定を取得
+        user_ids = list(set([x['User'] for x in infos.values() if 'User' in x]))
+        user_currencies = {}
+        if len(user_ids) > 0:
+            for user_info in self.Users.find({'_id': {'$in': user_ids}}, {'Currency': 1}):
+                if 'Currency' in user_info:
+                    user_currencies[user_info['_id']] = user_info['Currency']
+
+        # 個別に編集する
+        res = []
+        for id in ids:
+            if not id in infos:
+                continue
+            res.append(self.__make_prop_info(dict(infos[id]), states[id], lang, currencies, user_currencies, date_to_str))
+
+        # 結果を返す
+        return res
+
+    def __make_prop_info(self, info, state, lang, currencies, user_currencies, date_to_str):
+        """
+        知的財産権の情報を表示用に編集する
+        """
+        # 依頼可能か調べる
+        requestable, reason, max_year, additional = common_util.is_requestable_state(info, state['Active'], state['Recent'], consider_cart=True)
+
+        # 次回料金計算用の判定
+        _, _, _, additional = common_util.is_requestable_state(info, state['Active'], state['Recent'], consider_cart=False, consider_request=False)
 
         # 法令名の付与
         info['LawName'] = lang['Law'][info['Law']]
@@ -571,8 +918,7 @@ class DbClient:
         if 'PriorNumber' in info and not isinstance(info['PriorNumber'], list):
             info['PriorNumber'] = [info['PriorNumber'],]
 
-        # 依頼可能か調べる
-        requestable, reason, max_year, additional = common_util.is_requestable(self, id, consider_cart=True)
+        # 依頼可能か
         info['Requestable'] = requestable
 
         if not requestable:
@@ -584,9 +930,6 @@ class DbClient:
         if 'Holders' in info:
             info['HolderNames'] = ','.join([x['Name'] for x in info['Holders'] if 'Name' in x])
 
-        # 次回料金計算用の判定
-        _, _, _, additional = common_util.is_requestable(self, id, consider_cart=False, consider_request=False)
-
         # 次回納付料金を計算
         y_f = 0
         y_s = 0
@@ -641,10 +984,8 @@ class DbClient:
                 
                 # ユーザー通貨に換算
                 user_cur = cur
-                if 'User' in info:
-                    user_info = self.Users.find_one({'_id': info['User']})
-                    if not user_info is None and 'Currency' in user_info:
-                        user_cur = user_info['Currency']
+                if 'User' in info and info['User'] in user_currencies:
+                    user_cur = user_currencies[info['User']]
 
                 if cur != user_cur:
                     fee2, _ = common_util.currency_exchange(fee, cur, user_cur, currencies)
@@ -667,7 +1008,7 @@ class DbClient:
             info['AdditionalPeriod'] = True
 
         # 依頼中か否かを判定
-        info['UnderProcess'] = self.under_process(id, include_cart=True)
+        info['UnderProcess'] = state['Active'] or ('Cart' in info and info['Cart']['Years'] > 0)
 
         # レスポンス用にデータを編集
         res = {
@@ -763,10 +1104,43 @@ class DbClient:
     def close(self):
         """
         データベースへの接続を閉じる
+        （共有のコネクションプールは維持し、参照のみ解放する）
         """
-        # 接続を切る
-        self.__mongo.close()
+        self.__db = None
+        self.__mongo = None
 
 if __name__ == '__main__':
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    logging.basicConfig(level=logging.DEBUG)
+
+    # 番号の同時採番のベンチマーク（並列数は引数で指定）
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    name = 'Bench-%s' % datetime.now().strftime('%H%M%S%f')
+
+    def order(i):
+        with DbClient() as db:
+            return db.next_number(name), db.next_daily_number(name)
+
+    with DbClient() as db:
+        db.Counters.find_one({'Name': name})
+    before = get_pool_stats()['Commands']
+    start = datetime.now()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(order, range(workers)))
+
+    elapsed = datetime.now() - start
+    commands = get_pool_stats()['Commands'] - before
+    numbers = [x[0] for x in results]
+    daily_numbers = [x[1] for x in results]
+
+    logger.info('orders: %d, elapsed: %s', workers, elapsed)
+    logger.info('duplicates: %d (serial), %d (daily)', len(numbers) - len(set(numbers)), len(daily_numbers) - len(set(daily_numbers)))
+    logger.info('round trips: %d (%.2f per number)', commands, commands / (workers * 2))
+    logger.info('pool: %s', get_pool_stats())
+
+    # 後片付け
     with DbClient() as db:
-        logger.debug(db.next_number('Test'))
+        db.Counters.delete_many({'Name': {'$regex': '^%s' % name}})
@@ -0,0 +1,286 @@
+import logging
+import argparse
+import json
+from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+from database import DbClient
+
+# ログの初期設定
+logger = logging.getLogger(__name__)
+
+# インデックスの定義
+# ※ partialFilterExpression は $exists: false を扱えないため、
+#    Ignored 等の「存在しないこと」で絞り込む項目は複合キーの後半に含める
+INDEXES = {
+    'Properties': [
+        {
+            'keys': [('User', 1), ('Ignored', 1), ('Country', 1)],
+            'name': 'User_Ignored_Country',
+        },
+        {
+            'keys': [('Country', 1), ('Law', 1), ('RegistrationNumber', 1)],
+            'name': 'Country_Law_RegistrationNumber',
+        },
+        {
+            'keys': [('NextProcedureLimit', 1), ('Country', 1)],
+            'name': 'NextProcedureLimit_Country',
+            'partialFilterExpression': {'NextProcedureLimit': {'$exists': True}},
+        },
+    ],
+    'Requests': [
+        {
+            'keys': [('Properties.Property', 1)],
+            'name': 'Properties.Property',
+        },
+        {
+            'keys': [('RequestNumberV2', 1)],
+            'name': 'RequestNumberV2',
+            'unique': True,
+            'partialFilterExpression': {'RequestNumberV2': {'$exists': True}},
+        },
+        {
+            'keys': [('User', 1), ('RequestedTime', -1)],
+            'name': 'User_RequestedTime',
+        },
+    ],
+    'Users': [
+        {
+            'keys': [('MailAddress', 1), ('Ignored', 1)],
+            'name': 'MailAddress_Ignored',
+        },
+    ],
+    'Counters': [
+        {
+            'keys': [('Name', 1)],
+            'name': 'Name',
+            'unique': True,
+        },
+    ],
+    'Misc': [
+        {
+            'keys': [('Key', 1)],
+            'name': 'Key',
+            'unique': True,
+            'partialFilterExpression': {'Key': {'$exists': True}},
+        },
+    ],
+    'JppTickets': [
+        {
+            'keys': [('Priority', 1), ('RequestedTime', 1)],
+            'name': 'Priority_RequestedTime',
+        },
+        {
+            'keys': [('ExpireAt', 1)],
+            'name': 'ExpireAt',
+            'expireAfterSeconds': 0,
+        },
+    ],
+    'JppCache': [
+        {
+            'keys': [('Law', 1), ('Number', 1), ('NumberType', 1)],
+            'name': 'Law_Number_NumberType',
+            'unique': True,
+        },
+        {
+            'keys': [('ExpireAt', 1)],
+            'name': 'ExpireAt',
+            'expireAfterSeconds': 0,
+        },
+    ],
+    'JppJobs': [
+        {
+            'keys': [('Status', 1), ('RequestedTime', 1)],
+            'name': 'Status_RequestedTime',
+        },
+        {
+            'keys': [('User', 1), ('Status', 1)],
+            'name': 'User_Status',
+        },
+        {
+            'keys': [('ExpireAt', 1)],
+            'name': 'ExpireAt',
+            'expireAfterSeconds': 0,
+        },
+    ],
+    'Outbox': [
+        {
+            'keys': [('Status', 1), ('NextAttemptTime', 1)],
+            'name': 'Status_NextAttemptTime',
+        },
+        {
+            'keys': [('Key', 1)],
+            'name': 'Key',
+            'unique': True,
+            'partialFilterExpression': {'Key': {'$exists': True}},
+        },
+        {
+            'keys': [('ExpireAt', 1)],
+            'name': 'ExpireAt',
+            'expireAfterSeconds': 0,
+        },
+    ],
+    'ImportCheckpoints': [
+        {
+            'keys': [('Archive', 1), ('Law', 1)],
+            'name': 'Archive_Law',
+            'unique': True,
+        },
+    ],
+}
+
+def canonical_queries():
+    """
+    実行計画を確認する代表的なクエリーの一覧
+    （値はダミーだが、プランの選択には影響しない）
+    """
+    today = datetime.now()
+    dummy_id = ObjectId()
+    return [
+        ('Properties', 'props_page', {'$and': [
+            {'User': dummy_id},
+            {'Ignored': {'$exists': False}},
+            {'Country': {'$in': ['JP',]}},
+        ]}),
+        ('Properties', 'registration_number', {
+            'Country': 'JP',
+            'Law': 'Patent',
+            'RegistrationNumber': '0000000',
+        }),
+        ('Properties', 'notify_candidates', {'$and': [
+            {'Country': {'$in': ['JP',]}},
+            {'Ignored': {'$exists': False}},
+            {'NextProcedureLimit': {'$in': [today, today]}},
+            {'NextProcedureLimit': {'$gte': today}},
+        ]}),
+        ('Requests', 'active_request', {'$and': [
+            {'Properties': {'$elemMatch': {
+                'Property': dummy_id,
+                'CompletedTime': {'$exists': False},
+                'CanceledTime': {'$exists': False},
+            }}},
+            {'Ignored': {'$exists': False}},
+            {'CompletedTime': {'$exists': False}},
+            {'CanceledTime': {'$exists': False}},
+        ]}),
+        ('Requests', 'request_number_v2', {'RequestNumberV2': '000000-1'}),
+        ('Users', 'login', {'MailAddress': 'nobody@example.com', 'Ignored': {'$exists': False}}),
+        ('Counters', 'next_number', {'Name': 'Request'}),
+        ('Outbox', 'claim', {'$or': [
+            {'Status': 'Pending', 'NextAttemptTime': {'$lte': today}},
+            {'Status': 'Sending', 'LockedUntil': {'$lt': today}},
+        ]}),
+    ]
+
+def ensure_indexes(db):
+    """
+    定義されたインデックスを作成する（作成済みの場合は何もしない）
+    """
+    created = []
+    for coll_name in INDEXES:
+        coll = getattr(db, coll_name)
+        for spec in INDEXES[coll_name]:
+            options = dict([(k, v) for k, v in spec.items() if k != 'keys'])
+            try:
+                coll.create_indexes([IndexModel(spec['keys'], **options),])
+                created.append('%s.%s' % (coll_name, spec['name']))
+            except OperationFailure as e:
+                # 同名で定義の異なるインデックスや重複データがある場合
+                logger.warning('cannot create index %s.%s: %s', coll_name, spec['name'], e)
+    return created
+
+def missing_indexes(db, coll_name):
+    """
+    1つのコレクションについて、定義に対して不足しているインデックスを調べる
+    """
+    existing = getattr(db, coll_name).index_information()
+    return [x['name'] for x in INDEXES[coll_name] if not x['name'] in existing]
+
+def check_indexes(db):
+    """
+    定義に対して不足しているインデックスと、使われていないインデックスを調べる
+    """
+    report = {}
+    for coll_name in INDEXES:
+        coll = getattr(db, coll_name)
+        declared = [x['name'] for x in INDEXES[coll_name]]
+        existing = coll.index_information()
+
+        # 利用状況（サーバーの起動以降の集計）
+        usage = {}
+        for stat in coll.aggregate([{'$indexStats': {}}]):
+            usage[stat['name']] = {
+                'Ops': stat['accesses']['ops'],
+                'Since': stat['accesses']['since'],
+            }
+
+        report[coll_name] = {
+            'Missing': [x for x in declared if not x in existing],
+            'Undeclared': [x for x in existing if x != '_id_' and not x in declared],
+            'Unused': [x for x in usage if x != '_id_' and usage[x]['Ops'] == 0],
+            'Usage': usage,
+        }
+    return report
+
+def summarize_plan(plan):
+    """
+    実行計画のステージを平坦化する
+    """
+    stages = []
+    while not plan is None:
+        stage = plan.get('stage', '?')
+        if 'indexName' in plan:
+            stage += '(%s)' % plan['indexName']
+        stages.append(stage)
+        if 'inputStage' in plan:
+            plan = plan['inputStage']
+        elif 'inputStages' in plan and len(plan['inputStages']) > 0:
+            for sub in plan['inputStages'][1:]:
+                stages.extend(summarize_plan(sub))
+            plan = plan['inputStages'][0]
+        else:
+            plan = None
+    return stages
+
+def explain_queries(db):
+    """
+    代表的なクエリーの実行計画の要約を取得する
+    """
+    results = []
+    for coll_name, label, query in canonical_queries():
+        coll = getattr(db, coll_name)
+        ex = coll.find(query).explain()
+        stages = summarize_plan(ex['queryPlanner']['winningPlan'])
+        res = {
+            'Collection': coll_name,
+            'Query': label,
+            'Plan': ' <- '.join(stages),
+            'CollectionScan': len([x for x in stages if x.startswith('COLLSCAN')]) > 0,
+        }
+        if 'executionStats' in ex:
+            res['DocsExamined'] = ex['executionStats']['totalDocsExamined']
+            res['KeysExamined'] = ex['executionStats']['totalKeysExamined']
+            res['Returned'] = ex['executionStats']['nReturned']
+        if res['CollectionScan']:
+            logger.warning('collection scan: %s.%s', coll_name, label)
+        results.append(res)
+    return results
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(process)d:%(name)s:%(levelname)s:%(message)s')
+
+    parser = argparse.ArgumentParser(description='インデックスの作成と確認')
+    parser.add_argument('command', choices=['ensure', 'check', 'explain'])
+    args = parser.parse_args()
+
+    with DbClient() as db:
+        if args.command == 'ensure':
+            res = ensure_indexes(db)
+        elif args.command == 'check':
+            res = check_indexes(db)
+        else:
+            res = explain_queries(db)
+
+    print(json.dumps(res, indent=2, ensure_ascii=False, default=str))
@@ -19,7 +19,8 @@ import auth
 import local_config
 import web_util
 import language
-import mail
+import outbox
+import db_schema
 from web_util import InvalidRequestException
 
 import user_page
@@ -49,15 +50,9 @@ def static(file_path):
 
     def a(match):
         keys = match.group(1).split(".")
-        keys = keys[1:]
-        d = lang
-        for i in range(len(keys) - 1):
-            if keys[i] in d:
-                d = d[keys[i]]
-            else:
-                return match.group(1)
-        if keys[-1] in d and isinstance(d[keys[-1]], str):
-            return d[keys[-1]]
+        x = lang.lookup('.'.join(keys[1:]))
+        if isinstance(x, str):
+            return x
         else:
             return match.group(1)
 
@@ -223,11 +218,12 @@ def pre_signup_page_posted():
 
         mail_body = buff.getvalue()
 
-    # メールの送信
+    # メールの送信（送信待ちに登録し、ワーカーが送信する）
     try:
-        mail.send_mail(lang['Pages']['LogIn']['TEXT000005'], mail_body, addr)
+        with DbClient() as db:
+            outbox.enqueue(db, lang['Pages']['LogIn']['TEXT000005'], mail_body, addr, category='LoginLink')
     except:
-        logger.exception('smtp error at publish login url process.')
+        logger.exception('cannot queue mail at publish login url process.')
         return web_util.apply_template('login_link', doc={'MailAddress': addr, 'AlertMessage': lang['Pages']['LogIn']['TEXT000007']})
 
     # スパム防止用の Cookie を埋める
@@ -322,6 +318,7 @@ def new_user_page_default():
             {'_id': user_id},
             update
         )
+        auth.invalidate_account()
 
         # ページ遷移
         if res.modified_count > 0:
@@ -555,6 +552,9 @@ def user_page_posted():
             user_org = None
         common_util.update_user_name(db, cur['_id'], user_name, user_org)
 
+    # リクエスト内で保持しているアカウント情報を破棄
+    auth.invalidate_account()
+
     # ページの再表示
     return user_page(info=lang['Common']['Updated'])
 
@@ -806,8 +806,9 @@ def passwd_request_page_posted():
     mail_body = lang['Pages']['User']['Mail2']['Body'].format(URL=url)
     mail_body += lang.mail_footer()
 
-    # メールの送信
-    mail.send_mail(lang['Pages']['User']['Mail2']['Subject'], mail_body, posted['MailAddress'])
+    # メールの送信（送信待ちに登録し、ワーカーが送信する）
+    with DbClient() as db:
+        outbox.enqueue(db, lang['Pages']['User']['Mail2']['Subject'], mail_body, posted['MailAddress'], key='PasswordReset:%s' % key, category='PasswordReset')
 
     # スパム防止のCookieを埋める
     web_util.set_cookie(
@@ -1050,6 +1051,11 @@ def default_options():
 # 設定ファイルの取得
 config = local_config.Config()
 
+# インデックスの作成（設定で有効な場合のみ）
+if config['mongo'].get('ensure_indexes', '') == '1':
+    with DbClient() as db:
+        db_schema.ensure_indexes(db)
+
 # beaker セッションの設定
 # https://beaker.readthedocs.io/en/latest/configuration.html#configuration
 session_opts = {
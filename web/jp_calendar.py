@@ -3,6 +3,10 @@
 import sys
 import re
 from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
@@ -69,6 +73,26 @@ def get_holidays(year):
     """
     指定した年の祝日・国民の休日を取得する
     """
+    return list(_holidays(year))
+
+@lru_cache(maxsize=None)
+def _holidays(year):
+    """
+    指定した年の祝日・国民の休日（計算結果を保持する）
+    """
+    return tuple(compute_holidays(year))
+
+@lru_cache(maxsize=None)
+def _holiday_set(year):
+    """
+    指定した年の祝日・国民の休日の集合
+    """
+    return frozenset(_holidays(year))
+
+def compute_holidays(year):
+    """
+    指定した年の祝日・国民の休日を計算する
+    """
     days = []
     # 固定日付の祝日
     for m, d in ((1,1), (2,11), (4,29), (5,3)
@@ -142,27 +166,165 @@ def is_leap_year(year):
         return False
 
 
+class BusinessCalendar(object):
+    """
+    営業日（土日・祝日以外）の表
+    指定した年の範囲を事前に計算し、範囲外の日付は都度計算する
+    """
+
+    def __init__(self, first_year, last_year):
+        """
+        コンストラクター
+        """
+        self.first_year = first_year
+        self.last_year = last_year
+        self.__origin = datetime(first_year, 1, 1).toordinal()
+        size = datetime(last_year, 12, 31).toordinal() - self.__origin + 1
+
+        # 営業日のフラグ（日ごと）
+        flags = bytearray(size)
+        for i in range(size):
+            d = datetime.fromordinal(self.__origin + i)
+            if d.weekday() < 5 and not d in _holiday_set(d.year):
+                flags[i] = 1
+        self.__flags = bytes(flags)
+
+        # 営業日の位置のリスト
+        self.__days = array('l', [i for i in range(size) if flags[i]])
+
+        # 各日以降で最初の営業日の位置（範囲内にない場合は -1）
+        nexts = array('l', [-1]) * size
+        n = -1
+        for i in range(size - 1, -1, -1):
+            if flags[i]:
+                n = i
+            nexts[i] = n
+        self.__nexts = nexts
+
+    @property
+    def origin(self):
+        """
+        表の最初の日
+        """
+        return self.__date(0)
+
+    @property
+    def next_offsets(self):
+        """
+        各日以降で最初の営業日の位置（表の最初の日からの日数、範囲内にない場合は -1）
+        """
+        return self.__nexts
+
+    def __index(self, d):
+        """
+        表の位置を取得する（範囲外は None）
+        """
+        i = d.toordinal() - self.__origin
+        if i < 0 or i >= len(self.__flags):
+            return None
+        return i
+
+    def __date(self, i):
+        """
+        表の位置に対応する日付
+        """
+        return datetime.fromordinal(self.__origin + i)
+
+    def is_business_day(self, d):
+        """
+        営業日か否かを判定する
+        """
+        i = self.__index(d)
+        if i is None:
+            d = datetime(d.year, d.month, d.day)
+            return d.weekday() < 5 and not d in _holiday_set(d.year)
+        return self.__flags[i] == 1
+
+    def next_business_day(self, d):
+        """
+        指定日以降（指定日を含む）で最初の営業日を取得する
+        """
+        i = self.__index(d)
+        if not i is None and self.__nexts[i] >= 0:
+            return self.__date(self.__nexts[i])
+
+        # 範囲外は1日ずつ調べる
+        d = datetime(d.year, d.month, d.day)
+        while not self.is_business_day(d):
+            d = d + timedelta(days=1)
+        return d
+
+    def add_business_days(self, d, days):
+        """
+        指定日から営業日を数えて進める（負の場合は戻る）
+        days=0 の場合は指定日以降で最初の営業日
+        """
+        if days == 0:
+            return self.next_business_day(d)
+
+        i = self.__index(d)
+        if not i is None:
+            if days > 0:
+                k = bisect_right(self.__days, i) + days - 1
+            else:
+                k = bisect_left(self.__days, i) + days
+            if k >= 0 and k < len(self.__days):
+                return self.__date(self.__days[k])
+
+        # 範囲外は1日ずつ数える
+        d = datetime(d.year, d.month, d.day)
+        step = timedelta(days=1 if days > 0 else -1)
+        n = abs(days)
+        while n > 0:
+            d = d + step
+            if self.is_business_day(d):
+                n -= 1
+        return d
+
+# 事前に計算する年の範囲
+CALENDAR_FIRST_YEAR = 1980
+CALENDAR_LAST_YEAR = 2100
+
+_calendar = None
+_calendar_lock = threading.Lock()
+
+def get_calendar():
+    """
+    共有の営業日の表を取得する
+    """
+    global _calendar
+    if _calendar is None:
+        with _calendar_lock:
+            if _calendar is None:
+                _calendar = BusinessCalendar(CALENDAR_FIRST_YEAR, CALENDAR_LAST_YEAR)
+    return _calendar
+
+def is_business_day(d):
+    """
+    営業日か否かを判定する
+    """
+    return get_calendar().is_business_day(d)
+
+def next_business_day(d):
+    """
+    指定日以降（指定日を含む）で最初の営業日を取得する
+    """
+    return get_calendar().next_business_day(d)
+
+def add_business_days(d, days):
+    """
+    指定日から営業日を数えて進める
+    """
+    return get_calendar().add_business_days(d, days)
+
 # 月の加算
 def add_months(base_date, months, consider_holiday=False):
     """
     日本のカレンダーを基準に月を加算する
     """
-    d = datetime(base_date.year, base_date.month, 1)
-
     # 年・月を計算する
-    while months != 0:
-        if months > 0:
-            if d.month == 12:
-                d = datetime(d.year + 1, 1, 1)
-            else:
-                d = datetime(d.year, d.month + 1, 1)
-            months -= 1
-        else:
-            if d.month == 1:
-                d = datetime(d.year - 1, 12, 1)
-            else:
-                d = datetime(d.year, d.month - 1, 1)
-            months += 1
+    n = base_date.year * 12 + (base_date.month - 1) + int(months)
+    d = datetime(n // 12, n % 12 + 1, 1)
 
     # 末日の処理（対応する日がない場合は末日）
     if base_date.day == 31 and d.month in (4, 6, 9, 11):
@@ -177,12 +339,38 @@ def add_months(base_date, months, consider_holiday=False):
 
     # 休日の考慮
     if consider_holiday:
-        while d.weekday() in (5, 6) or d in get_holidays(d.year):
-            d = d + timedelta(days=1)
+        d = next_business_day(d)
 
     # 計算した日付を返す
     return d
 
 if __name__ == '__main__':
-    for d in get_holidays(int(sys.argv[1])):
-        print(d)
+    if sys.argv[1] != 'bench':
+        for d in get_holidays(int(sys.argv[1])):
+            print(d)
+        sys.exit()
+
+    import timeit
+
+    # 従来の方法（休日を毎回計算して1日ずつ進める）
+    def add_months_legacy(base_date, months):
+        d = add_months(base_date, months)
+        while d.weekday() in (5, 6) or d in compute_holidays(d.year):
+            d = d + timedelta(days=1)
+        return d
+
+    # 比較に使う日付（2000年以降の各日）
+    dates = [datetime(2000, 1, 1) + timedelta(days=i) for i in range(0, 365 * 20, 7)]
+
+    # 結果の一致を確認
+    get_calendar()
+    for d in dates:
+        assert add_months_legacy(d, 6) == add_months(d, 6, consider_holiday=True), d
+
+    n = 3
+    t_legacy = timeit.timeit(lambda: [add_months_legacy(d, 6) for d in dates], number=n) / (n * len(dates))
+    t_table = timeit.timeit(lambda: [add_months(d, 6, consider_holiday=True) for d in dates], number=n) / (n * len(dates))
+    t_build = timeit.timeit(lambda: BusinessCalendar(CALENDAR_FIRST_YEAR, CALENDAR_LAST_YEAR), number=1)
+    print('add_months(consider_holiday) legacy: %.1f us / call' % (t_legacy * 1e6))
+    print('add_months(consider_holiday) table : %.1f us / call' % (t_table * 1e6))
+    print('calendar build (%d-%d)          : %.1f ms' % (CALENDAR_FIRST_YEAR, CALENDAR_LAST_YEAR, t_build * 1e3))
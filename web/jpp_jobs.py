@@ -0,0 +1,288 @@
+"""
+J-PlatPat の照会ジョブ
+（画面からの照会を JppJobs コレクションに登録し、バックグラウンドのワーカーで実行する）
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+import common_util
+import jp_calendar
+import patent_reference
+import jpp_scheduler
+
+# ロガーの取得
+logger = logging.getLogger(__name__)
+
+# ジョブの状態
+STATUS_QUEUED = 'Queued'
+STATUS_RUNNING = 'Running'
+STATUS_DONE = 'Done'
+STATUS_FAILED = 'Failed'
+
+# ジョブを保持する秒数
+JOB_TTL = 86400
+
+# 実行中のジョブを他のワーカーに渡すまでの秒数（ワーカーが停止した場合）
+LOCK_SECONDS = 600
+
+def resolve_key(db, posted_data, ui_lang, force=False):
+    """
+    照会する権利のキーを決定する
+    :return キー, 失敗時のレスポンス
+    """
+    # キーの取得
+    if 'Id' in posted_data:
+
+        # Idが存在する場合はDBの登録情報を優先して使う
+        id = ObjectId(posted_data['Id'])
+
+        # 手続が進行中の場合は更新不可
+        proc = common_util.under_process(db, id, include_cart=(not force))
+        if proc:
+            return None, {'Result': False, 'Message': ui_lang['Error']['UnderProcess']}
+
+        # 権利の情報を取得
+        p = db.Properties.find_one({'_id': id}, {'RegistrationNumber':1, 'Law':1, 'Country':1})
+
+        # 取得した情報を展開
+        if p:
+            return {
+                'Id': id,
+                'Country': p['Country'],
+                'Law': p['Law'],
+                'NumberType': 'registration',
+                'Number': p['RegistrationNumber'],
+                'Force': force,
+            }, None
+        else:
+            return None, {
+                'Result': False,
+                'Message': ui_lang['Pages']['Property']['JPlatPat']['CannotGetInformation']
+            }
+
+    # Id が指定されていない場合は入力された基本情報を利用する
+
+    # 入力のチェック
+    if not 'Country' in posted_data:
+        return None, {'Result': False, 'Message': 'Country is not selected.'}
+    if not 'Law' in posted_data:
+        return None, {'Result': False, 'Message': 'Law is not selected.'}
+
+    law = posted_data['Law']
+    country = posted_data['Country']
+
+    # 番号の判別
+    if 'RegistrationNumber' in posted_data:
+        num_type = 'registration'
+        num = common_util.regularize_reg_num(country, law, posted_data['RegistrationNumber'])
+    elif 'ApplicationNumber' in posted_data:
+        num_type = 'application'
+        num = common_util.regularize_app_num(country, law, posted_data['ApplicationNumber'])
+    else:
+        return None, {'Result': False, 'Message': 'Missing property number.'}
+
+    return {
+        'Country': country,
+        'Law': law,
+        'NumberType': num_type,
+        'Number': num,
+        'Force': force,
+    }, None
+
+def refer_property(db, key, user_id, ui_lang):
+    """
+    J-PlatPatから知的財産権の情報を取得する（Idが指定されている場合はDBも更新する）
+    """
+    country = key['Country']
+    law = key['Law']
+
+    # 照会待ちの間に手続が始まった場合は更新不可
+    if 'Id' in key:
+        proc = common_util.under_process(db, key['Id'], include_cart=(not key.get('Force', False)))
+        if proc:
+            return {'Result': False, 'Message': ui_lang['Error']['UnderProcess']}
+
+    # 特許情報の検索サービスの照会
+    data, message = patent_reference.refer(country, law, key['Number'], key['NumberType'], ui_lang, priority=jpp_scheduler.PRIORITY_INTERACTIVE)
+
+    # 取得できず
+    if data is None:
+        return {'Result': False, 'Message': message}
+
+    # Idが指定されていた場合はDBも更新する
+    if 'Id' in key and data:
+
+        data['Id'] = key['Id']
+        updated, id, message, is_new = db.update_prop(data, user_id, update_abandonment=True, lang=ui_lang)
+        data['Id'] = str(key['Id'])
+
+        # 次回手続期限の取得
+        p = db.Properties.find_one({'_id': id}, {'NextProcedureLimit':1})
+        if p and 'NextProcedureLimit' in p:
+            data['NextProcedureLimit'] = p['NextProcedureLimit']
+        if p and 'NextProcedureLastLimit' in p:
+            data['NextProcedureLastLimit'] = p['NextProcedureLastLimit']
+
+    else:
+
+        updated = False
+
+        # 次回手続期限の計算
+        if country == 'JP':
+            if 'PaidYears' in data:
+                # 商標は特別
+                if law == 'Trademark':
+                    # 存続期間満了日が設定されていない場合は計算しない
+                    if 'ExpirationDate' in data and data['PaidYears'] <= 10:
+                        data['NextProcedureLimit'] = common_util.add_months(data['ExpirationDate'], -1 * 12 * (10 - data['PaidYears']))
+                    elif 'ExpirationDate' in data:
+                        data['NextProcedureLimit'] = data['ExpirationDate']
+                    # 分割納付でない場合は次回手続の開始日をセットする
+                    if data['PaidYears'] == 10 and 'NextProcedureLimit' in data:
+                        if common_util.in_and_true(data, 'Disappered') or 'DisappearanceDate' in data:
+                            # 消滅している場合は計算しない
+                            pass
+                        if data['NextProcedureLimit'] < jp_calendar.add_months(common_util.get_today(), 6):
+                            # 期限を渡過している場合は計算しない
+                            pass
+                        else:
+                            data['NextProcedureOpenDate'] = common_util.add_months(data['NextProcedureLimit'], -6)
+                    # 追納期限と閉庁日調整
+                    if 'NextProcedureLimit' in data:
+                        data['NextProcedureLastLimit'] = jp_calendar.add_months(data['NextProcedureLimit'], 6, consider_holiday=True)
+                        data['NextProcedureLimit'] = jp_calendar.add_months(data['NextProcedureLimit'], 0, consider_holiday=True)
+                else:
+                    # 登録日が設定されていない場合は計算しない
+                    if 'RegistrationDate' in data:
+                        data['NextProcedureLimit'] = jp_calendar.add_months(data['RegistrationDate'], 12 * data['PaidYears'], consider_holiday=True)
+                        data['NextProcedureLastLimit'] = jp_calendar.add_months(data['RegistrationDate'], (12 * data['PaidYears']) + 6, consider_holiday=True)
+            elif law == 'Trademark':
+                # 納付年数のない商標は更新
+                if 'ExpirationDate' in data:
+                    data['NextProcedureLimit'] = data['ExpirationDate']
+                # 分割納付でない場合は次回手続の開始日をセットする
+                if common_util.in_and_true(data, 'Disappered') or 'DisappearanceDate' in data:
+                    # 消滅している場合は計算しない
+                    pass
+                if data['NextProcedureLimit'] < jp_calendar.add_months(common_util.get_today(), 6):
+                    # 期限を渡過している場合は計算しない
+                    pass
+                else:
+                    data['NextProcedureOpenDate'] = common_util.add_months(data['NextProcedureLimit'], -6)
+                # 追納期限と閉庁日調整
+                if 'NextProcedureLimit' in data:
+                    data['NextProcedureLastLimit'] = jp_calendar.add_months(data['NextProcedureLimit'], 6, consider_holiday=True)
+                    data['NextProcedureLimit'] = jp_calendar.add_months(data['NextProcedureLimit'], 0, consider_holiday=True)
+
+    # レスポンスの生成
+    res = {
+        'Result': True,
+        'Data': data,
+        'Updated': updated,
+    }
+    return res
+
+def enqueue(db, key, user_id, lang_name):
+    """
+    照会ジョブを登録する
+    （同じ利用者の同じ権利のジョブが待機中・実行中の場合は、そのジョブを使う）
+    :return ジョブのId
+    """
+    now = datetime.now()
+
+    # 同じ照会の重複を避ける
+    job = db.JppJobs.find_one_and_update({
+        'User': user_id,
+        'Key': key,
+        'Lang': lang_name,
+        'Status': {'$in': [STATUS_QUEUED, STATUS_RUNNING]},
+    }, {
+        '$setOnInsert': {
+            'Status': STATUS_QUEUED,
+            'RequestedTime': now,
+            'ExpireAt': now + timedelta(seconds=JOB_TTL),
+        },
+    }, upsert=True, return_document=ReturnDocument.AFTER, projection={'_id': 1})
+
+    return job['_id']
+
+def get_job(db, job_id, user_id):
+    """
+    照会ジョブの状態を取得する（登録した利用者のもののみ）
+    """
+    try:
+        job_id = ObjectId(job_id)
+    except Exception:
+        return None
+    return db.JppJobs.find_one({'_id': job_id, 'User': user_id})
+
+def job_response(job, ui_lang):
+    """
+    照会ジョブの状態を画面に返す形式にする
+    （完了している場合は同期で照会した場合と同じ形式）
+    """
+    if job is None:
+        return {'Result': False, 'Status': STATUS_FAILED, 'Message': ui_lang['Pages']['Property']['JPlatPat']['CannotGetInformation']}
+
+    if job['Status'] in (STATUS_DONE, STATUS_FAILED,):
+        res = dict(job['Response'])
+        res['Status'] = job['Status']
+        return res
+
+    return {
+        'Result': True,
+        'Status': job['Status'],
+        'JobId': str(job['_id']),
+        'WaitSeconds': (datetime.now() - job['RequestedTime']).total_seconds(),
+    }
+
+def claim_job(db, worker):
+    """
+    待機中のジョブ（または停止したワーカーの実行中のジョブ）を1件取り出す
+    """
+    now = datetime.now()
+    return db.JppJobs.find_one_and_update({
+        '$or': [
+            {'Status': STATUS_QUEUED},
+            {'Status': STATUS_RUNNING, 'LockedUntil': {'$lt': now}},
+        ],
+    }, {
+        '$set': {
+            'Status': STATUS_RUNNING,
+            'StartedTime': now,
+            'LockedUntil': now + timedelta(seconds=LOCK_SECONDS),
+            'Worker': worker,
+        },
+        '$inc': {'Attempts': 1},
+    }, sort=[('RequestedTime', 1)], return_document=ReturnDocument.AFTER)
+
+def finish_job(db, job, response):
+    """
+    ジョブの結果を保存する
+    """
+    now = datetime.now()
+    db.JppJobs.update_one({'_id': job['_id']}, {
+        '$set': {
+            'Status': STATUS_DONE if response.get('Result', False) else STATUS_FAILED,
+            'Response': response,
+            'FinishedTime': now,
+            'ExpireAt': now + timedelta(seconds=JOB_TTL),
+        },
+        '$unset': {'LockedUntil': ''},
+    })
+
+def run_job(db, job, ui_lang):
+    """
+    ジョブを実行して結果を保存する
+    """
+    try:
+        response = refer_property(db, job['Key'], job['User'], ui_lang)
+    except Exception:
+        logger.exception('jpp job %s is failed.', job['_id'])
+        response = {'Result': False, 'Message': ui_lang['Pages']['Property']['JPlatPat']['CannotGetInformation']}
+    finish_job(db, job, response)
+    return response
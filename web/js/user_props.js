@@ -513,6 +513,30 @@ function onAbandonButtonClicked(e) {
 }
 
 
+/**
+ * 特許庁DBの照会ジョブの完了を待つ
+ * （登録直後のレスポンスが待機中・実行中の場合は、状態を定期的に確認する）
+ */
+function waitForReferJob(url, data) {
+    let d = $.Deferred();
+    let poll = (data) => {
+        if (data.Status == "Queued" || data.Status == "Running") {
+            setTimeout(() => {
+                $.ajax({
+                    url: url, type: 'POST', dataType: 'json',
+                    data: { JobId: data.JobId }
+                })
+                    .done(poll)
+                    .fail(d.reject);
+            }, 2000);
+        } else {
+            d.resolve(data);
+        }
+    };
+    poll(data);
+    return d.promise();
+}
+
 /**
  * ダイアログでのメッセージの表示
  */
@@ -877,6 +901,7 @@ $(window).on("load", e => {
             url: '/props/api/refer', type: 'POST', dataType: 'json',
             data: q
         })
+            .then(data => waitForReferJob('/props/api/refer/status', data))
             .done(data => {
 
                 // 結果の確認
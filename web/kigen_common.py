@@ -4,6 +4,9 @@
 
 from bottle import request
 from datetime import datetime
+import math
+
+import common_util
 
 def get_page_paramegers():
     """
@@ -37,33 +40,215 @@ def get_page_paramegers():
     # 決定したパラメーターを返す
     return page, sort, dire
 
-def sort_properties(props, sort_key, sort_direction):
+def _sort_key_expr(sort_key, sort_direction, missing_text):
     """
-    指定条件に従ってリストを並べ替える
+    並べ替えキーを計算する式
     """
     if sort_key == 'n':
         # 次回納付期限
-        props = sorted(props, key=lambda x: x['NextProcedureLimit'] if 'NextProcedureLimit' in x else (datetime.min if (sort_direction == 'd') else datetime.max), reverse=(sort_direction == 'd'))
+        return {'$ifNull': ['$NextProcedureLimit', datetime.min if (sort_direction == 'd') else datetime.max]}
     elif sort_key == 'r':
         # 登録番号
-        props = sorted(props, key=lambda x: x['RegistrationNumber'] if 'RegistrationNumber' in x else '\U00010FFFF', reverse=(sort_direction == 'd'))
+        return {'$ifNull': ['$RegistrationNumber', missing_text]}
     elif sort_key == 'm':
         # 整理番号
-        props = sorted(props, key=lambda x: x['ManagementNumber'] if 'ManagementNumber' in x else '\U00010FFFF', reverse=(sort_direction == 'd'))
+        return {'$ifNull': ['$ManagementNumber', '\U00010FFFF']}
     elif sort_key == 'h':
         # 権利者
-        def first_holder(x):
-            if 'Holders' in x:
-                return x['Holders'][0]
-            return '\U00010FFFF'
-        props = sorted(props, key=lambda x: first_holder(x), reverse=(sort_direction == 'd'))
+        return {'$let': {
+            'vars': {'hs': {'$filter': {
+                'input': {'$cond': [{'$isArray': '$Holders'}, '$Holders', []]},
+                'as': 'h',
+                'cond': {'$ne': [{'$type': '$$h.Name'}, 'missing']},
+            }}},
+            'in': {'$ifNull': [{'$arrayElemAt': ['$$hs.Name', 0]}, '\U00010FFFF']},
+        }}
     elif sort_key == 'u':
         # ユーザー
-        def user_name(x):
-            if 'UserOrganization' in x:
-                return x['UserOrganization']
-            if 'UserName' in x:
-                return '\U00010FFFF' + x['UserName']
-            return '\U00010FFFF' * 2
-        props = sorted(props, key=lambda x: user_name(x), reverse=(sort_direction == 'd'))
-    return props
+        return {'$cond': [
+            {'$ne': [{'$ifNull': ['$UserOrganization', None]}, None]},
+            '$UserOrganization',
+            {'$concat': ['\U00010FFFF', {'$ifNull': ['$UserName', '\U00010FFFF']}]},
+        ]}
+    return None
+
+def _display_stages(staff):
+    """
+    表示用の項目を計算するステージ
+    """
+    def exists(field):
+        return {'$ne': [{'$type': field}, 'missing']}
+
+    # 直近の依頼は、申込人が未設定か申込日がある場合のみ参照する
+    need_reqs = {'$or': [{'$not': [exists('$UserName')]}, exists('$RegisteredTime')]}
+
+    fields = {
+        'Country': 1,
+        'Law': 1,
+        'RegistrationNumber': 1,
+        'Subject': 1,
+        'NextProcedureLimit': 1,
+        'CountryDescription': 1,
+        'Silent': {'$ifNull': ['$Silent', False]},
+        'SilentTime': {'$cond': [exists('$Silent'), '$SilentTime', '$$REMOVE']},
+        # 申込日
+        'RegisteredTime': {'$ifNull': [
+            '$RegisteredTime',
+            {'$ifNull': [{'$cond': [need_reqs, '$_Req1.RequestedTime', None]}, '$ModifiedTime']},
+        ]},
+        # メールアドレス
+        'MailAddress': '$_User.MailAddress',
+        # 申込人（権利 → 直近の依頼 → ユーザーの順）
+        'UserName': {'$switch': {
+            'branches': [
+                {'case': exists('$UserName'), 'then': '$UserName'},
+                {'case': {'$and': [need_reqs, exists('$_Req2.UserName')]}, 'then': '$_Req2.UserName'},
+            ],
+            'default': '$_User.Name',
+        }},
+        'UserOrganization': {'$switch': {
+            'branches': [
+                {'case': exists('$UserName'), 'then': {'$ifNull': ['$Organization', '$UserOrganization']}},
+                {'case': {'$and': [need_reqs, exists('$_Req2.UserName')]}, 'then': {'$ifNull': ['$_Req2.UserOrganization', '$_Req2.Organization']}},
+            ],
+            'default': '$_User.Organization',
+        }},
+        # 権利者
+        'Holders': {'$let': {
+            'vars': {'names': {'$map': {
+                'input': {'$filter': {
+                    'input': {'$cond': [{'$isArray': '$Holders'}, '$Holders', []]},
+                    'as': 'h',
+                    'cond': exists('$$h.Name'),
+                }},
+                'as': 'h',
+                'in': '$$h.Name',
+            }}},
+            'in': {'$cond': [{'$gt': [{'$size': '$$names'}, 0]}, '$$names', '$$REMOVE']},
+        }},
+    }
+    if staff:
+        fields['NotifiedDates'] = 1
+        fields['Memo'] = 1
+    else:
+        fields['ManagementNumber'] = 1
+
+    return [
+        {'$project': fields},
+    ]
+
+def _requests_lookup(order=None):
+    """
+    最初と最後の依頼（_Req1, _Req2）を結合するステージ
+    （Properties.Property のインデックスで結合し、必要な項目だけを残して権利ごとにまとめ直す）
+    order: まとめ直した後の並び順（$sort の指定、省略時は並べ替えない）
+    """
+    stages = [
+        {'$lookup': {'from': 'Requests', 'localField': '_id', 'foreignField': 'Properties.Property', 'as': '_Req'}},
+        # $lookup の直後の $unwind は結合と同時に行われるため、依頼の全体（添付ファイルを含む）を配列にまとめない
+        {'$unwind': {'path': '$_Req', 'preserveNullAndEmptyArrays': True}},
+        {'$addFields': {'_Req': {
+            'RequestedTime': '$_Req.RequestedTime',
+            'UserName': '$_Req.UserName',
+            'UserOrganization': '$_Req.UserOrganization',
+            'Organization': '$_Req.Organization',
+        }}},
+        {'$sort': {'_id': 1, '_Req.RequestedTime': 1}},
+        {'$group': {
+            '_id': '$_id',
+            '_Doc': {'$first': '$$ROOT'},
+            '_Req1': {'$first': '$_Req'},
+            '_Req2': {'$last': '$_Req'},
+        }},
+        {'$addFields': {'_Doc._Req1': '$_Req1', '_Doc._Req2': '$_Req2'}},
+        {'$replaceRoot': {'newRoot': '$_Doc'}},
+    ]
+    if not order is None:
+        stages.append({'$sort': order})
+    return stages
+
+def query_page(db, lang, query, page, sort_key, sort_direction, page_size=500, staff=False):
+    """
+    期限管理リストの1ページ分を集計で取得する
+    :return 1:リスト, 2:最大ページ, 3:ページ番号(1-based)
+    """
+    # 並べ替え
+    missing_text = '熙熙熙' if staff else '\U00010FFFF'
+    order = -1 if sort_direction == 'd' else 1
+    sort_expr = _sort_key_expr(sort_key, sort_direction, missing_text)
+
+    # 権利とユーザーの結合（ユーザーが存在しないものは除外）
+    pipeline = [
+        {'$match': query},
+        {'$lookup': {'from': 'Users', 'localField': 'User', 'foreignField': '_id', 'as': '_User'}},
+        {'$match': {'_User.0': {'$exists': True}}},
+        {'$addFields': {'_User': {'$arrayElemAt': ['$_User', 0]}}},
+    ]
+
+    # 並べ替えとページ分割
+    # ※ユーザー順は依頼からの申込人に依存するため、並べ替えの前に依頼を結合する
+    sort_spec = {'_Sort': order, '_id': 1} if not sort_expr is None else {'_id': 1}
+    if sort_key == 'u':
+        pipeline.extend(_requests_lookup())
+        pipeline.extend(_display_stages(staff))
+        page_stages = []
+    else:
+        # 依頼の結合で崩れたページ内の順序は並べ直す
+        page_stages = _requests_lookup(sort_spec) + _display_stages(staff)
+    if not sort_expr is None:
+        pipeline.append({'$addFields': {'_Sort': sort_expr}})
+    pipeline.append({'$sort': sort_spec})
+
+    def run(p):
+        facet = {'$facet': {
+            'Total': [{'$count': 'Count'},],
+            'Rows': [{'$skip': page_size * (p - 1)}, {'$limit': page_size},] + page_stages,
+        }}
+        res = next(db.Properties.aggregate(pipeline + [facet,], allowDiskUse=True))
+        total = res['Total'][0]['Count'] if len(res['Total']) > 0 else 0
+        return res['Rows'], total
+
+    # 取得（範囲外のページの場合は補正して取得し直す）
+    page = max(1, int(page))
+    rows, total = run(page)
+    p_max = max(1, int(math.floor((total - 1) / page_size)) + 1)
+    if page > p_max:
+        page = p_max
+        rows, total = run(page)
+
+    # 表示用に編集
+    props = []
+    for row in rows:
+        prop = {'_id': str(row['_id'])}
+        for key in row:
+            if key != '_id' and not key.startswith('_') and not row[key] is None:
+                prop[key] = row[key]
+
+        if row['Country'] == 'UNK':
+            prop['CountryDescription'] = row['CountryDescription']
+        else:
+            prop['CountryDescription'] = lang['Country'][row['Country']]
+        prop['LawName'] = lang['Law'][row['Law']]
+
+        # 通知日
+        if 'NotifiedDates' in prop:
+            nds = prop['NotifiedDates']
+            del prop['NotifiedDates']
+            if 'NextProcedureLimit' in prop:
+                d = common_util.add_months(prop['NextProcedureLimit'], -7)
+                nds = [x for x in nds if x['Date'] > d]
+                nds = sorted(nds, key=lambda x: x['Date'])
+                for x in nds:
+                    if x['Timing'] == 'm6':
+                        prop['NotifiedM6'] = x['Date']
+                    elif x['Timing'] == 'm3':
+                        prop['NotifiedM3'] = x['Date']
+                    elif x['Timing'] == 'm1':
+                        prop['NotifiedM1'] = x['Date']
+                    elif x['Timing'] == 'd10':
+                        prop['NotifiedD10'] = x['Date']
+
+        props.append(prop)
+
+    # 結果を返す
+    return props, p_max, page
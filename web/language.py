@@ -2,58 +2,80 @@ import json
 from pathlib import Path
 import logging
 import io
+import os
 import re
+import threading
+from collections.abc import Mapping
+
+from local_config import Config
 
 logger = logging.getLogger(__name__)
 
 class Dictionary(object):
     """
     表示定義を扱う階層化された辞書
+    （構築時に子の辞書・文字列をすべて生成し、参照時は表を引くだけにする）
     """
 
-    def __init__(self, d, path='', name='no name'):
+    __slots__ = ('__d', '__p', '__name', '__flat',)
+
+    def __init__(self, d, path='', name='no name', flat=None):
         """
         コンストラクター
         """
-        if not isinstance(d, dict):
+        if not isinstance(d, Mapping):
             raise ValueError()
-        self.__d = d
         self.__p = path
         self.__name = name
 
+        # ドット区切りのキーによる表（言語ごとに全階層で共有する）
+        self.__flat = {} if flat is None else flat
+
+        # 子エントリーの生成
+        entries = {}
+        for key, x in d.items():
+            full_key = path + '.' + key if path else key
+            if isinstance(x, Mapping):
+                x = Dictionary(x, path=full_key, name=name, flat=self.__flat)
+            elif isinstance(x, (list, tuple,)):
+                # リストの場合は改行で結合する
+                x = '\n'.join(x)
+            else:
+                # 文字列型にする
+                x = str(x)
+            entries[key] = x
+            self.__flat[full_key] = x
+        self.__d = entries
+
     def __getitem__(self, key):
         """
         ローカライズされたテキストの取得
         """
-        p = '%s.%s' % (self.__p, key)
-        if not key in self.__d:
-            raise KeyError('%s is not defined at language file.' % p)
-        x = self.__d[key]
+        x = self.__d.get(key)
+        if x is None:
+            raise KeyError('%s is not defined at language file.' % ('%s.%s' % (self.__p, key)))
+        return x
 
-        # 子エントリーを返す
-        if isinstance(x, dict):
-            return Dictionary(x, path=(self.__p + '.' + key if self.__p else key), name=self.name)
-
-        # リストの場合は改行で結合する
-        if isinstance(x, list):
-            return '\n'.join(x)
-
-        # 文字列型を返す
-        return str(x)
-    
     def __contains__(self, item):
         """
         包含判定
         """
         return item in self.__d
-        
+
+    def lookup(self, path, default=None):
+        """
+        ドット区切りのキーで取得する（例: 'Pages.Request.TEXT000122'）
+        """
+        if self.__p:
+            path = self.__p + '.' + path
+        return self.__flat.get(path, default)
+
     def __str__(self):
         """
         文字列表現
         """
         t = ""
-        for key in self.__d.keys():
-            child = self[key]
+        for key, child in self.__d.items():
             if isinstance(child, Dictionary):
                 t += str(child) + "\n"
             else:
@@ -136,20 +158,35 @@ class Dictionary(object):
 
             return buff.getvalue()
 
-def get_dictionary(lang='ja'):
+# 読み込み済みの辞書（言語コード → (ファイルの更新日時, 辞書)）
+_cache = {}
+_cache_lock = threading.Lock()
+
+# 言語ファイルの場所
+_lang_dir = str(Path(__file__).parent / 'lang')
+
+def _files(lang):
     """
-    辞書の取得
+    言語ファイルのパスのリスト
     """
-    # 言語ファイルの場所
-    d = Path(__file__).parent / 'lang'
+    files = [os.path.join(_lang_dir, 'ja.json'),]
+    if lang != 'ja':
+        files.append(os.path.join(_lang_dir, '%s.json' % lang))
+    return files
+
+def _load(lang):
+    """
+    言語ファイルを読み込んで辞書を構成する
+    """
+    files = _files(lang)
 
     # 日本語の設定ファイルを読み込む
-    with open(str(d / 'ja.json'), 'r', encoding='utf-8') as f:
+    with open(files[0], 'r', encoding='utf-8') as f:
         ja = json.load(f)
 
     # 指定言語のファイルを開く
-    if lang != 'ja':
-        with open(str(d / ('%s.json' % lang)), 'r', encoding='utf-8') as f:
+    if len(files) > 1:
+        with open(files[1], 'r', encoding='utf-8') as f:
             d = json.load(f)
             # 日本語設定を上書き
             ja.update(d)
@@ -157,6 +194,54 @@ def get_dictionary(lang='ja'):
     # 辞書を構成して返す
     return Dictionary(ja, name=lang)
 
+def get_dictionary(lang='ja'):
+    """
+    辞書の取得
+    （言語ファイルが更新されるまでは読み込み済みの辞書を共有する）
+    """
+    # ファイルの更新日時
+    stamp = tuple([os.stat(x).st_mtime_ns for x in _files(lang)])
+
+    cached = _cache.get(lang)
+    if not cached is None and cached[0] == stamp:
+        return cached[1]
+
+    with _cache_lock:
+        cached = _cache.get(lang)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, _load(lang))
+            _cache[lang] = cached
+        return cached[1]
+
+def preload(langs=('ja',)):
+    """
+    辞書を事前に読み込んでおく
+    """
+    for lang in langs:
+        get_dictionary(lang)
+
+# 設定で指定された言語を事前に読み込む
+_config = Config()
+if _config.has_section('web') and _config['web'].get('lang_preload', '').strip() != '':
+    preload([x.strip() for x in _config['web']['lang_preload'].split(',') if x.strip() != ''])
+
 if __name__ == '__main__':
-    d = get_dictionary('ja')
-    print(d.mail_footer())
+    import sys
+    import timeit
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    # 1リクエストで辞書を取得する費用のベンチマーク
+    t_load = timeit.timeit(lambda: _load('ja'), number=n) / n
+    get_dictionary('ja')
+    t_cache = timeit.timeit(lambda: get_dictionary('ja'), number=n) / n
+    print('load every time: %.1f us / call' % (t_load * 1e6))
+    print('cached         : %.1f us / call' % (t_cache * 1e6))
+
+    # 参照の費用のベンチマーク
+    lang = get_dictionary('ja')
+    m = n * 100
+    t_chain = timeit.timeit(lambda: lang['Pages']['Request']['TEXT000122'], number=m) / m
+    t_flat = timeit.timeit(lambda: lang.lookup('Pages.Request.TEXT000122'), number=m) / m
+    print('chained lookup : %.3f us / lookup' % (t_chain * 1e6))
+    print('dotted lookup  : %.3f us / lookup' % (t_flat * 1e6))
@@ -0,0 +1,458 @@
+"""
+次回手続期限の計算
+（データベースに依存しない計算部分と、NumPy による一括計算）
+"""
+
+import logging
+from datetime import datetime
+import numpy as np
+
+import common_util
+import jp_calendar
+
+# ログの初期設定
+logger = logging.getLogger(__name__)
+
+# 期限の項目
+LIMIT_FIELDS = ('NextProcedureLimit', 'NextProcedureLastLimit', 'NextProcedureOpenDate',)
+
+def select_last_request(reqs, prop_id):
+    """
+    完了済の依頼のうち最後のものと、その中の対象の権利の情報を取得する
+    """
+    reqs = sorted(reqs, key=lambda x: x['RequestedTime'])
+    if len(reqs) < 1:
+        return None, None
+    req = reqs[-1]
+    req_p = [x for x in req['Properties'] if x['Property'] == prop_id][0]
+    return req, req_p
+
+def resolve_paid_years(prop, req=None, req_p=None):
+    """
+    最後の依頼を考慮して納付済年分と存続期間満了日を決定する
+    :return 1:納付済年分, 2:存続期間満了日（無い場合は None）
+    """
+    # 納付済年分を取得する
+    if 'PaidYears' in prop:
+        y = prop['PaidYears']
+    else:
+        y = 0
+
+    exp = prop['ExpirationDate'] if 'ExpirationDate' in prop else None
+
+    if req is None:
+        return y, exp
+
+    # 納付済年分の調整
+    if prop['Law'] == 'Trademark':
+
+        # 商標は存続期間満了日を基準に直近の納付手続か否かを判定する
+        if not exp is None:
+            if req_p['PaidYears'] == 5:
+                # 分納後期 -> 満了日の11年前より後なら直近の納付とみなす
+                if req_p['CompletedTime'] > common_util.add_months(exp, -11 * 12):
+                    # 完納済
+                    logger.info('changing PaidYears %d -> %d by completed request %s', y, 10, req['_id'])
+                    y = 10
+            else:
+                # 満了日の12月前より後なら直近の更新とみなす
+                if req_p['CompletedTime'] > common_util.add_months(exp, -12):
+                    logger.info('changing PaidYears %d -> %d by completed request %s', y, req_p['Years'], req['_id'])
+                    next_exp = common_util.add_months(exp, 10 * 12)
+                    logger.info('changing ExpirationDate %s -> %s by completed request %s', exp, next_exp, req['_id'])
+                    # 納付年数
+                    y = req_p['Years']
+                    # 次の存続期間満了日
+                    exp = next_exp
+
+    else:
+
+        # 商標以外は単純に納付済年分を置き換える
+        if 'YearTo' in req_p:
+            y2 = req_p['YearTo']
+        else:
+            assert req_p['Years'] == 1
+            y2 = req_p['YearFrom']
+
+        if y2 > y:
+            logger.info('changing PaidYears %d -> %d by completed request %s', y, y2, req['_id'])
+            y = y2
+
+    return y, exp
+
+def compute_limit_dates(prop, req=None, req_p=None):
+    """
+    知的財産権の次回庁期限を計算し、更新クエリーを生成する
+    （更新が不要な場合は空の辞書を返す）
+    """
+    y, exp = resolve_paid_years(prop, req, req_p)
+
+    # 更新クエリーの生成
+    query = {'$set': {}, '$unset': {}}
+
+    if prop['Country'] == 'JP' and prop['Law'] == 'Trademark':
+
+        # 日本の商標
+
+        # 存続期間満了日が設定されていない場合は計算しない
+        if not exp is None:
+
+            # 存続期間満了日から分納分を差し引いた日を次の期限とする
+            if y <= 10:
+                query['$set']['NextProcedureLimit'] = common_util.add_months(exp, -1 * 12 * (10 - y))
+            else:
+                query['$set']['NextProcedureLimit'] = jp_calendar.add_months(exp, 0, consider_holiday=False)
+
+            if 'NextProcedureLimit' in query['$set']:
+                query['$set']['NextProcedureOpenDate'] = jp_calendar.add_months(query['$set']['NextProcedureLimit'], -6, consider_holiday=False)
+                query['$set']['NextProcedureLastLimit'] = jp_calendar.add_months(query['$set']['NextProcedureLimit'], 6, consider_holiday=True)
+                # 閉庁日調整
+                query['$set']['NextProcedureLimit'] = jp_calendar.add_months(query['$set']['NextProcedureLimit'], 0, consider_holiday=True)
+
+    else:
+
+        # 通常の計算
+
+        # 登録日が設定されていない場合は計算しない
+        if 'RegistrationDate' in prop:
+
+            # 次回庁期限の計算
+            if prop['Country'] == 'JP':
+                query['$set']['NextProcedureLimit'] = jp_calendar.add_months(prop['RegistrationDate'], 12 * y, consider_holiday=True)
+            else:
+                query['$set']['NextProcedureLimit'] = common_util.add_months(prop['RegistrationDate'], 12 * y)
+
+            # 追納期間の計算
+            if prop['Country'] == 'JP':
+                query['$set']['NextProcedureLastLimit'] = jp_calendar.add_months(prop['RegistrationDate'], (12 * y) + 6, consider_holiday=True)
+
+    # 計算した次回期限が存続期間を超える場合は期限日を消す
+    if 'NextProcedureLimit' in query['$set'] and not exp is None:
+        if query['$set']['NextProcedureLimit'] > exp and prop['Law'] != 'Trademark':
+            del query['$set']['NextProcedureLimit']
+            query['$unset']['NextProcedureLimit'] = ''
+
+    # 消滅しているのに次回期限があったら消す
+    if 'NextProcedureLimit' in query['$set'] and common_util.in_and_true(prop, 'Disappered'):
+        del query['$set']['NextProcedureLimit']
+        query['$unset']['NextProcedureLimit'] = ''
+
+    if 'NextProcedureLastLimit' in query['$set'] and not 'NextProcedureLimit' in query['$set']:
+        del query['$set']['NextProcedureLastLimit']
+        query['$unset']['NextProcedureLastLimit'] = ''
+    if not 'NextProcedureLastLimit' in query['$set'] and 'NextProcedureLimit' in query['$set']:
+        query['$set']['NextProcedureLastLimit'] = query['$set']['NextProcedureLimit']
+    else:
+        query['$unset']['NextProcedureLastLimit'] = ''
+
+    # $set に次回期限が無ければ、$unset に入れる
+    if not 'NextProcedureLimit' in query['$set']:
+        query['$unset']['NextProcedureLimit'] = ''
+        query['$unset']['NextProcedureOpenDate'] = ''
+        query['$unset']['NextProcedureLastLimit'] = ''
+
+    # $set にあるキーを $unset から消す
+    for key in query['$set'].keys():
+        if key in query['$unset']:
+            del query['$unset'][key]
+
+    if len(query['$set']) == 0:
+        del query['$set']
+    if len(query['$unset']) == 0:
+        del query['$unset']
+
+    return query
+
+def changed_fields(prop, query):
+    """
+    更新クエリーによって値が変わる期限の項目を取得する
+    """
+    fields = []
+    for key in LIMIT_FIELDS:
+        if '$set' in query and key in query['$set']:
+            if not key in prop or prop[key] != query['$set'][key]:
+                fields.append(key)
+        elif '$unset' in query and key in query['$unset']:
+            if key in prop:
+                fields.append(key)
+    return fields
+
+# 営業日の表（NumPy 配列）
+_table = None
+
+def _business_table():
+    """
+    営業日の表を NumPy の配列として取得する
+    :return 1:表の最初の日, 2:各日以降で最初の営業日の位置
+    """
+    global _table
+    if _table is None:
+        cal = jp_calendar.get_calendar()
+        _table = (np.datetime64(cal.origin.date(), 'D'), np.asarray(cal.next_offsets, dtype='int64'))
+    return _table
+
+# datetime64[D] の 0 に対応する日の序数と、NaT の内部表現
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+_NAT = np.iinfo(np.int64).min
+
+def to_datetime64(values):
+    """
+    日時のリストを日単位の datetime64 の配列に変換する（None は NaT）
+    """
+    return np.array([_NAT if x is None else x.toordinal() - _EPOCH_ORDINAL for x in values], dtype='int64').astype('datetime64[D]')
+
+def to_datetime_list(days):
+    """
+    datetime64[D] の配列を datetime のリストに変換する（NaT は None）
+    """
+    return [None if x == _NAT else datetime.fromordinal(x + _EPOCH_ORDINAL) for x in days.astype('int64').tolist()]
+
+def to_datetime(value):
+    """
+    datetime64 の値を datetime に変換する（NaT は None）
+    """
+    if np.isnat(value):
+        return None
+    return datetime.fromordinal(int(value.astype('datetime64[D]').astype('int64')) + _EPOCH_ORDINAL)
+
+def add_months_array(days, months):
+    """
+    日付の配列に対して月を加算する
+    （jp_calendar.add_months と同様に、対応する日がない場合は末日とする）
+    """
+    first = days.astype('datetime64[M]')
+    offset = days - first.astype('datetime64[D]')
+    target = first + np.asarray(months, dtype='int64').astype('timedelta64[M]')
+    start = target.astype('datetime64[D]')
+    length = (target + 1).astype('datetime64[D]') - start
+    return start + np.minimum(offset, length - 1)
+
+def next_business_day_array(days):
+    """
+    日付の配列について、各日以降（当日を含む）で最初の営業日を取得する
+    """
+    origin, nexts = _business_table()
+    res = days.copy()
+    valid = ~np.isnat(days)
+
+    # 表の範囲内は表を引く
+    idx = np.where(valid, days - origin, np.timedelta64(-1, 'D')).astype('int64')
+    pos = np.nonzero(valid & (idx >= 0) & (idx < len(nexts)))[0]
+    found = nexts[idx[pos]]
+    ok = found >= 0
+    res[pos[ok]] = origin + found[ok].astype('timedelta64[D]')
+
+    # 範囲外は1件ずつ計算する
+    rest = valid.copy()
+    rest[pos[ok]] = False
+    for i in np.nonzero(rest)[0]:
+        d = jp_calendar.next_business_day(to_datetime(days[i]))
+        res[i] = np.datetime64(d.date(), 'D')
+
+    return res
+
+def compute_limit_arrays(is_jp, is_trademark, registration, expiration, paid_years, disappeared=None):
+    """
+    次回期限をまとめて計算する
+    registration, expiration は datetime64[D] の配列（無い場合は NaT）
+    paid_years は resolve_paid_years で決定した納付済年分
+    :return 期限の項目ごとの datetime64[D] の配列
+            NaT は削除を表す（ただし NextProcedureOpenDate は、
+            NextProcedureLimit がある場合は変更しないことを表す）
+    """
+    is_jp = np.asarray(is_jp, dtype=bool)
+    is_trademark = np.asarray(is_trademark, dtype=bool)
+    y = np.asarray(paid_years, dtype='int64')
+    size = len(y)
+    if disappeared is None:
+        disappeared = np.zeros(size, dtype=bool)
+    else:
+        disappeared = np.asarray(disappeared, dtype=bool)
+
+    limit = np.full(size, np.datetime64('NaT'), dtype='datetime64[D]')
+    last_limit = limit.copy()
+    open_date = limit.copy()
+
+    # 日本の商標（存続期間満了日から分納分を差し引いた日）
+    s = np.nonzero(is_jp & is_trademark & ~np.isnat(expiration))[0]
+    if len(s) > 0:
+        base = add_months_array(expiration[s], np.where(y[s] <= 10, -12 * (10 - y[s]), 0))
+        open_date[s] = add_months_array(base, np.full(len(s), -6))
+        last_limit[s] = next_business_day_array(add_months_array(base, np.full(len(s), 6)))
+        limit[s] = next_business_day_array(base)
+
+    # 通常の計算（登録日から納付済年分）
+    s = np.nonzero(~(is_jp & is_trademark) & ~np.isnat(registration))[0]
+    if len(s) > 0:
+        limit[s] = add_months_array(registration[s], 12 * y[s])
+        j = s[is_jp[s]]
+        if len(j) > 0:
+            limit[j] = next_business_day_array(limit[j])
+            last_limit[j] = next_business_day_array(add_months_array(registration[j], 12 * y[j] + 6))
+
+    # 存続期間を超える場合と、消滅している場合は期限日を消す
+    has_limit = ~np.isnat(limit)
+    over = has_limit & ~np.isnat(expiration) & ~is_trademark
+    over[over] = limit[over] > expiration[over]
+    drop = over | (has_limit & disappeared)
+    limit[drop] = np.datetime64('NaT')
+
+    # 追納期限は次回期限に合わせる
+    no_limit = np.isnat(limit)
+    last_limit[no_limit] = np.datetime64('NaT')
+    fill = ~no_limit & np.isnat(last_limit)
+    last_limit[fill] = limit[fill]
+
+    return {
+        'NextProcedureLimit': limit,
+        'NextProcedureLastLimit': last_limit,
+        'NextProcedureOpenDate': open_date,
+    }
+
+def make_update(limit, last_limit, open_date):
+    """
+    一括計算の結果（1件分、datetime または None）から更新クエリーを生成する
+    """
+    if limit is None:
+        if open_date is None:
+            return {'$unset': dict([(x, '') for x in LIMIT_FIELDS])}
+        return {
+            '$set': {'NextProcedureOpenDate': open_date},
+            '$unset': {'NextProcedureLimit': '', 'NextProcedureLastLimit': ''},
+        }
+    query = {'$set': {
+        'NextProcedureLimit': limit,
+        'NextProcedureLastLimit': last_limit,
+    }}
+    if not open_date is None:
+        query['$set']['NextProcedureOpenDate'] = open_date
+    return query
+
+def compute_limit_dates_batch(props, last_requests=None):
+    """
+    複数の知的財産権の次回庁期限をまとめて計算し、更新クエリーのリストを返す
+    last_requests には権利のIDから (依頼, 依頼中の権利の情報) への辞書を渡す
+    """
+    if last_requests is None:
+        last_requests = {}
+
+    # 納付済年分と存続期間満了日を決定する
+    years = []
+    exps = []
+    for prop in props:
+        req, req_p = last_requests[prop['_id']] if prop['_id'] in last_requests else (None, None)
+        y, exp = resolve_paid_years(prop, req, req_p)
+        years.append(y)
+        exps.append(exp)
+
+    # 配列にまとめて計算する
+    res = compute_limit_arrays(
+        [x['Country'] == 'JP' for x in props],
+        [x['Law'] == 'Trademark' for x in props],
+        to_datetime64([x['RegistrationDate'] if 'RegistrationDate' in x else None for x in props]),
+        to_datetime64(exps),
+        years,
+        [common_util.in_and_true(x, 'Disappered') for x in props],
+    )
+
+    # 更新クエリーに変換する
+    return [make_update(*x) for x in zip(
+        to_datetime_list(res['NextProcedureLimit']),
+        to_datetime_list(res['NextProcedureLastLimit']),
+        to_datetime_list(res['NextProcedureOpenDate']),
+    )]
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import time
+    from datetime import timedelta
+
+    # 合成したポートフォリオで、1件ずつの計算と一括計算の結果を比較する
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rnd = random.Random(12345)
+
+    def random_date(first_year, last_year):
+        d = datetime(first_year, 1, 1) + timedelta(days=rnd.randrange((last_year - first_year + 1) * 365))
+        if rnd.random() < 0.1:
+            d = d + timedelta(hours=rnd.randrange(24))
+        return d
+
+    props = []
+    last_requests = {}
+    for i in range(size):
+        prop = {
+            '_id': i,
+            'Country': rnd.choice(['JP', 'JP', 'JP', 'US', 'EP']),
+            'Law': rnd.choice(['Patent', 'Utility', 'Design', 'Trademark']),
+        }
+        if rnd.random() < 0.9:
+            prop['RegistrationDate'] = random_date(1970, 2095)
+        if rnd.random() < 0.8:
+            prop['ExpirationDate'] = random_date(1975, 2099)
+        if rnd.random() < 0.9:
+            prop['PaidYears'] = rnd.randrange(0, 21)
+        if rnd.random() < 0.05:
+            prop['Disappered'] = True
+        props.append(prop)
+
+        # 完了済の依頼
+        if rnd.random() < 0.4:
+            req_p = {'Property': i, 'CompletedTime': random_date(1975, 2099)}
+            if prop['Law'] == 'Trademark':
+                req_p['PaidYears'] = rnd.choice([5, 10])
+                req_p['Years'] = rnd.choice([5, 10])
+            elif rnd.random() < 0.5:
+                req_p['Years'] = 1
+                req_p['YearFrom'] = rnd.randrange(1, 21)
+            else:
+                req_p['YearFrom'] = rnd.randrange(1, 21)
+                req_p['YearTo'] = req_p['YearFrom'] + rnd.randrange(0, 3)
+            reqs = [{'_id': 'R%d-%d' % (i, j), 'RequestedTime': random_date(1975, 2099), 'Properties': [req_p,]} for j in range(2)]
+            last_requests[i] = select_last_request(reqs, i)
+
+    jp_calendar.get_calendar()
+    _business_table()
+
+    t = time.perf_counter()
+    expected = []
+    for prop in props:
+        req, req_p = last_requests[prop['_id']] if prop['_id'] in last_requests else (None, None)
+        expected.append(compute_limit_dates(prop, req, req_p))
+    t_scalar = time.perf_counter() - t
+
+    t = time.perf_counter()
+    actual = compute_limit_dates_batch(props, last_requests)
+    t_batch = time.perf_counter() - t
+
+    # 配列の計算のみ
+    years = []
+    exps = []
+    for prop in props:
+        req, req_p = last_requests[prop['_id']] if prop['_id'] in last_requests else (None, None)
+        y, exp = resolve_paid_years(prop, req, req_p)
+        years.append(y)
+        exps.append(exp)
+    arrays = (
+        np.array([x['Country'] == 'JP' for x in props]),
+        np.array([x['Law'] == 'Trademark' for x in props]),
+        to_datetime64([x['RegistrationDate'] if 'RegistrationDate' in x else None for x in props]),
+        to_datetime64(exps),
+        np.array(years),
+        np.array([common_util.in_and_true(x, 'Disappered') for x in props]),
+    )
+    t = time.perf_counter()
+    compute_limit_arrays(*arrays)
+    t_arrays = time.perf_counter() - t
+
+    mismatch = [i for i in range(size) if expected[i] != actual[i]]
+    for i in mismatch[:10]:
+        print('MISMATCH', props[i], expected[i], actual[i])
+
+    print('properties      : %d' % size)
+    print('mismatches      : %d' % len(mismatch))
+    print('one by one      : %.3f s' % t_scalar)
+    print('batch (NumPy)   : %.3f s' % t_batch)
+    print('  arrays only   : %.3f s' % t_arrays)
+
+    sys.exit(1 if len(mismatch) > 0 else 0)
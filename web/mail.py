@@ -10,6 +10,11 @@ from pathlib import Path
 import configparser
 from datetime import datetime, timedelta
 import base64
+import atexit
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from local_config import Config
 
@@ -29,9 +34,10 @@ else:
     from smtplib import SMTP as SMTP
 import ssl
 
-def send_mail(subject, body, to, cc=None, bcc=None, attachments=None):
+def build_message(subject, body, to, cc=None, bcc=None, attachments=None):
     """
-    メールの送信
+    送信するメッセージを生成する
+    :return メッセージ（宛先が無い場合は None）, 宛先の表示
     """
     enc = 'utf-8'
 
@@ -78,7 +84,7 @@ def send_mail(subject, body, to, cc=None, bcc=None, attachments=None):
 
     if to == "" and cc == "" and bcc == "":
         logger.warning("sending email was canceled, because address was not specified.")
-        return
+        return None, None
 
     if attachments is None or len(attachments) == 0:
 
@@ -118,28 +124,340 @@ def send_mail(subject, body, to, cc=None, bcc=None, attachments=None):
         message['Bcc'] = bcc
     message['From'] = conf['smtp']['from']
 
-    # SMTP-AUTH を通して送信
-    with SMTP(conf['smtp']['host'], int(conf['smtp']['port'])) as smtp:
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-        smtp.ehlo()
-        if SMTP.__name__ != 'SMTP_SSL':
-            smtp.starttls(context=context)
-        if 'user' in conf['smtp']:
-            smtp.login(conf['smtp']['user'], conf['smtp']['pwd'])
-            smtp.noop()
-        smtp.send_message(message)
-        smtp.quit()
+    return message, '%s (cc: %s, bcc: %s)' % (to, cc, bcc)
+
+# STARTTLS で使う SSL コンテキスト（接続ごとに作らず使い回す）
+_ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS)
+
+class SmtpSession:
+    """
+    認証済みの SMTP セッション
+    """
+
+    def __init__(self, host, port, user=None, pwd=None, starttls=True):
+        """
+        コンストラクター（接続して認証する）
+        """
+        self.smtp = SMTP(host, port)
+        self.smtp.ehlo()
+        if starttls and SMTP.__name__ != 'SMTP_SSL':
+            self.smtp.starttls(context=_ssl_context)
+            self.smtp.ehlo()
+        if not user is None:
+            self.smtp.login(user, pwd)
+        self.created_time = time.time()
+        self.last_used_time = self.created_time
+        self.messages = 0
+
+    def send(self, message):
+        """
+        メッセージを送信する
+        :return 拒否された宛先
+        """
+        refused = self.smtp.send_message(message)
+        self.messages += 1
+        self.last_used_time = time.time()
+        return refused
+
+    def is_alive(self):
+        """
+        接続が維持されているか否か
+        """
+        try:
+            return self.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        """
+        切断する
+        """
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                self.smtp.close()
+            except OSError:
+                pass
+
+class SmtpSessionPool:
+    """
+    SMTP セッションのプール
+    （認証済みのセッションを使い回し、切断されていた場合は接続し直す）
+    """
+
+    def __init__(self, host, port, user=None, pwd=None, size=4, max_messages=100, idle_timeout=60, starttls=True):
+        """
+        コンストラクター
+        size: 同時に使うセッションの数
+        max_messages: セッションを作り直すまでの送信数
+        idle_timeout: 使われていないセッションを送信前に確認するまでの秒数
+        starttls: 接続後に STARTTLS を行う（TLS に対応しないローカルの試験用サーバーでは False）
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.pwd = pwd
+        self.starttls = starttls
+        self.size = size
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.__idle = []
+        self.__in_use = 0
+        self.__closed = False
+        self.__cond = threading.Condition()
+        self.__stats = {'Connected': 0, 'Reused': 0, 'Reconnected': 0, 'Sent': 0, 'Failed': 0}
+
+    def __count(self, name):
+        with self.__cond:
+            self.__stats[name] += 1
+
+    def __connect(self):
+        """
+        接続する
+        """
+        session = SmtpSession(self.host, self.port, self.user, self.pwd, self.starttls)
+        self.__count('Connected')
+        return session
+
+    def __acquire(self):
+        """
+        セッションを借りる（すべて使用中の場合は返却を待つ）
+        """
+        with self.__cond:
+            while True:
+                if self.__closed:
+                    raise RuntimeError('the pool is closed.')
+                if len(self.__idle) > 0:
+                    self.__in_use += 1
+                    return self.__idle.pop()
+                if self.__in_use < self.size:
+                    self.__in_use += 1
+                    return None
+                self.__cond.wait()
+
+    def __release(self, session):
+        """
+        セッションを返す（None の場合は枠のみ返す）
+        """
+        if not session is None and (self.__closed or (self.max_messages > 0 and session.messages >= self.max_messages)):
+            session.close()
+            session = None
+        with self.__cond:
+            if not session is None:
+                self.__idle.append(session)
+            self.__in_use -= 1
+            self.__cond.notify()
+
+    def send(self, message):
+        """
+        メッセージを送信する（切断されていた場合は1度だけ接続し直して再送する）
+        :return 拒否された宛先
+        """
+        session = self.__acquire()
+        try:
+            # 長く使われていないセッションは確認する
+            if not session is None:
+                if time.time() - session.last_used_time > self.idle_timeout and not session.is_alive():
+                    session.close()
+                    session = None
+                else:
+                    self.__count('Reused')
+            if session is None:
+                session = self.__connect()
+
+            try:
+                refused = session.send(message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                # 接続し直して再送する
+                logger.warning('smtp session is lost (%s). reconnect.', e)
+                session.close()
+                session = None
+                session = self.__connect()
+                self.__count('Reconnected')
+                refused = session.send(message)
 
-    logger.info('sent mail to %s (cc: %s, bcc: %s)', to, cc, bcc)
+            self.__count('Sent')
+            return refused
+
+        except:
+            self.__count('Failed')
+            # エラーの起きたセッションは使わない
+            if not session is None:
+                session.close()
+                session = None
+            raise
+
+        finally:
+            self.__release(session)
+
+    def stats(self):
+        """
+        プールの状態を取得する
+        """
+        with self.__cond:
+            res = dict(self.__stats)
+            res['Idle'] = len(self.__idle)
+            res['InUse'] = self.__in_use
+        return res
+
+    def close(self):
+        """
+        すべてのセッションを切断する（使用中のものは返却時に切断する）
+        """
+        with self.__cond:
+            self.__closed = True
+            idle = self.__idle
+            self.__idle = []
+            self.__cond.notify_all()
+        for session in idle:
+            session.close()
+
+# プロセス内で共有するプール
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    プロセス内で共有するプールを取得する（設定は [smtp] から読み込む）
+    """
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                options = {}
+                if conf['smtp'].get('pool_size', ''):
+                    options['size'] = int(conf['smtp']['pool_size'])
+                if conf['smtp'].get('max_messages', ''):
+                    options['max_messages'] = int(conf['smtp']['max_messages'])
+                if 'user' in conf['smtp']:
+                    options['user'] = conf['smtp']['user']
+                    options['pwd'] = conf['smtp']['pwd']
+                _pool = SmtpSessionPool(conf['smtp']['host'], int(conf['smtp']['port']), **options)
+                atexit.register(_pool.close)
+
+    return _pool
+
+def send_mail(subject, body, to, cc=None, bcc=None, attachments=None):
+    """
+    メールの送信
+    """
+    message, addresses = build_message(subject, body, to, cc, bcc, attachments)
+    if message is None:
+        return
+
+    # 認証済みのセッションで送信
+    get_pool().send(message)
+
+    logger.info('sent mail to %s', addresses)
+
+def send_many(messages, workers=None, pool=None):
+    """
+    複数のメールを並行して送信する
+    messages: send_mail の引数（subject, body, to, cc, bcc, attachments）の dict のリスト
+    workers: 同時に送信する数（省略時はプールの大きさ）
+    pool: 送信に使うプール（省略時は共有のプール）
+    :return メッセージごとの結果（Result: 成否, Message: 失敗時の理由, Permanent: 再送しても成功しない失敗か否か, Refused: 拒否された宛先）のリスト
+    """
+    if pool is None:
+        pool = get_pool()
+
+    def send_one(kwargs):
+        try:
+            message, addresses = build_message(**kwargs)
+            if message is None:
+                return {'Result': False, 'Message': 'address is not specified.', 'Permanent': True}
+            refused = pool.send(message)
+            logger.info('sent mail to %s', addresses)
+            res = {'Result': True}
+            if len(refused) > 0:
+                res['Refused'] = dict([(k, list(v) if isinstance(v, tuple) else v) for k, v in refused.items()])
+            return res
+        except Exception as e:
+            logger.exception('cannot send mail (%s).', kwargs.get('subject', ''))
+            res = {'Result': False, 'Message': str(e)}
+            # すべての宛先が拒否された場合・5xx の応答は、再送しても成功しない
+            if isinstance(e, smtplib.SMTPRecipientsRefused) or (isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500):
+                res['Permanent'] = True
+            return res
+
+    if len(messages) < 1:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(len(messages), workers if workers else pool.size)) as executor:
+        return list(executor.map(send_one, messages))
 
 if __name__ == '__main__':
-    import io
-    import os.path
-    with open('20231107_特許6791731号_手続完了報告書.pdf', 'rb') as fin:
-        attrs = [{
-            'Data': fin.read(),
-            'Name': '20231107_特許6791731号_手続完了報告書.pdf',
-        }]
-    # テストメールの送信
-    send_mail('テスト', 'テストです。', ['go2anj.1108@gmail.com',], attachments=attrs)
-    #send_mail('テスト', 'テストです。', 'hideto@isgs-lab.com')
+    # ローカルの試験用サーバー（aiosmtpd）に送信して、接続ごとの送信とプールでの送信を比べる
+    # python mail.py [件数] [サーバーの応答の遅延（秒）]
+    import asyncio
+
+    try:
+        from aiosmtpd.controller import Controller
+    except ImportError:
+        print('aiosmtpd is required.')
+        sys.exit(1)
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+
+    class Sink:
+        """
+        受信したメールを数えるだけのサーバー（接続・送信の応答を遅らせる）
+        """
+        def __init__(self):
+            self.received = 0
+        async def handle_EHLO(self, server, session, envelope, hostname, responses):
+            await asyncio.sleep(latency)
+            session.host_name = hostname
+            return responses
+        async def handle_DATA(self, server, session, envelope):
+            await asyncio.sleep(latency)
+            self.received += 1
+            return '250 OK'
+
+    # 空いているポートで起動する
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        host, port = sock.getsockname()
+
+    sink = Sink()
+    controller = Controller(sink, hostname=host, port=port)
+    controller.start()
+
+    # 差出人が未設定の場合は仮のアドレスにする
+    if not conf['smtp'].get('from', ''):
+        conf['smtp']['from'] = 'noreply@example.com'
+
+    messages = [{
+        'subject': 'テスト %d' % i,
+        'body': 'テストです。\n' * 20,
+        'to': ['user%d@example.com' % i,],
+    } for i in range(count)]
+
+    try:
+        # 1通ごとに接続する（従来の方法）
+        started = time.perf_counter()
+        for kwargs in messages:
+            message, _ = build_message(**kwargs)
+            session = SmtpSession(host, port, starttls=False)
+            session.send(message)
+            session.close()
+        elapsed = time.perf_counter() - started
+        print('connect per message: %d messages in %.2f s (%.0f / s)' % (count, elapsed, count / elapsed))
+
+        # プールで並行して送信する
+        for size in (1, 4, 8,):
+            pool = SmtpSessionPool(host, port, size=size, starttls=False)
+            started = time.perf_counter()
+            results = send_many(messages, pool=pool)
+            elapsed = time.perf_counter() - started
+            pool.close()
+            print('pool (size %d): %d messages in %.2f s (%.0f / s), failed %d, %s' % (
+                size, count, elapsed, count / elapsed, len([x for x in results if not x['Result']]), pool.stats()))
+
+        print('received:', sink.received)
+    finally:
+        controller.stop()
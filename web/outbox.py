@@ -0,0 +1,219 @@
+"""
+送信待ちのメール（Outbox コレクション）
+（画面の処理ではメールを登録するだけにして、送信はワーカーがまとめて行う）
+"""
+
+import logging
+import random
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import mail
+
+# ロガーの取得
+logger = logging.getLogger(__name__)
+
+# メールの状態
+STATUS_PENDING = 'Pending'
+STATUS_SENDING = 'Sending'
+STATUS_SENT = 'Sent'
+STATUS_FAILED = 'Failed'
+
+# 送信を諦めるまでの試行回数
+MAX_ATTEMPTS = 8
+
+# 再送までの待ち時間（秒、試行ごとに倍にする）
+BACKOFF_SECONDS = 60
+MAX_BACKOFF_SECONDS = 3600
+
+# 送信中のメールを他のワーカーに渡すまでの秒数（ワーカーが停止した場合）
+LOCK_SECONDS = 600
+
+# 送信済み・送信失敗のメールを保持する日数
+# ※添付ファイルは送信済み・送信失敗にした時点で削除し、保持するのは本文と宛先のみ
+RETENTION_DAYS = 7
+
+# 送信までの時間の集計のキー（Misc コレクション）
+_stats_key = 'Outbox'
+
+def enqueue(db, subject, body, to, cc=None, bcc=None, attachments=None, key=None, category=None):
+    """
+    メールを送信待ちに登録する
+    key: 冪等キー（同じキーのメールが既に登録されている場合は登録しない）
+    category: 集計・調査用の分類
+    :return 登録したメールの Id（登録済みの場合はそのメールの Id）
+    """
+    now = datetime.now()
+
+    doc = {
+        'Status': STATUS_PENDING,
+        'Message': {
+            'subject': subject,
+            'body': body,
+            'to': to,
+            'cc': cc,
+            'bcc': bcc,
+            'attachments': attachments,
+        },
+        'Attempts': 0,
+        'QueuedTime': now,
+        'NextAttemptTime': now,
+    }
+    if not key is None:
+        doc['Key'] = key
+    if not category is None:
+        doc['Category'] = category
+
+    try:
+        return db.Outbox.insert_one(doc).inserted_id
+    except DuplicateKeyError:
+        if key is None:
+            raise
+        # 登録済みのメールを使う
+        logger.info('mail %s is already queued.', key)
+        return db.Outbox.find_one({'Key': key}, {'_id': 1})['_id']
+
+def claim(db, worker, limit):
+    """
+    送信する時刻になったメール（または停止したワーカーの送信中のメール）を取り出す
+    """
+    now = datetime.now()
+    claimed = []
+
+    while len(claimed) < limit:
+        doc = db.Outbox.find_one_and_update({
+            '$or': [
+                {'Status': STATUS_PENDING, 'NextAttemptTime': {'$lte': now}},
+                {'Status': STATUS_SENDING, 'LockedUntil': {'$lt': now}},
+            ],
+        }, {
+            '$set': {
+                'Status': STATUS_SENDING,
+                'LockedUntil': now + timedelta(seconds=LOCK_SECONDS),
+                'Worker': worker,
+            },
+            '$inc': {'Attempts': 1},
+        }, sort=[('NextAttemptTime', 1)], return_document=ReturnDocument.AFTER)
+        if doc is None:
+            break
+        claimed.append(doc)
+
+    return claimed
+
+def backoff_seconds(attempts):
+    """
+    attempts 回目の送信に失敗した後、再送するまでの秒数
+    （同時に失敗したメールの再送が重ならないよう、幅を持たせる）
+    """
+    seconds = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * (2 ** max(0, attempts - 1)))
+    return seconds * random.uniform(0.5, 1.0)
+
+def finish(db, doc, result, max_attempts=MAX_ATTEMPTS):
+    """
+    送信結果を保存する（失敗した場合は再送を予約する）
+    """
+    now = datetime.now()
+
+    if result['Result']:
+
+        # 送信済み
+        db.Outbox.update_one({'_id': doc['_id']}, {
+            '$set': {
+                'Status': STATUS_SENT,
+                'SentTime': now,
+                'ExpireAt': now + timedelta(days=RETENTION_DAYS),
+            },
+            '$unset': {'LockedUntil': '', 'NextAttemptTime': '', 'Error': '', 'Message.attachments': ''},
+        })
+
+        # 登録から送信までの時間を記録する
+        latency = (now - doc['QueuedTime']).total_seconds()
+        db.Misc.update_one({'Key': _stats_key}, {
+            '$inc': {'Sent': 1, 'TotalLatencySeconds': latency},
+            '$max': {'MaxLatencySeconds': latency},
+            '$set': {'LastLatencySeconds': latency, 'LastSentTime': now},
+        }, upsert=True)
+        return
+
+    # 宛先が無い・拒否された場合は再送しない
+    if result.get('Permanent', False) or doc['Attempts'] >= max_attempts:
+
+        # 送信を諦める
+        logger.error('mail %s is failed after %d attempts. (%s)', doc['_id'], doc['Attempts'], result.get('Message', ''))
+        db.Outbox.update_one({'_id': doc['_id']}, {
+            '$set': {
+                'Status': STATUS_FAILED,
+                'Error': result.get('Message', ''),
+                'FailedTime': now,
+                'ExpireAt': now + timedelta(days=RETENTION_DAYS),
+            },
+            '$unset': {'LockedUntil': '', 'NextAttemptTime': '', 'Message.attachments': ''},
+        })
+        db.Misc.update_one({'Key': _stats_key}, {'$inc': {'Failed': 1}}, upsert=True)
+        return
+
+    # 再送を予約する
+    wait = backoff_seconds(doc['Attempts'])
+    logger.warning('mail %s is failed (attempt %d). retry after %.0f s. (%s)', doc['_id'], doc['Attempts'], wait, result.get('Message', ''))
+    db.Outbox.update_one({'_id': doc['_id']}, {
+        '$set': {
+            'Status': STATUS_PENDING,
+            'Error': result.get('Message', ''),
+            'NextAttemptTime': now + timedelta(seconds=wait),
+        },
+        '$unset': {'LockedUntil': ''},
+    })
+    db.Misc.update_one({'Key': _stats_key}, {'$inc': {'Retried': 1}}, upsert=True)
+
+def drain(db, worker, batch_size=20, max_attempts=MAX_ATTEMPTS, pool=None):
+    """
+    送信待ちのメールを取り出して、まとめて送信する
+    :return 処理したメールの数, 送信できた数
+    """
+    docs = claim(db, worker, batch_size)
+    if len(docs) < 1:
+        return 0, 0
+
+    # 並行して送信する
+    results = mail.send_many([doc['Message'] for doc in docs], pool=pool)
+
+    # 結果を保存する
+    sent = 0
+    for doc, res in zip(docs, results):
+        finish(db, doc, res, max_attempts)
+        if res['Result']:
+            sent += 1
+
+    return len(docs), sent
+
+def stats(db):
+    """
+    送信待ちの件数、最も長く待っている秒数、送信までの時間の集計を取得する
+    """
+    now = datetime.now()
+    res = {'Counts': {}, 'Backlog': 0, 'Due': 0, 'OldestWaitSeconds': None, 'Latency': {}}
+
+    # 状態ごとの件数（未送信のものが滞留している件数）
+    for rec in db.Outbox.aggregate([
+        {'$group': {'_id': '$Status', 'Count': {'$sum': 1}, 'Oldest': {'$min': '$QueuedTime'}}},
+    ]):
+        res['Counts'][rec['_id']] = rec['Count']
+        if rec['_id'] in (STATUS_PENDING, STATUS_SENDING,):
+            res['Backlog'] += rec['Count']
+            wait = (now - rec['Oldest']).total_seconds()
+            if res['OldestWaitSeconds'] is None or res['OldestWaitSeconds'] < wait:
+                res['OldestWaitSeconds'] = wait
+
+    # 送信する時刻になっている件数
+    res['Due'] = db.Outbox.count_documents({'Status': STATUS_PENDING, 'NextAttemptTime': {'$lte': now}})
+
+    # 送信までの時間
+    total = db.Misc.find_one({'Key': _stats_key}, {'_id': 0, 'Key': 0})
+    if not total is None:
+        res['Latency'] = total
+        if total.get('Sent', 0) > 0:
+            res['Latency']['AverageLatencySeconds'] = total['TotalLatencySeconds'] / total['Sent']
+
+    return res
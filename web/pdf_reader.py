@@ -3,7 +3,20 @@ from pdfminer.converter import TextConverter
 from pdfminer.layout import LAParams
 from pdfminer.pdfpage import PDFPage
 import io
+import os
+import json
+import time
+import atexit
+import hashlib
 import logging
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from local_config import Config
 
 logging.getLogger('pdfminer.psparser').setLevel(logging.WARNING)
 logging.getLogger('pdfminer.pdfinterp').setLevel(logging.WARNING)
@@ -13,40 +26,354 @@ logging.getLogger('pdfminer.pdfparser').setLevel(logging.WARNING)
 logging.getLogger('pdfminer.pdfpage').setLevel(logging.WARNING)
 logging.getLogger('pdfminer.converter').setLevel(logging.WARNING)
 
+logger = logging.getLogger(__name__)
+
+# 並行して読み取るページ数の下限（これより少ない場合は順に読み取る）
+PARALLEL_MIN_PAGES = 8
+
+# キャッシュの既定の上限（バイト）
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+
+# キャッシュの形式（読み取り方を変えた場合は上げて、古いエントリーを使わないようにする）
+_cache_version = 1
+
 def read(pdf):
     """
     PDFファイルを読み取る
     """
-    manager = PDFResourceManager()
+    return ''.join(read_pages(pdf))
+
+def read_pages(pdf):
+    """
+    PDFファイルをページごとに読み取る
+    （同じ内容のファイルはキャッシュから返し、ページの多いファイルはプロセスを分けて読み取る）
+    """
+    pdf.seek(0)
+    data = pdf.read()
     pdf.seek(0)
 
-    with io.BytesIO() as buff:
+    # キャッシュの確認
+    key = hashlib.sha256(data).hexdigest()
+    cache = get_cache()
+    pages = cache.get(key)
+    if not pages is None:
+        return pages
 
-        with TextConverter(manager, buff, codec='utf-8', laparams=LAParams()) as conv:
-            interpreter = PDFPageInterpreter(manager, conv)
-            for page in PDFPage.get_pages(pdf):
-                interpreter.process_page(page)
+    # 読み取り
+    pages = extract_pages(data)
 
-        return buff.getvalue().decode('utf-8')
+    # キャッシュに保存
+    cache.put(key, pages)
 
-def read_pages(pdf):
+    return pages
+
+def store_pages(data, pages):
     """
-    PDFファイルをページごとに読み取る
+    読み取り済みのページをキャッシュに保存する
+    （分割したファイルなど、読み取り結果が分かっているもの）
+    """
+    get_cache().put(hashlib.sha256(data).hexdigest(), pages)
+
+def _read_range(data, start=None, stop=None):
+    """
+    PDFファイルの指定した範囲のページを読み取る（別プロセスでも実行する）
     """
     pages = []
 
     manager = PDFResourceManager()
-    pdf.seek(0)
+    pagenos = None if start is None else set(range(start, stop))
 
-    for page in PDFPage.get_pages(pdf):
-        with io.BytesIO() as buff:
-            with TextConverter(manager, buff, codec='utf-8', laparams=LAParams()) as conv:
-                interpreter = PDFPageInterpreter(manager, conv)
-                interpreter.process_page(page)
-            pages.append(buff.getvalue().decode('utf-8'))
+    with io.BytesIO(data) as pdf:
+        for page in PDFPage.get_pages(pdf, pagenos=pagenos):
+            with io.BytesIO() as buff:
+                with TextConverter(manager, buff, codec='utf-8', laparams=LAParams()) as conv:
+                    interpreter = PDFPageInterpreter(manager, conv)
+                    interpreter.process_page(page)
+                pages.append(buff.getvalue().decode('utf-8'))
 
     return pages
 
+def extract_pages(data, workers=None):
+    """
+    PDFファイルをページごとに読み取る（キャッシュを使わない）
+    workers: 同時に読み取るプロセス数（省略時は設定値、1 以下なら順に読み取る）
+    """
+    if workers is None:
+        workers = get_workers()
+
+    # ページ数の確認
+    if workers > 1:
+        with io.BytesIO(data) as pdf:
+            count = sum(1 for _ in PDFPage.get_pages(pdf))
+    if workers <= 1 or count < PARALLEL_MIN_PAGES:
+        return _read_range(data)
+
+    # 連続したページの範囲に分けて読み取る
+    n = min(workers, count)
+    bounds = [count * i // n for i in range(n + 1)]
+    try:
+        executor = get_executor(workers)
+        futures = [executor.submit(_read_range, data, bounds[i], bounds[i+1]) for i in range(n)]
+        pages = []
+        for f in futures:
+            pages.extend(f.result())
+        return pages
+    except (BrokenProcessPool, OSError, RuntimeError):
+        # プロセスを起動できない・異常終了した場合は作り直し、このファイルは順に読み取る
+        logger.exception('pdf reader process pool is broken.')
+        reset_executor()
+        return _read_range(data)
+
+class PdfTextCache:
+    """
+    PDFファイルの読み取り結果のキャッシュ
+    （ファイルの内容の SHA-256 ごとに JSON で保存し、上限を超えたら古いものから削除する）
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        コンストラクター
+        max_bytes: 保存するファイルの合計の上限（0 以下ならキャッシュしない）
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.enabled = max_bytes > 0
+        self.__lock = threading.Lock()
+        self.__stats = {'Hit': 0, 'Miss': 0, 'Stored': 0, 'Evicted': 0}
+
+    def __path(self, key):
+        return self.directory / key[:2] / ('%s.json' % key)
+
+    def __count(self, name, n=1):
+        with self.__lock:
+            self.__stats[name] += n
+
+    def get(self, key):
+        """
+        読み取り結果を取得する
+        :return ページごとのテキスト（無い場合は None）
+        """
+        if not self.enabled:
+            return None
+
+        p = self.__path(key)
+        try:
+            with open(p, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.__count('Miss')
+            return None
+        if entry.get('Version') != _cache_version:
+            self.__count('Miss')
+            return None
+
+        # 使われたものを新しくする（削除の順序）
+        try:
+            os.utime(p)
+        except OSError:
+            pass
+
+        self.__count('Hit')
+        return entry['Pages']
+
+    def put(self, key, pages):
+        """
+        読み取り結果を保存する
+        """
+        if not self.enabled:
+            return
+
+        p = self.__path(key)
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            # 書き込み途中のファイルを読まないよう、別名で書いてから置き換える
+            fd, tmp = tempfile.mkstemp(dir=str(p.parent), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'Version': _cache_version, 'Pages': pages}, f, ensure_ascii=False)
+            os.replace(tmp, str(p))
+            self.__count('Stored')
+            self.prune()
+        except OSError:
+            # キャッシュできなくても読み取り自体は成功とする
+            logger.exception('cannot store pdf text cache (%s).', key)
+
+    def prune(self):
+        """
+        上限を超えた分を、使われていないものから削除する
+        """
+        entries = []
+        total = 0
+        for p in self.directory.glob('*/*.json'):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+            total += st.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        evicted = 0
+        for mtime, size, p in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                p.unlink()
+                evicted += 1
+            except OSError:
+                pass
+            total -= size
+
+        if evicted > 0:
+            self.__count('Evicted', evicted)
+
+    def stats(self):
+        """
+        ヒット・ミスの件数を取得する（プロセス内）
+        """
+        with self.__lock:
+            res = dict(self.__stats)
+        n = res['Hit'] + res['Miss']
+        if n > 0:
+            res['HitRatio'] = res['Hit'] / n
+        return res
+
+def _get_conf():
+    """
+    [pdf] の設定を取得する
+    """
+    config = Config()
+    return config['pdf'] if config.has_section('pdf') else {}
+
+# プロセス内で共有するキャッシュとプロセスプール
+_cache = None
+_executor = None
+_executor_workers = 0
+_lock = threading.Lock()
+
+def get_cache():
+    """
+    プロセス内で共有するキャッシュを取得する（設定は [pdf] から読み込む）
+    """
+    global _cache
+
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                conf = _get_conf()
+                directory = conf.get('cache_dir', '') or str(Path(tempfile.gettempdir()) / 'pdf_text_cache')
+                options = {}
+                if conf.get('cache_mb', ''):
+                    options['max_bytes'] = int(float(conf['cache_mb']) * 1024 * 1024)
+                _cache = PdfTextCache(directory, **options)
+
+    return _cache
+
+def get_workers():
+    """
+    同時に読み取るプロセス数（設定は [pdf] の workers、省略時は CPU の数）
+    """
+    conf = _get_conf()
+    if conf.get('workers', ''):
+        return int(conf['workers'])
+    return os.cpu_count() or 1
+
+def get_executor(workers):
+    """
+    プロセス内で共有するプロセスプールを取得する
+    """
+    global _executor, _executor_workers
+
+    with _lock:
+        if _executor is None or _executor_workers != workers:
+            if not _executor is None:
+                _executor.shutdown(wait=False)
+            else:
+                atexit.register(reset_executor)
+            # Web サーバーのスレッドから fork しないよう、spawn で起動する
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _executor_workers = workers
+
+    return _executor
+
+def reset_executor():
+    """
+    プロセスプールを終了する（次に使うときに作り直す）
+    """
+    global _executor
+
+    with _lock:
+        if not _executor is None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
 if __name__ == '__main__':
-    with open('./log/sample.pdf', 'rb') as sample:
-        print(read_pages(sample))
\ No newline at end of file
+    # 50ページの領収書の束を生成して、順に読み取る場合・並行して読み取る場合・キャッシュから返す場合を比べる
+    # python pdf_reader.py [PDFファイル]
+    import sys
+    import shutil
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            data = f.read()
+    else:
+        from reportlab.pdfgen import canvas
+        from reportlab.lib.pagesizes import A4
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+
+        pdfmetrics.registerFont(UnicodeCIDFont('HeiseiMin-W3'))
+        with io.BytesIO() as buff:
+            c = canvas.Canvas(buff, pagesize=A4)
+            for i in range(50):
+                c.setFont('HeiseiMin-W3', 16)
+                c.drawString(200, 780, '年金領収書')
+                c.setFont('HeiseiMin-W3', 10)
+                y = 740
+                for j in range(40):
+                    c.drawString(60, y, '特許第%07d号　第%d年分　特許料　%s円　納付日　令和6年%d月%d日' % (4000000 + i * 40 + j, j % 20 + 1, format(1000 * (j + 1), ','), j % 12 + 1, j % 28 + 1))
+                    y -= 16
+                c.showPage()
+            c.save()
+            data = buff.getvalue()
+
+    # 一時的なキャッシュを使う
+    cache_dir = tempfile.mkdtemp()
+    _cache = PdfTextCache(cache_dir)
+
+    try:
+        started = time.perf_counter()
+        sequential = extract_pages(data, workers=1)
+        elapsed = time.perf_counter() - started
+        print('sequential: %d pages in %.2f s' % (len(sequential), elapsed))
+
+        for workers in sorted(set([2, 4, get_workers()]) - set([1])):
+            # プロセスの起動は1度だけなので、計測の前に済ませる
+            get_executor(workers).submit(int).result()
+            started = time.perf_counter()
+            parallel = extract_pages(data, workers=workers)
+            elapsed_p = time.perf_counter() - started
+            print('parallel (%d processes): %d pages in %.2f s (x%.1f), same result: %s' % (
+                workers, len(parallel), elapsed_p, elapsed / elapsed_p, parallel == sequential))
+
+        # 1回目で保存し、2回目はキャッシュから返す
+        with io.BytesIO(data) as pdf:
+            read_pages(pdf)
+            started = time.perf_counter()
+            cached = read_pages(pdf)
+            elapsed_c = time.perf_counter() - started
+        print('cached: %d pages in %.4f s, same result: %s, %s' % (len(cached), elapsed_c, cached == sequential, _cache.stats()))
+
+        # 従来の1つのコンバーターで読み取る方法と同じ結果になること
+        manager = PDFResourceManager()
+        with io.BytesIO() as buff, io.BytesIO(data) as pdf:
+            with TextConverter(manager, buff, codec='utf-8', laparams=LAParams()) as conv:
+                interpreter = PDFPageInterpreter(manager, conv)
+                for page in PDFPage.get_pages(pdf):
+                    interpreter.process_page(page)
+            print('read() is compatible:', buff.getvalue().decode('utf-8') == ''.join(sequential))
+    finally:
+        reset_executor()
+        shutil.rmtree(cache_dir)
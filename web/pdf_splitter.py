@@ -59,6 +59,9 @@ def split(pdf):
             merger.close()
             new_pdfs.append(buff.getvalue())
 
+        # 分割したファイルの読み取り結果は分かっているので、読み直さないようキャッシュしておく
+        pdf_reader.store_pages(new_pdfs[-1], pages[pos[i]:pos[i+1]])
+
     return new_pdfs
 
 if __name__ == '__main__':
@@ -16,11 +16,12 @@ from database import DbClient
 import web_util
 import security
 import common_util
+import kigen_common
 from enums import RequestStatus
 import pdf_reader
 import pdf_parser
 import pdf_splitter
-import mail
+import outbox
 import language
 import report_pdf
 import report_docx
@@ -331,8 +332,24 @@ def props_api_refer():
     posted = web_util.get_posted_data(csrf_name='staff_prop')
     lang = web_util.get_ui_texts()
 
-    # 情報を取得して返す
-    return web_util.get_property_info_from_jpp(posted, lang)
+    # 照会ジョブを登録して返す（結果は props_api_refer_status で取得する）
+    return web_util.enqueue_jpp_job(posted, lang)
+
+@app.post('/s/props/api/refer/status')
+@auth.require_ajax()
+@web_util.local_page()
+@auth.staff_only()
+@web_util.json_safe()
+def props_api_refer_status():
+    """
+    Ajax: 特許庁DBの照会ジョブの状態（完了時は照会結果）
+    """
+    # POSTデータの取得
+    posted = web_util.get_posted_data(csrf_name='staff_prop')
+    lang = web_util.get_ui_texts()
+
+    # ジョブの状態を返す
+    return web_util.get_jpp_job(posted, lang)
 
 @app.route('/s/reqs/<page:int>')
 @auth.require()
@@ -991,6 +1008,9 @@ def reqs_completed():
             }
         )
 
+        # 依頼の状況を更新する
+        db.refresh_request_state([prop_id,])
+
         # 次回期限を更新する
         db.renew_limit_date(prop_id)
 
@@ -1068,6 +1088,9 @@ def reqs_cancel():
                 }
             )
 
+        # 依頼の状況を更新する
+        db.refresh_request_state([x['Property'] for x in tmp['Properties']])
+
     # 一覧ページを表示し直す。
     return reqs_page(filters=posted['Filters'], page=posted['Page'])
 
@@ -1677,6 +1700,9 @@ def check_request_is_completed(db, lang, targets=None):
                     }}
                 )
 
+                # 依頼の状況を更新する
+                db.refresh_request_state([req_p['Property'],])
+
                 if prop['Country'] == 'JP' and prop['Law'] == 'Trademark':
 
                     d = prop['RegistrationDate']
@@ -1807,13 +1833,16 @@ def send_completed_message(db, req_id, prop_id):
                 'Name': uf['Name'],
             })
 
-    # メールの送信
+    # メールの送信（送信待ちに登録し、ワーカーが送信する）
     to_addr, cc_addr, bcc_addr = db.get_mail_addresses(req['User'])
-    mail.send_mail(
+    outbox.enqueue(
+        db,
         subject,
         mail_body,
         to=to_addr, cc=cc_addr, bcc=bcc_addr,
         attachments=attachments,
+        key='CompletedReport:%s:%s' % (req_id, prop_id),
+        category='CompletedReport',
     )
 
     # 通知日時を記録する
@@ -2108,12 +2137,15 @@ def send_jpo_receipt_message(db, req_id, prop_id):
             'Name': req_p['JpoReceiptFile']['Name'],
         })
 
-    # メールの送信
-    mail.send_mail(
+    # メールの送信（送信待ちに登録し、ワーカーが送信する）
+    outbox.enqueue(
+        db,
         subject,
         mail_body,
         to=to_addr, cc=cc_addr, bcc=bcc_addr,
         attachments=attachments,
+        key='JpoReceipt:%s:%s' % (req_id, prop_id),
+        category='JpoReceipt',
     )
 
     # 通知日時を記録する
@@ -3269,155 +3301,10 @@ def kigen_page(page, sort, direction):
         # サポートする国・地域に制限
         query['$and'].append({'Country': {'$in': ['JP',]}})
 
-        # 権利リストの取得
-        props = []
-
-        for info in db.Properties.find(query):
-
-            # 表示用に編集
-            prop = {'_id': str(info['_id'])}
-            for key in ('Country', 'Law', 'RegistrationNumber', 'Subject', 'NextProcedureLimit',):
-                if key in info:
-                    prop[key] = info[key]
-
-            if info['Country'] == 'UNK':
-                prop['CountryDescription'] = info['CountryDescription']
-            else:
-                prop['CountryDescription'] = lang['Country'][info['Country']]
-            prop['LawName'] = lang['Law'][info['Law']]
-
-            # 関連付けられたユーザー
-            user_info = db.Users.find_one({'_id': info['User']})
-
-            if user_info is None:
-                continue
-
-            # 必要な場合は直近の依頼を取得
-            req_info_1 = None
-            req_info_2 = None
-
-            if not 'UserName' in info or 'RegisteredTime' in info:
-                reqs = db.Requests.find({
-                    'Properties': {
-                        '$elemMatch': {
-                            'Property': info['_id'],
-                        }
-                    }
-                }, {
-                    'Properties.Property': 1,
-                    'RequestedTime': 1,
-                    'User': 1,
-                    'UserName': 1,
-                    'UserOrganization': 1,
-                    'Organization': 1,
-                })
-                reqs = [x for x in reqs]
-                reqs = sorted(reqs, key=lambda x: x['RequestedTime'])
-                if len(reqs) > 0:
-                    req_info_1 = reqs[0]
-                    req_info_2 = reqs[-1]
-
-            # 申込日
-            if 'RegisteredTime' in info:
-                prop['RegisteredTime'] = info['RegisteredTime']
-            elif not req_info_1 is None:
-                prop['RegisteredTime'] = req_info_1['RequestedTime']
-            elif 'ModifiedTime' in info:
-                prop['RegisteredTime'] = info['ModifiedTime']
-
-            # メールアドレス
-            if 'MailAddress' in user_info:
-                prop['MailAddress'] = user_info['MailAddress']
-
-            # 申込人
-            if 'UserName' in info:
-                prop['UserName'] = info['UserName']
-                if 'Organization' in info:
-                    prop['UserOrganization'] = info['Organization']
-                elif 'UserOrganization' in info:
-                    prop['UserOrganization'] = info['UserOrganization']
-            elif not req_info_2 is None and 'UserName' in req_info_2:
-                # 直近の依頼から取得
-                if 'UserName' in req_info_2:
-                    prop['UserName'] = req_info_2['UserName']
-                if 'Organization' in req_info_2:
-                    prop['UserOrganization'] = req_info_2['Organization']
-                if 'UserOrganization' in req_info_2:
-                    prop['UserOrganization'] = req_info_2['UserOrganization']
-            else:
-                # 権利に関連付けられたユーザー情報を取得
-                if 'Name' in user_info:
-                    prop['UserName'] = user_info['Name']
-                if 'Organization' in user_info:
-                    prop['UserOrganization'] = user_info['Organization']
-
-            # 権利者
-            if 'Holders' in info:
-                tmp = [x['Name'] for x in info['Holders'] if 'Name' in x]
-                if len(tmp) > 0:
-                    prop['Holders'] = tmp
-
-            # 通知日
-            if 'NotifiedDates' in info and 'NextProcedureLimit' in info:
-                nds = info['NotifiedDates']
-                d = common_util.add_months(info['NextProcedureLimit'], -7)
-                nds = [x for x in nds if x['Date'] > d]
-                nds = sorted(nds, key=lambda x: x['Date'])
-                for x in nds:
-                    if x['Timing'] == 'm6':
-                        prop['NotifiedM6'] = x['Date']
-                    elif x['Timing'] == 'm3':
-                        prop['NotifiedM3'] = x['Date']
-                    elif x['Timing'] == 'm1':
-                        prop['NotifiedM1'] = x['Date']
-                    elif x['Timing'] == 'd10':
-                        prop['NotifiedD10'] = x['Date']
-
-            # 備考
-            if 'Memo' in info:
-                prop['Memo'] = info['Memo']
-
-            # 通知制限
-            if 'Silent' in info:
-                prop['Silent'] = info['Silent']
-                if 'SilentTime' in info:
-                    prop['SilentTime'] = info['SilentTime']
-            else:
-                prop['Silent'] = False
-
-            # 表示候補に追加
-            props.append(prop)
-
-    # 並べ替え
-    if sort == 'n':
-        # 次回納付期限
-        props = sorted(props, key=lambda x: x['NextProcedureLimit'] if 'NextProcedureLimit' in x else (datetime.min if (direction == 'd') else datetime.max), reverse=(direction == 'd'))
-    elif sort == 'r':
-        # 登録番号
-        props = sorted(props, key=lambda x: x['RegistrationNumber'] if 'RegistrationNumber' in x else '熙熙熙', reverse=(direction == 'd'))
-    elif sort == 'h':
-        # 権利者
-        def first_holder(x):
-            if 'Holders' in x:
-                return x['Holders'][0]
-            return '\U00010FFFF'
-        props = sorted(props, key=lambda x: first_holder(x), reverse=(direction == 'd'))
-    elif sort == 'u':
-        # ユーザー
-        def user_name(x):
-            if 'UserOrganization' in x:
-                return x['UserOrganization']
-            if 'UserName' in x:
-                return '\U00010FFFF' + x['UserName']
-            return '\U00010FFFF' * 2
-        props = sorted(props, key=lambda x: user_name(x), reverse=(direction == 'd'))
+        # 権利リストの取得（並べ替えとページング処理を含む）
+        props, p_max, page = kigen_common.query_page(db, lang, query, page, sort, direction, page_size=500, staff=True)
 
-    # ページング処理
     doc = {}
-
-    # 通常のページング
-    props, p_max, page = web_util.paging(props, 500, page)
-
     doc['Page'] = {
         'Current': page,
         'Max': p_max,
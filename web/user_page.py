@@ -4,6 +4,7 @@ import math
 import logging
 from bottle import request, redirect, abort
 from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
 import io
 import json
 import operator
@@ -17,7 +18,7 @@ import auth
 from database import DbClient
 import language
 import jpo_price
-import mail
+import outbox
 import common_util
 import invoice
 import fee_calculator
@@ -99,46 +100,30 @@ def props_page(filters={}, page=1, id=None, target=None, info=None):
     # 言語辞書の取得
     lang = web_util.get_ui_texts()
 
-    with DbClient() as db:
-
-        # 通貨設定の取得
-        currencies = common_util.get_currencies(db)
-
-        # DB用のクエリーの構築
-        query = {'$and':[
-            {'User': auth.get_account_id()},
-            {'Ignored': {'$exists': False}},
-        ]}
-
-        # サポートする国・地域に制限
-        query['$and'].append({'Country': {'$in': ['JP',]}})
-
-        if 'q' in filters:
-            p = re.compile(r'.*' + re.escape(filters['q']) + r'.*', flags=re.IGNORECASE)
-            sq = [
-                {'RegistrationNumber': p},
-                {'Subject': p},
-                {'PctNumber': p},
-                {'PriorNumber': p},
-                {'ManagementNumber': p},
-                {'Holders':{'$elemMatch':{'Name': p}}}
-            ]
-            query['$and'].append({'$or':sq})
-
-        if '_id' in filters:
-            id = ObjectId(filters['_id'])
-            query['$and'].append({'_id': id})
-        else:
-            id = None
-
-        # 権利リストの取得
-        props = []
-
-        # 検索の実行
-        for prop in db.Properties.find(query, {'_id': 1}):
-
-            # 詳細を取得してリストに追加
-            props.append(get_prop_info(prop['_id'], date_to_str=False))
+    # DB用のクエリーの構築
+    query = {'$and':[
+        {'User': auth.get_account_id()},
+        {'Ignored': {'$exists': False}},
+    ]}
+
+    # サポートする国・地域に制限
+    query['$and'].append({'Country': {'$in': ['JP',]}})
+
+    if 'q' in filters:
+        p = re.compile(r'.*' + re.escape(filters['q']) + r'.*', flags=re.IGNORECASE)
+        sq = [
+            {'RegistrationNumber': p},
+            {'Subject': p},
+            {'PctNumber': p},
+            {'PriorNumber': p},
+            {'ManagementNumber': p},
+            {'Holders':{'$elemMatch':{'Name': p}}}
+        ]
+        query['$and'].append({'$or':sq})
+
+    if '_id' in filters:
+        id = ObjectId(filters['_id'])
+        query['$and'].append({'_id': id})
 
     # 並べ替え指定
     # ※以前の並べ替え指定を復元
@@ -155,100 +140,46 @@ def props_page(filters={}, page=1, id=None, target=None, info=None):
         sort_seq.append('1')
     sort = sort_seq[-1]
 
-    for sort_key in sort_seq:
+    # 並べ替えの優先順
+    # ※従来の安定ソートの繰り返しと同じく、最後の指定を第1キー、
+    #   それ以前に次回手続期限順の指定があれば第2キーとする
+    sort_keys = ['_K%s' % sort,]
+    if sort != '1' and '1' in sort_seq[:-1]:
+        sort_keys.append('_K1')
+    sort_keys.append('_id')
 
-        if sort_key == '1':
+    page_size = 100
 
-            # 次回手続期限順に並べ替え
-            def order_1(x):
-                if 'AbandonedTime' in x:
-                    return datetime.max
-                if not 'NextProcedureLimit' in x:
-                    return datetime.max
-                if x['NextProcedureLimit'] > datetime.now():
-                    return x['NextProcedureLimit']
-                else:
-                    if 'NextProcedureLastLimit' in x and x['NextProcedureLastLimit'] > datetime.now():
-                        return x['NextProcedureLastLimit']
-                    elif common_util.add_months(x['NextProcedureLimit'], 6) > datetime.now():
-                        return common_util.add_months(x['NextProcedureLimit'], 6)
-                    return datetime.max
-            props = sorted(props, key=lambda x: order_1(x))
-
-        elif sort == '2':
-
-            # 法区分で並べ替え
-            order = ['Patent', 'Utility', 'Design', 'Trademark',]
-            props = sorted(props, key=lambda x: order.index(x['Law']))
-
-        elif sort == '3':
-
-            # 状態で並べ替え
-            def order(x):
-                if common_util.in_and_true(x, 'Disappered'):
-                    return 999
-                if 'ExpirationDate' in x and x['ExpirationDate'] < datetime.now():
-                    return 999
-                if 'Abandoned' in x:
-                    return 999
-                if 'NextProcedureLimit' in x:
-                    if common_util.add_months(x['NextProcedureLimit'], 6) < datetime.now():
-                        return 999
-                if 'RequestWarning_Reason' in x:
-                    if x['RequestWarning_Reason'] == 'AlreadyRequested':
-                        return 81
-                    if x['RequestWarning_Reason'] == 'AlreadySelected':
-                        return 80
-                    if x['RequestWarning_Reason'] == 'PassLimit':
-                        return 40
-                if x['Law'] == 'Trademark':
-                    if 'NextProcedureLimit' in x and x['NextProcedureLimit'] > common_util.add_months(datetime.now(), 6):
-                        return 5
-                return 1
-            props = sorted(props, key=lambda x: order(x))
-
-        elif sort == '4':
-
-            # 権利者で並べ替え
-            def first_holder_name(x):
-                if 'Holders' in x and len(x['Holders']) > 0:
-                    for h in x['Holders']:
-                        if 'Name' in h:
-                            return h['Name']
-                return chr(0xffff)
-            props = sorted(props, key=lambda x: first_holder_name(x))
-
-        elif sort == '5':
-
-            # 登録番号で並べ替え
-            props = sorted(props, key=lambda x: x['RegistrationNumber'] if 'RegistrationNumber' in x else chr(0xffff))
+    with DbClient() as db:
+
+        # 件数とページ数
+        total = db.Properties.count_documents(query)
+        p_max = max(1, int(math.floor((total - 1) / page_size)) + 1)
+
+        # 指定されたキーが存在するページを探す
+        if not id is None:
+            rank = props_rank(db, query, sort_keys, id)
+            if not rank is None:
+                page = int(rank / page_size) + 1
+
+        page = max(1, min(p_max, int(page)))
+
+        # 表示するページの権利を取得
+        pipeline = [{'$match': query},] + props_sort_stages(sort_keys) + [
+            {'$skip': page_size * (page - 1)},
+            {'$limit': page_size},
+            {'$project': {'_id': 1}},
+        ]
+        ids = [x['_id'] for x in db.Properties.aggregate(pipeline, allowDiskUse=True)]
+
+    # 表示するページの詳細のみ取得
+    result = get_prop_infos(ids, date_to_str=False)
 
     # ページに渡す値の生成
     filters['s'] = sort
     filters['ss'] = ','.join(sort_seq)
     doc = {'Filters': filters, 'Sort': sort, 'SortSeq': ','.join(sort_seq)}
 
-    result = None
-    page_size = 100
-
-    # ページング処理
-    if not id is None:
-        # 該当するキーが存在するページを探す
-        p = 1
-        while p < 10000:
-            props_, p_max, p_ = web_util.paging(props, page_size, p)
-            if len([x for x in props_ if x['_id'] == id]) > 0:
-                result = props_
-                page = p_
-                break
-            if p != p_:
-                break
-            p += 1
-
-    # 通常のページング処理
-    if result is None:
-        result, p_max, page = web_util.paging(props, page_size, page)
-
     doc['Page'] = {
         'Current': page,
         'Max': p_max,
@@ -268,6 +199,86 @@ def props_page(filters={}, page=1, id=None, target=None, info=None):
     # ページの生成
     return web_util.apply_template('user_props', doc=doc, info=info, csrf_name='user_props')
 
+def props_sort_stages(sort_keys):
+    """
+    知的財産権一覧の並べ替えキー（_K1～_K5）を計算して並べ替えるステージ
+    （表示用に編集した情報に対する従来の並べ替えと同じ順序になる）
+    """
+    now = datetime.now()
+
+    def is_date(field):
+        return {'$eq': [{'$type': field}, 'date']}
+
+    return [
+        {'$addFields': {
+            '_Npl6': {'$cond': [is_date('$NextProcedureLimit'), common_util.add_months_expr('$NextProcedureLimit', 6), None]},
+        }},
+        {'$addFields': {
+            # 次回手続期限順（追納期間を考慮）
+            '_K1': {'$switch': {
+                'branches': [
+                    {'case': {'$not': [is_date('$NextProcedureLimit')]}, 'then': datetime.max},
+                    {'case': {'$gt': ['$NextProcedureLimit', now]}, 'then': '$NextProcedureLimit'},
+                    {'case': {'$and': [is_date('$NextProcedureLastLimit'), {'$gt': ['$NextProcedureLastLimit', now]}]}, 'then': '$NextProcedureLastLimit'},
+                    {'case': {'$gt': ['$_Npl6', now]}, 'then': '$_Npl6'},
+                ],
+                'default': datetime.max,
+            }},
+            # 法区分順
+            '_K2': {'$indexOfArray': [['Patent', 'Utility', 'Design', 'Trademark',], '$Law']},
+            # 状態順
+            '_K3': {'$switch': {
+                'branches': [
+                    {'case': {'$and': [is_date('$ExpirationDate'), {'$lt': ['$ExpirationDate', now]}]}, 'then': 999},
+                    {'case': is_date('$Abandoned'), 'then': 999},
+                    {'case': {'$and': [is_date('$NextProcedureLimit'), {'$lt': ['$_Npl6', now]}]}, 'then': 999},
+                    {'case': {'$and': [
+                        {'$eq': ['$Law', 'Trademark']},
+                        is_date('$NextProcedureLimit'),
+                        {'$gt': ['$NextProcedureLimit', common_util.add_months(now, 6)]},
+                    ]}, 'then': 5},
+                ],
+                'default': 1,
+            }},
+            # 権利者順（名前のある最初の権利者）
+            '_K4': {'$let': {
+                'vars': {'hs': {'$filter': {
+                    'input': {'$cond': [{'$isArray': '$Holders'}, '$Holders', []]},
+                    'as': 'h',
+                    'cond': {'$ne': [{'$type': '$$h.Name'}, 'missing']},
+                }}},
+                'in': {'$cond': [{'$gt': [{'$size': '$$hs'}, 0]}, {'$arrayElemAt': ['$$hs.Name', 0]}, chr(0xffff)]},
+            }},
+            # 登録番号順
+            '_K5': {'$ifNull': ['$RegistrationNumber', chr(0xffff)]},
+        }},
+        {'$sort': dict([(x, 1) for x in sort_keys])},
+    ]
+
+def props_rank(db, query, sort_keys, id):
+    """
+    知的財産権一覧の並び順で、指定した権利より前にある件数を取得する
+    （指定した権利が一覧に含まれない場合は None）
+    """
+    # 指定した権利のキーを取得
+    pipeline = [{'$match': {'$and': [query, {'_id': id}]}},] + props_sort_stages(sort_keys)
+    target = next(db.Properties.aggregate(pipeline), None)
+    if target is None:
+        return None
+
+    # キーの辞書順で前にあるものを数える
+    cond = []
+    for i, key in enumerate(sort_keys):
+        c = dict([(x, target[x]) for x in sort_keys[:i]])
+        c[key] = {'$lt': target[key]}
+        cond.append(c)
+    pipeline = [{'$match': query},] + props_sort_stages(sort_keys)[:-1] + [
+        {'$match': {'$or': cond}},
+        {'$count': 'Rank'},
+    ]
+    res = next(db.Properties.aggregate(pipeline, allowDiskUse=True), None)
+    return res['Rank'] if not res is None else 0
+
 def get_prop_info(id, date_to_str=True):
     """
     知的財産権の情報を取得する
@@ -284,6 +295,28 @@ def get_prop_info(id, date_to_str=True):
         # 情報の取得
         res = db.get_prop_info(id, lang, date_to_str=date_to_str)
 
+    # 表示用の編集
+    return adjust_prop_info(res, date_to_str)
+
+def get_prop_infos(ids, date_to_str=True):
+    """
+    複数の知的財産権の情報をまとめて取得する
+    """
+    # 表示言語
+    lang = web_util.get_ui_texts()
+
+    with DbClient() as db:
+
+        # 情報の取得
+        infos = db.get_prop_infos(ids, lang, date_to_str=date_to_str)
+
+    # 表示用の編集
+    return [adjust_prop_info(x, date_to_str) for x in infos]
+
+def adjust_prop_info(res, date_to_str=True):
+    """
+    知的財産権の情報に一覧表示用の期限情報を付与する
+    """
     if 'NextProcedureLimit' in res:
         # 一旦日付型化
         res['NextProcedureLimit'] = common_util.parse_date(res['NextProcedureLimit'])
@@ -447,8 +480,24 @@ def props_api_refer():
     posted = web_util.get_posted_data(csrf_name='user_props')
     lang = web_util.get_ui_texts()
 
-    # 情報を取得して結果を返す
-    return web_util.get_property_info_from_jpp(posted, lang)
+    # 照会ジョブを登録して返す（結果は props_api_refer_status で取得する）
+    return web_util.enqueue_jpp_job(posted, lang)
+
+@app.post('/props/api/refer/status')
+@auth.require_ajax()
+@web_util.local_page()
+@auth.client_only()
+@web_util.json_safe()
+def props_api_refer_status():
+    """
+    Ajax: 特許庁DBの照会ジョブの状態（完了時は照会結果）
+    """
+    # POSTデータの取得
+    posted = web_util.get_posted_data(csrf_name='user_props')
+    lang = web_util.get_ui_texts()
+
+    # ジョブの状態を返す
+    return web_util.get_jpp_job(posted, lang)
 
 @app.post('/props/api/cart')
 @auth.require_ajax()
@@ -1764,6 +1813,18 @@ def cart_page_accept():
         result_doc['Organization'] = user_org
     return web_util.apply_template('user_cart_3', doc=result_doc)
 
+def used_request_number(db, req_num_base):
+    """
+    依頼番号v2について、指定した日付文字列で使用済みの最大の連番を取得する
+    （日ごとのカウンターを導入する前に採番された番号を含む）
+    """
+    n = 0
+    for req in db.Requests.find({'RequestNumberV2': {'$regex': '^%s-' % re.escape(req_num_base)}}, {'RequestNumberV2': 1}):
+        m = re.match(r'^\d+-(\d+)$', req['RequestNumberV2'])
+        if m and int(m.group(1)) > n:
+            n = int(m.group(1))
+    return n
+
 def register_request(agent, category, targets, cdata, user_id=None, user_name=None, user_org=None, user_email=None):
     """
     依頼を登録する
@@ -1778,13 +1839,10 @@ def register_request(agent, category, targets, cdata, user_id=None, user_name=No
         now = datetime.now()
         currencies = common_util.get_currencies(db)
 
-        # 依頼番号v2の生成（日付文字列+連番）
+        # 依頼番号v2の生成（日付文字列+日ごとの連番）
         req_num_base = now.strftime('%Y%m%d')[2:]
-        i = 1
-        req_num = '%s-%d' % (req_num_base, i)
-        while db.Requests.count_documents({'RequestNumberV2': req_num,}) > 0:
-            i += 1
-            req_num = '%s-%d' % (req_num_base, i)
+        used = lambda: used_request_number(db, req_num_base)
+        req_num = '%s-%d' % (req_num_base, db.next_daily_number('RequestNumberV2', now, used))
 
         # 依頼の登録
         req = {
@@ -1832,7 +1890,16 @@ def register_request(agent, category, targets, cdata, user_id=None, user_name=No
         if 'ExchangeRate' in cdata:
             req['ExchangeRate'] = cdata['ExchangeRate']
 
-        res = db.Requests.insert_one(req)
+        # ※一意インデックスで重複した場合は採番し直す（カウンター導入前の番号との衝突）
+        for _ in range(100):
+            try:
+                res = db.Requests.insert_one(req)
+                break
+            except DuplicateKeyError:
+                req.pop('_id', None)
+                req['RequestNumberV2'] = '%s-%d' % (req_num_base, db.next_daily_number('RequestNumberV2', now, used))
+        else:
+            raise DuplicateKeyError('RequestNumberV2 is exhausted.')
         req_id = res.inserted_id
         has_invoice = False
         invoice_file = None
@@ -1879,6 +1946,9 @@ def register_request(agent, category, targets, cdata, user_id=None, user_name=No
             {'$set':{'Timestamp': datetime.now()}, '$unset':{'Cart': '', 'Ready': '', 'Ready_Classes': ''}}
         )
 
+        # 依頼の状況を更新する
+        db.refresh_request_state([x['Property'] for x in targets])
+
         # 権利にユーザー名を設定する
         if not user_name is None:
             q = {'$set': {'UserName': user_name}}
@@ -2100,26 +2170,32 @@ def register_request(agent, category, targets, cdata, user_id=None, user_name=No
         body_s.write('\n\n')
         body_s.write(lang.mail_footer(req['Agent']))
 
-        # ユーザー向けメールの送信
+        # ユーザー向けメールの送信（送信待ちに登録し、ワーカーが送信する）
         to_addr, cc_addr, bcc_addr = db.get_mail_addresses(req['User'])
         if has_invoice:
             attachments = [{'Name': filename, 'Data': invoice_file},]
         else:
             attachments = None
-        mail.send_mail(
+        outbox.enqueue(
+            db,
             subject_u,
             body_u.getvalue(),
             to=to_addr, cc=cc_addr, bcc=bcc_addr,
             attachments=attachments,
+            key='RequestAccepted:%s:User' % req_id,
+            category='RequestAccepted',
         )
 
         # スタッフ向けメールの送信
         to_addr, cc_addr, bcc_addr = db.get_staff_addresses()
-        mail.send_mail(
+        outbox.enqueue(
+            db,
             subject_s,
             body_s.getvalue(),
             to=to_addr, cc=cc_addr, bcc=bcc_addr,
             attachments=attachments,
+            key='RequestAccepted:%s:Staff' % req_id,
+            category='RequestAccepted',
         )
 
         # StringIOの破棄
@@ -2509,13 +2585,15 @@ def silent_notification(prop_id, user_id):
         # メールの後段
         mail_body.write(lang.mail_footer('0001'))
 
-        # メールの送信
+        # メールの送信（送信待ちに登録し、ワーカーが送信する）
         to_addr, cc_addr, bcc_addr = db.get_mail_addresses(user_id)
 
-        mail.send_mail(
+        outbox.enqueue(
+            db,
             mail_subject,
             mail_body.getvalue(),
             to=to_addr, cc=cc_addr, bcc=bcc_addr,
+            category='Silent',
         )
 
     # 成功
@@ -2640,13 +2718,15 @@ def direct_cancel_silent_page():
         # メールの後段
         mail_body.write(lang.mail_footer('0001'))
 
-        # メールの送信
+        # メールの送信（送信待ちに登録し、ワーカーが送信する）
         to_addr, cc_addr, bcc_addr = db.get_mail_addresses(user_id)
 
-        mail.send_mail(
+        outbox.enqueue(
+            db,
             mail_subject,
             mail_body.getvalue(),
             to=to_addr, cc=cc_addr, bcc=bcc_addr,
+            category='CancelSilent',
         )
 
     # 成功
@@ -3622,123 +3702,23 @@ def kigen_page(page, sort, direction):
         # サポートする国・地域に制限
         query['$and'].append({'Country': {'$in': ['JP',]}})
 
-        # 権利リストの取得
-        props = []
-
-        for info in db.Properties.find(query):
+        # 権利リストの取得（並べ替えとページング処理を含む）
+        props, p_max, page = kigen_common.query_page(db, lang, query, page, sort, direction, page_size=500)
 
-            # 表示用に編集
-            prop = {'_id': str(info['_id'])}
-            for key in ('Country', 'Law', 'RegistrationNumber', 'Subject', 'NextProcedureLimit', 'ManagementNumber',):
-                if key in info:
-                    prop[key] = info[key]
+        # 表示するページについてのみ、その他情報を取得
+        infos2 = {}
+        for info2 in db.get_prop_infos([x['_id'] for x in props], lang=lang, date_to_str=False):
+            infos2[info2['_id']] = info2
 
-            if info['Country'] == 'UNK':
-                prop['CountryDescription'] = info['CountryDescription']
-            else:
-                prop['CountryDescription'] = lang['Country'][info['Country']]
-            prop['LawName'] = lang['Law'][info['Law']]
-
-            # 関連付けられたユーザー
-            user_info = db.Users.find_one({'_id': info['User']})
-
-            if user_info is None:
-                continue
-
-            # 必要な場合は直近の依頼を取得
-            req_info_1 = None
-            req_info_2 = None
-
-            if not 'UserName' in info or 'RegisteredTime' in info:
-                reqs = db.Requests.find({
-                    'Properties': {
-                        '$elemMatch': {
-                            'Property': info['_id'],
-                        }
-                    }
-                }, {
-                    'Properties.Property': 1,
-                    'RequestedTime': 1,
-                    'User': 1,
-                    'UserName': 1,
-                    'UserOrganization': 1,
-                    'Organization': 1,
-                })
-                reqs = [x for x in reqs]
-                reqs = sorted(reqs, key=lambda x: x['RequestedTime'])
-                if len(reqs) > 0:
-                    req_info_1 = reqs[0]
-                    req_info_2 = reqs[-1]
-
-            # 申込日
-            if 'RegisteredTime' in info:
-                prop['RegisteredTime'] = info['RegisteredTime']
-            elif not req_info_1 is None:
-                prop['RegisteredTime'] = req_info_1['RequestedTime']
-            elif 'ModifiedTime' in info:
-                prop['RegisteredTime'] = info['ModifiedTime']
-
-            # メールアドレス
-            if 'MailAddress' in user_info:
-                prop['MailAddress'] = user_info['MailAddress']
-
-            # 申込人
-            if 'UserName' in info:
-                prop['UserName'] = info['UserName']
-                if 'Organization' in info:
-                    prop['UserOrganization'] = info['Organization']
-                elif 'UserOrganization' in info:
-                    prop['UserOrganization'] = info['UserOrganization']
-            elif not req_info_2 is None and 'UserName' in req_info_2:
-                # 直近の依頼から取得
-                if 'UserName' in req_info_2:
-                    prop['UserName'] = req_info_2['UserName']
-                if 'Organization' in req_info_2:
-                    prop['UserOrganization'] = req_info_2['Organization']
-                if 'UserOrganization' in req_info_2:
-                    prop['UserOrganization'] = req_info_2['UserOrganization']
-            else:
-                # 権利に関連付けられたユーザー情報を取得
-                if 'Name' in user_info:
-                    prop['UserName'] = user_info['Name']
-                if 'Organization' in user_info:
-                    prop['UserOrganization'] = user_info['Organization']
-
-            # 権利者
-            if 'Holders' in info:
-                tmp = [x['Name'] for x in info['Holders'] if 'Name' in x]
-                if len(tmp) > 0:
-                    prop['Holders'] = tmp
-
-            # 通知制限
-            if 'Silent' in info:
-                prop['Silent'] = info['Silent']
-                if 'SilentTime' in info:
-                    prop['SilentTime'] = info['SilentTime']
-            else:
-                prop['Silent'] = False
-
-            # その他情報の取得
-            info2 = db.get_prop_info(info['_id'], lang=lang, date_to_str=False)
-
-            # 情報の転記
-            for key in ('Requestable', 'RequestWarning_Short', 'AdditionalPeriod', 'NextOfficialFee', 'CurrencyLocal',
-                        'ApplyDiscount',):
-                if key in info2:
-                    prop[key] = info2[key]
-
-            # 表示候補に追加
-            props.append(prop)
-
-    # 並べ替え
-    props = kigen_common.sort_properties(props, sort, direction)
+    # 情報の転記
+    for prop in props:
+        info2 = infos2[prop['_id']]
+        for key in ('Requestable', 'RequestWarning_Short', 'AdditionalPeriod', 'NextOfficialFee', 'CurrencyLocal',
+                    'ApplyDiscount',):
+            if key in info2:
+                prop[key] = info2[key]
 
-    # ページング処理
     doc = {}
-
-    # 通常のページング
-    props, p_max, page = web_util.paging(props, 500, page)
-
     doc['Page'] = {
         'Current': page,
         'Max': p_max,
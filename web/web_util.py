@@ -23,8 +23,7 @@ import common_util
 import security
 import language
 import html_minify
-import patent_reference
-import jp_calendar
+import jpp_jobs
 
 logger = logging.getLogger(__name__)
 
@@ -99,20 +98,18 @@ def apply_template(name, doc=None, info=None, alert=None, csrf_name=None):
     doc['logged_in'] = False
     doc['user_name'] = 'Guest'
 
-    with DbClient() as db:
-
-        if auth.is_authenticated():
+    if auth.is_authenticated():
 
-            doc['logged_in'] = True
+        doc['logged_in'] = True
 
-            # ユーザー名
-            user = db.Users.find_one({'_id': auth.get_account_id()})
-            doc['user_name'] = user['Name'] if 'Name' in user else ''
+        # ユーザー名
+        user = auth.get_account()
+        doc['user_name'] = user['Name'] if 'Name' in user else ''
 
-            # 権限の取得と設定
-            doc['is_client'] = user['IsClient'] if 'IsClient' in user else False
-            doc['is_staff'] = user['IsStaff'] if 'IsStaff' in user else False
-            doc['is_admin'] = user['IsAdmin'] if 'IsAdmin' in user else False
+        # 権限の取得と設定
+        doc['is_client'] = user['IsClient'] if 'IsClient' in user else False
+        doc['is_staff'] = user['IsStaff'] if 'IsStaff' in user else False
+        doc['is_admin'] = user['IsAdmin'] if 'IsAdmin' in user else False
 
     # 通知の設定
     if info:
@@ -219,10 +216,9 @@ def get_language():
 
     # ログイン情報から取得
     if auth.is_authenticated():
-        with DbClient() as db:
-            u = db.Users.find_one({'_id': auth.get_account_id()})
-            if 'Language' in u and u['Language'] in allowed:
-                return u['Language']
+        u = auth.get_account()
+        if 'Language' in u and u['Language'] in allowed:
+            return u['Language']
 
     # Cookieから取得
     lang = get_cookie('lang')
@@ -664,138 +660,42 @@ def get_property_info_from_jpp(posted_data, ui_lang, force=False):
     """
     J-PlatPatから知的財産権の情報を取得する
     """
-    # キーの取得
-    if 'Id' in posted_data:
-
-        # Idが存在する場合はDBの登録情報を優先して使う
-        use_id = True
-        id = ObjectId(posted_data['Id'])
-
-        with DbClient() as db:
-
-            # 手続が進行中の場合は更新不可
-            proc = common_util.under_process(db, id, include_cart=(not force))
-            if proc:
-                return {'Result': False, 'Message': ui_lang['Error']['UnderProcess']}
+    with DbClient() as db:
 
-            # 権利の情報を取得
-            p = db.Properties.find_one({'_id': id}, {'RegistrationNumber':1, 'Law':1, 'Country':1})
+        # 照会する権利の決定
+        key, error = jpp_jobs.resolve_key(db, posted_data, ui_lang, force)
+        if key is None:
+            return error
 
-            # 取得した情報を展開
-            if p:
-                country = p['Country']
-                law = p['Law']
-                num_type = 'registration'
-                num = p['RegistrationNumber']
-            else:
-                return {
-                    'Result': False,
-                    'Message': ui_lang['Pages']['Property']['JPlatPat']['CannotGetInformation']
-                }
+        # 照会（Idが指定されていた場合はDBも更新する）
+        return jpp_jobs.refer_property(db, key, auth.get_account_id(), ui_lang)
 
-    else:
-
-        # Id が指定されていない場合は入力された基本情報を利用する
-        use_id = False
-
-        # 入力のチェック
-        if not 'Country' in posted_data:
-            return {'Result': False, 'Message': 'Country is not selected.'}
-        if not 'Law' in posted_data:
-            return {'Result': False, 'Message': 'Law is not selected.'}
-
-        law = posted_data['Law']
-        country = posted_data['Country']
-
-        # 番号の判別
-        if 'RegistrationNumber' in posted_data:
-            num_type = 'registration'
-            num = common_util.regularize_reg_num(country, law, posted_data['RegistrationNumber'])
-        elif 'ApplicationNumber' in posted_data:
-            num_type = 'application'
-            num = common_util.regularize_app_num(country, law, posted_data['ApplicationNumber'])
-        else:
-            return {'Result': False, 'Message': 'Missing property number.'}
-
-    # 特許情報の検索サービスの照会
-    data, message = patent_reference.refer(country, law, num, num_type, ui_lang)
+def enqueue_jpp_job(posted_data, ui_lang, force=False):
+    """
+    J-PlatPatの照会ジョブを登録する（照会はワーカーが実行する）
+    """
+    with DbClient() as db:
 
-    # 取得できず
-    if data is None:
-        return {'Result': False, 'Message': message}
+        # 照会する権利の決定
+        key, error = jpp_jobs.resolve_key(db, posted_data, ui_lang, force)
+        if key is None:
+            return error
 
-    # Idが指定されていた場合はDBも更新する
-    if use_id and data:
+        # ジョブの登録
+        job_id = jpp_jobs.enqueue(db, key, auth.get_account_id(), ui_lang.name)
 
-        data['Id'] = posted_data['Id']
-        updated, id, message, is_new = update_prop(data, update_abandonment=True)
+        return jpp_jobs.job_response(jpp_jobs.get_job(db, job_id, auth.get_account_id()), ui_lang)
 
-        # 次回手続期限の取得
-        with DbClient() as db:
-            p = db.Properties.find_one({'_id': id}, {'NextProcedureLimit':1})
-            if p and 'NextProcedureLimit' in p:
-                data['NextProcedureLimit'] = p['NextProcedureLimit']
-            if p and 'NextProcedureLastLimit' in p:
-                data['NextProcedureLastLimit'] = p['NextProcedureLastLimit']
-            
-    else:
+def get_jpp_job(posted_data, ui_lang):
+    """
+    J-PlatPatの照会ジョブの状態（完了している場合は照会結果）を取得する
+    """
+    if not 'JobId' in posted_data:
+        return {'Result': False, 'Message': 'Missing job id.'}
 
-        updated = False
-
-        # 次回手続期限の計算
-        if country == 'JP':
-            if 'PaidYears' in data:
-                # 商標は特別
-                if law == 'Trademark':
-                    # 存続期間満了日が設定されていない場合は計算しない
-                    if 'ExpirationDate' in data and data['PaidYears'] <= 10:
-                        data['NextProcedureLimit'] = common_util.add_months(data['ExpirationDate'], -1 * 12 * (10 - data['PaidYears']))
-                    elif 'ExpirationDate' in data:
-                        data['NextProcedureLimit'] = data['ExpirationDate']
-                    # 分割納付でない場合は次回手続の開始日をセットする
-                    if data['PaidYears'] == 10 and 'NextProcedureLimit' in data:
-                        if common_util.in_and_true(data, 'Disappered') or 'DisappearanceDate' in data:
-                            # 消滅している場合は計算しない
-                            pass
-                        if data['NextProcedureLimit'] < jp_calendar.add_months(common_util.get_today(), 6):
-                            # 期限を渡過している場合は計算しない
-                            pass
-                        else:
-                            data['NextProcedureOpenDate'] = common_util.add_months(data['NextProcedureLimit'], -6)
-                    # 追納期限と閉庁日調整
-                    if 'NextProcedureLimit' in data:
-                        data['NextProcedureLastLimit'] = jp_calendar.add_months(data['NextProcedureLimit'], 6, consider_holiday=True)
-                        data['NextProcedureLimit'] = jp_calendar.add_months(data['NextProcedureLimit'], 0, consider_holiday=True)
-                else:
-                    # 登録日が設定されていない場合は計算しない
-                    if 'RegistrationDate' in data:
-                        data['NextProcedureLimit'] = jp_calendar.add_months(data['RegistrationDate'], 12 * data['PaidYears'], consider_holiday=True)
-                        data['NextProcedureLastLimit'] = jp_calendar.add_months(data['RegistrationDate'], (12 * data['PaidYears']) + 6, consider_holiday=True)
-            elif law == 'Trademark':
-                # 納付年数のない商標は更新
-                if 'ExpirationDate' in data:
-                    data['NextProcedureLimit'] = data['ExpirationDate']
-                # 分割納付でない場合は次回手続の開始日をセットする
-                if common_util.in_and_true(data, 'Disappered') or 'DisappearanceDate' in data:
-                    # 消滅している場合は計算しない
-                    pass
-                if data['NextProcedureLimit'] < jp_calendar.add_months(common_util.get_today(), 6):
-                    # 期限を渡過している場合は計算しない
-                    pass
-                else:
-                    data['NextProcedureOpenDate'] = common_util.add_months(data['NextProcedureLimit'], -6)
-                # 追納期限と閉庁日調整
-                if 'NextProcedureLimit' in data:
-                    data['NextProcedureLastLimit'] = jp_calendar.add_months(data['NextProcedureLimit'], 6, consider_holiday=True)
-                    data['NextProcedureLimit'] = jp_calendar.add_months(data['NextProcedureLimit'], 0, consider_holiday=True)
-            
-    # レスポンスの生成
-    res = {
-        'Result': True,
-        'Data': data,
-        'Updated': updated,
-    }
-    return res
+    with DbClient() as db:
+        job = jpp_jobs.get_job(db, posted_data['JobId'], auth.get_account_id())
+        return jpp_jobs.job_response(job, ui_lang)
 
 def local_page():
     """